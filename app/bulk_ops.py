@@ -0,0 +1,430 @@
+import enum
+import json
+import logging
+import os
+import shutil
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, List, Dict, Any, Set, Callable, IO
+
+from app.model.image_data import ImageData
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.utils import bounded_map, sizeof_fmt
+
+_log = logging.getLogger(__name__)
+
+# deleted files are parked here (same filesystem as the workspace) until the operation is complete
+TRASH_DIR_NAME = ".picreview-trash"
+_JOURNAL_SUFFIX = ".journal"
+_JOURNAL_VERSION = 1
+
+
+class BulkOperation(enum.Enum):
+    MOVE = "move"
+    COPY = "copy"
+    DELETE = "delete"
+    HARDLINK = "hardlink"
+
+    @property
+    def needs_destination(self) -> bool:
+        return self is not BulkOperation.DELETE
+
+
+@dataclass(frozen=True)
+class BulkOpReport:
+    operation: BulkOperation
+    dry_run: bool
+    files_total: int
+    bytes_total: int
+    files_done: int = 0
+    files_failed: int = 0
+    # set when the operation is not complete and can be resumed or rolled back
+    journal: Optional[Path] = None
+
+    def __str__(self) -> str:
+        prefix = "[dry run] " if self.dry_run else ""
+        return f"{prefix}{self.operation.value}: {self.files_total} files, {sizeof_fmt(self.bytes_total)}, " \
+               f"done: {self.files_done}, failed: {self.files_failed}"
+
+
+class _Journal:
+    """
+    Append-only JSON lines file: a header, the planned items, then done/failed/undone marks.
+    A truncated last line (crash in the middle of a write) is ignored on load.
+    """
+    path: Path
+    header: Dict[str, Any]
+    items: List[Dict[str, Any]]
+    done: Set[int]
+    failed: Set[int]
+    undone: Set[int]
+    __file: IO
+
+    def __init__(self, path: Path, header: Dict[str, Any], items: List[Dict[str, Any]]):
+        self.path = path
+        self.header = header
+        self.items = items
+        self.done, self.failed, self.undone = set(), set(), set()
+        self.__file = None
+
+    @staticmethod
+    def create(path: Path, header: Dict[str, Any], items: List[Dict[str, Any]]) -> '_Journal':
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf8") as f:
+            f.write(json.dumps(header) + "\n")
+            for item in items:
+                f.write(json.dumps(item) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        return _Journal(path, header, items)
+
+    @staticmethod
+    def load(path: Path) -> '_Journal':
+        with open(path, "r", encoding="utf8") as f:
+            lines = f.readlines()
+        header = json.loads(lines[0])
+        if header.get("version") != _JOURNAL_VERSION:
+            raise ValueError(f"Unsupported journal version in {path}: {header.get('version')}")
+        journal = _Journal(path, header, [])
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                _log.warning(f"Skipping damaged journal record in {path}: {line!r}")
+                continue
+            if "src" in record:
+                journal.items.append(record)
+            elif "done" in record:
+                journal.done.add(record["done"])
+                journal.failed.discard(record["done"])
+            elif "failed" in record:
+                journal.failed.add(record["failed"])
+            elif "undone" in record:
+                journal.undone.add(record["undone"])
+        return journal
+
+    def mark(self, state: str, idx: int):
+        if self.__file is None:
+            self.__file = open(self.path, "a", encoding="utf8")
+        self.__file.write(json.dumps({state: idx}) + "\n")
+        self.__file.flush()
+        getattr(self, state).add(idx)
+
+    def sync(self):
+        if self.__file is not None:
+            os.fsync(self.__file.fileno())
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def remove(self):
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+def _same_copy(src: Path, dst: Path) -> bool:
+    if not dst.exists():
+        return False
+    src_stat, dst_stat = src.stat(), dst.stat()
+    return src_stat.st_size == dst_stat.st_size and src_stat.st_mtime_ns == dst_stat.st_mtime_ns
+
+
+def _move_file(src: Path, dst: Path):
+    if not src.exists() and dst.exists():
+        return  # moved already, the run has been interrupted before it was journaled
+    if dst.exists():
+        raise FileExistsError(f"Destination already exists: {dst}")
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(src, dst)
+
+
+def _copy_file(src: Path, dst: Path):
+    if _same_copy(src, dst):
+        return
+    if dst.exists():
+        raise FileExistsError(f"Destination already exists: {dst}")
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + ".part")
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _hardlink_file(src: Path, dst: Path):
+    if dst.exists():
+        if os.path.samefile(src, dst):
+            return
+        raise FileExistsError(f"Destination already exists: {dst}")
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    os.link(src, dst)
+
+
+def _unlink_file(_src: Path, dst: Path):
+    dst.unlink(missing_ok=True)
+
+
+_FILE_OPS: Dict[BulkOperation, Callable[[Path, Path], None]] = {
+    BulkOperation.MOVE: _move_file,
+    BulkOperation.COPY: _copy_file,
+    BulkOperation.DELETE: _move_file,  # into the trash, which is purged once all the files are processed
+    BulkOperation.HARDLINK: _hardlink_file,
+}
+
+_UNDO_FILE_OPS: Dict[BulkOperation, Callable[[Path, Path], None]] = {
+    BulkOperation.MOVE: lambda src, dst: _move_file(dst, src),
+    BulkOperation.COPY: _unlink_file,
+    BulkOperation.DELETE: lambda src, dst: _move_file(dst, src),
+    BulkOperation.HARDLINK: _unlink_file,
+}
+
+
+class BulkOpsEngine:
+    """
+    Applies a file operation to all the workspace images matching a rank filter.
+
+    File I/O runs on a bounded thread pool. Every run is journaled before any file is touched,
+    so a run interrupted by a crash can be resumed or rolled back later. Database changes are
+    applied in batches, each in a single transaction, after the matching journal records are synced.
+    """
+    __repository: Repository
+    __journal_dir: Path
+    __max_workers: int
+    __db_batch_size: int
+
+    def __init__(self, repo: Repository, journal_dir: Path, max_workers: int = 4, db_batch_size: int = 500):
+        assert max_workers > 0, "max_workers must be > 0"
+        assert db_batch_size > 0, "db_batch_size must be > 0"
+        self.__repository = repo
+        self.__journal_dir = journal_dir
+        self.__max_workers = max_workers
+        self.__db_batch_size = db_batch_size
+
+    def run(
+            self,
+            ws: Workspace,
+            operation: BulkOperation,
+            rank_filter: RankFilter,
+            destination: Optional[Path] = None,
+            dry_run: bool = False,
+    ) -> BulkOpReport:
+        images = self.__repository.get_images_by_rank(ws.id, rank_filter)
+        bytes_total = sum(i.size for i in images)
+        _log.info(f"Bulk {operation.value} of images with rank {rank_filter}: "
+                  f"{len(images)} files, {sizeof_fmt(bytes_total)}{' (dry run)' if dry_run else ''}")
+        if dry_run:
+            self._plan(ws, operation, images, destination)  # validates the arguments
+            return BulkOpReport(operation=operation, dry_run=True, files_total=len(images), bytes_total=bytes_total)
+        journal = self._prepare(ws, operation, images, destination)
+        return self._execute(journal)
+
+    def prepare(
+            self,
+            ws: Workspace,
+            operation: BulkOperation,
+            rank_filter: RankFilter,
+            destination: Optional[Path] = None,
+    ) -> Path:
+        """
+        Plans and journals the operation without executing it, it can be run with `resume` later.
+        """
+        images = self.__repository.get_images_by_rank(ws.id, rank_filter)
+        journal = self._prepare(ws, operation, images, destination)
+        journal.close()
+        return journal.path
+
+    def interrupted_runs(self) -> List[Path]:
+        if not self.__journal_dir.is_dir():
+            return []
+        return sorted(self.__journal_dir.glob(f"*{_JOURNAL_SUFFIX}"), key=lambda p: p.stat().st_mtime)
+
+    def resume(self, journal_path: Path) -> BulkOpReport:
+        _log.info(f"Resuming bulk operation from {journal_path}")
+        return self._execute(_Journal.load(journal_path))
+
+    def rollback(self, journal_path: Path) -> BulkOpReport:
+        _log.info(f"Rolling back bulk operation from {journal_path}")
+        journal = _Journal.load(journal_path)
+        operation = BulkOperation(journal.header["operation"])
+        ws_id = journal.header["workspace_id"]
+        ws_root = Path(journal.header["workspace_path"])
+        to_undo = [i for i in reversed(journal.items) if i["i"] in journal.done and i["i"] not in journal.undone]
+        undo = _UNDO_FILE_OPS[operation]
+        undone, failed = [], 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="bulk-op-undo") as executor:
+                window = self.__max_workers * 4
+                for item, future in bounded_map(executor, lambda i: undo(Path(i["src"]), Path(i["dst"])), to_undo, window):
+                    error = future.exception()
+                    if error is None:
+                        journal.mark("undone", item["i"])
+                        undone.append(item)
+                    elif isinstance(error, OSError):
+                        _log.error(f"Couldn't roll back {item['dst']} -> {item['src']}", exc_info=error)
+                        failed += 1
+                    else:
+                        raise error
+                    if len(undone) >= self.__db_batch_size:
+                        journal.sync()
+                        self._undo_db_changes(operation, ws_id, ws_root, undone)
+                        undone.clear()
+            journal.sync()
+            self._undo_db_changes(operation, ws_id, ws_root, undone)
+        finally:
+            journal.close()
+
+        report = BulkOpReport(
+            operation=operation,
+            dry_run=False,
+            files_total=len(to_undo),
+            bytes_total=sum(i["size"] for i in to_undo),
+            files_done=len(to_undo) - failed,
+            files_failed=failed,
+            journal=journal.path if failed else None,
+        )
+        if not failed:
+            self._cleanup(journal)
+        _log.info(f"Rollback done: {report}")
+        return report
+
+    def _plan(
+            self,
+            ws: Workspace,
+            operation: BulkOperation,
+            images: List[ImageData],
+            destination: Optional[Path],
+            op_id: str = "",
+    ) -> List[Dict[str, Any]]:
+        ws_root = Path(ws.path)
+        if operation.needs_destination:
+            if destination is None:
+                raise ValueError(f"Operation {operation.value} requires a destination")
+            destination = destination.absolute()
+            if destination == ws_root:
+                raise ValueError("Destination must differ from the workspace directory")
+        else:
+            destination = ws_root.joinpath(TRASH_DIR_NAME, op_id)
+
+        items = []
+        for idx, img in enumerate(images):
+            src = Path(img.path)
+            relative = src.relative_to(ws_root) if src.is_relative_to(ws_root) else Path(src.name)
+            items.append({
+                "i": idx,
+                "src": str(src),
+                "dst": str(destination.joinpath(relative)),
+                "size": img.size,
+                "last_updated_at": img.last_updated_at.isoformat(),
+                "width": img.width,
+                "height": img.height,
+                "rank": img.rank,
+            })
+        return items
+
+    def _prepare(
+            self,
+            ws: Workspace,
+            operation: BulkOperation,
+            images: List[ImageData],
+            destination: Optional[Path],
+    ) -> _Journal:
+        op_id = f"{datetime.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}"
+        items = self._plan(ws, operation, images, destination, op_id)
+        header = {
+            "version": _JOURNAL_VERSION,
+            "id": op_id,
+            "operation": operation.value,
+            "workspace_id": ws.id,
+            "workspace_path": ws.path,
+        }
+        return _Journal.create(self.__journal_dir.joinpath(op_id + _JOURNAL_SUFFIX), header, items)
+
+    def _execute(self, journal: _Journal) -> BulkOpReport:
+        operation = BulkOperation(journal.header["operation"])
+        ws_id = journal.header["workspace_id"]
+        ws_root = Path(journal.header["workspace_path"])
+        file_op = _FILE_OPS[operation]
+
+        # database changes of a previous interrupted run might not have been applied, they are idempotent
+        self._apply_db_changes(operation, ws_id, ws_root, [i for i in journal.items if i["i"] in journal.done])
+        pending = [i for i in journal.items if i["i"] not in journal.done]
+        processed, failed = [], 0
+        try:
+            with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix="bulk-op") as executor:
+                window = self.__max_workers * 4
+                for item, future in bounded_map(executor, lambda i: file_op(Path(i["src"]), Path(i["dst"])), pending, window):
+                    error = future.exception()
+                    if error is None:
+                        journal.mark("done", item["i"])
+                        processed.append(item)
+                    elif isinstance(error, OSError):
+                        _log.error(f"Couldn't {operation.value} {item['src']}", exc_info=error)
+                        journal.mark("failed", item["i"])
+                        failed += 1
+                    else:
+                        raise error
+                    if len(processed) >= self.__db_batch_size:
+                        journal.sync()
+                        self._apply_db_changes(operation, ws_id, ws_root, processed)
+                        processed.clear()
+            journal.sync()
+            self._apply_db_changes(operation, ws_id, ws_root, processed)
+        finally:
+            journal.close()
+
+        report = BulkOpReport(
+            operation=operation,
+            dry_run=False,
+            files_total=len(journal.items),
+            bytes_total=sum(i["size"] for i in journal.items),
+            files_done=len(journal.done),
+            files_failed=failed,
+            journal=journal.path if failed else None,
+        )
+        if not failed:
+            self._cleanup(journal)
+        _log.info(f"Bulk operation done: {report}")
+        return report
+
+    def _cleanup(self, journal: _Journal):
+        trash_dir = Path(journal.header["workspace_path"]).joinpath(TRASH_DIR_NAME, journal.header["id"])
+        if trash_dir.is_dir():
+            shutil.rmtree(trash_dir, ignore_errors=True)
+        journal.remove()
+
+    def _apply_db_changes(self, operation: BulkOperation, ws_id: int, ws_root: Path, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        if operation is BulkOperation.DELETE:
+            self.__repository.rm_images(ws_id, (i["src"] for i in items))
+        elif operation is BulkOperation.MOVE:
+            moved_within = [i for i in items if Path(i["dst"]).is_relative_to(ws_root)]
+            moved_out = [i for i in items if not Path(i["dst"]).is_relative_to(ws_root)]
+            self.__repository.move_images(ws_id, ((i["src"], i["dst"]) for i in moved_within))
+            self.__repository.rm_images(ws_id, (i["src"] for i in moved_out))
+        # copies and links inside the workspace are picked up by the next refresh
+
+    def _undo_db_changes(self, operation: BulkOperation, ws_id: int, ws_root: Path, items: List[Dict[str, Any]]):
+        if not items:
+            return
+        if operation in (BulkOperation.DELETE, BulkOperation.MOVE):
+            moved_within = {i["i"] for i in items if operation is BulkOperation.MOVE
+                            and Path(i["dst"]).is_relative_to(ws_root)}
+            self.__repository.move_images(ws_id, ((i["dst"], i["src"]) for i in items if i["i"] in moved_within))
+            # removed rows are restored from the journal to keep the ranks
+            self.__repository.persist_images(ImageData(
+                workspace_id=ws_id,
+                path=i["src"],
+                size=i["size"],
+                last_updated_at=datetime.fromisoformat(i["last_updated_at"]),
+                width=i["width"],
+                height=i["height"],
+                rank=i["rank"],
+            ) for i in items if i["i"] not in moved_within)
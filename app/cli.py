@@ -0,0 +1,301 @@
+"""
+Headless entry point, never imports the GUI stack so it can run on machines without a display, e.g. from cron:
+
+    python -m app.cli refresh my-workspace
+"""
+import argparse
+import logging
+import sys
+import time
+from dataclasses import replace
+from pathlib import Path
+from typing import List, Optional, TextIO
+
+from app.bulk_ops import BulkOperation, BulkOpReport
+from app.export import ArchiveFormat
+from app.model.rank_filter import RankFilter
+from app.model.scan_rules import ScanRules
+from app.pic_review import PicReview
+from app.publish import PublishFormat, PublishSettings
+
+_log = logging.getLogger(__name__)
+
+USERDATA_PATH = Path("./userdata")
+_HISTOGRAM_WIDTH = 40
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="picreview", description="PicReview headless commands")
+    parser.add_argument("--userdata", type=Path, default=USERDATA_PATH, help="userdata directory with the database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("workspaces", help="list workspaces")
+
+    create = commands.add_parser("create", help="create a workspace and index its images")
+    create.add_argument("path", type=Path, help="workspace directory")
+    create.add_argument("name", help="workspace name")
+    create.add_argument("--no-refresh", action="store_true", help="don't index images right away")
+
+    refresh = commands.add_parser("refresh", help="index new, updated and removed images of a workspace")
+    refresh.add_argument("workspace", help="workspace name or id")
+
+    move = commands.add_parser("move", help="point a workspace to the directory its files were moved to")
+    move.add_argument("workspace", help="workspace name or id")
+    move.add_argument("path", type=Path, help="new workspace directory")
+
+    rules = commands.add_parser("rules", help="print or set which files a workspace refresh indexes")
+    rules.add_argument("workspace", help="workspace name or id")
+    rules.add_argument("--patterns", help="file of gitignore-style patterns of files to exclude, or - for stdin")
+    rules.add_argument("--extensions", nargs="+", help="extensions of image files, e.g. jpg png webp")
+    rules.add_argument("--reset", action="store_true", help="back to no patterns and the default extensions")
+
+    histogram = commands.add_parser("histogram", help="print number of images per rank")
+    histogram.add_argument("workspace", help="workspace name or id")
+
+    bulk = commands.add_parser("bulk", help="move, copy, delete or hardlink images within a rank range")
+    bulk.add_argument("workspace", help="workspace name or id")
+    bulk.add_argument("operation", choices=[o.value for o in BulkOperation])
+    bulk.add_argument("destination", type=Path, nargs="?", help="target directory, not needed for delete")
+    _add_rank_filter_args(bulk)
+    bulk.add_argument("--dry-run", action="store_true", help="only print what would be done")
+
+    commands.add_parser("interrupted", help="list journals of interrupted bulk operations")
+    resume = commands.add_parser("resume", help="finish an interrupted bulk operation")
+    resume.add_argument("journal", type=Path)
+    rollback = commands.add_parser("rollback", help="undo an interrupted bulk operation")
+    rollback.add_argument("journal", type=Path)
+
+    export = commands.add_parser("export", help="stream images within a rank range into an archive")
+    export.add_argument("workspace", help="workspace name or id")
+    export.add_argument("output", help="archive file, or - for stdout")
+    _add_rank_filter_args(export)
+    export.add_argument("--format", choices=[f.value for f in ArchiveFormat], help="guessed from output if not set")
+    export.add_argument("--level", type=int, help="compression level, zip entries are stored if not set")
+
+    publish = commands.add_parser("publish", help="resize and re-encode images within a rank range")
+    publish.add_argument("workspace", help="workspace name or id")
+    publish.add_argument("destination", type=Path, help="output directory")
+    _add_rank_filter_args(publish)
+    publish.add_argument("--format", choices=[f.value for f in PublishFormat], default=PublishFormat.JPEG.value)
+    publish.add_argument("--max-edge", type=int, help="longest side in pixels, original size if not set")
+    publish.add_argument("--quality", type=int, default=90)
+
+    commands.add_parser("maintenance", help="reclaim space of removed images and workspaces, update statistics")
+    return parser
+
+
+def _add_rank_filter_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--min-rank", type=int, help="inclusive, unbounded if not set")
+    parser.add_argument("--max-rank", type=int, help="inclusive, unbounded if not set")
+
+
+def _rank_filter(args: argparse.Namespace) -> RankFilter:
+    return RankFilter(min_rank=args.min_rank, max_rank=args.max_rank)
+
+
+def _open_workspace(backend: PicReview, name_or_id: str) -> bool:
+    ws = backend.find_workspace(name_or_id)
+    if ws is None:
+        _log.error(f"No such workspace: {name_or_id}")
+        return False
+    backend.set_workspace_as_current(ws.id, refresh=False)
+    return True
+
+
+class _Progress:
+    """
+    Reports progress to stderr: in place on a terminal, every 10% to the log otherwise (e.g. under cron).
+    """
+    __label: str
+    __stream: TextIO
+    __interactive: bool
+    __last_printed_at: float = 0.0
+    __last_decile: int = -1
+
+    _PRINT_INTERVAL = 0.2  # seconds
+
+    def __init__(self, label: str, stream: TextIO = sys.stderr):
+        self.__label = label
+        self.__stream = stream
+        self.__interactive = stream.isatty()
+
+    def __call__(self, done: int, total: int):
+        percent = done * 100 // total if total else 100
+        if self.__interactive:
+            now = time.perf_counter()
+            if done == total or now - self.__last_printed_at >= self._PRINT_INTERVAL:
+                self.__last_printed_at = now
+                self.__stream.write(f"\r{self.__label}: {done}/{total} ({percent}%)" + ("\n" if done == total else ""))
+                self.__stream.flush()
+        elif percent // 10 > self.__last_decile:
+            self.__last_decile = percent // 10
+            _log.info(f"{self.__label}: {done}/{total} ({percent}%)")
+
+
+def _cmd_workspaces(backend: PicReview, _args: argparse.Namespace) -> int:
+    for ws in backend.get_workspaces():
+        last_used_at = f"{ws.last_used_at:%Y-%m-%d %H:%M}" if ws.last_used_at else "never"
+        print(f"{ws.id:>4}  {ws.name:<24} {last_used_at:<16}  {ws.path}")
+    return 0
+
+
+def _cmd_create(backend: PicReview, args: argparse.Namespace) -> int:
+    ws = backend.create_new_workspace(args.path, args.name, set_current=False)
+    if ws is None:
+        return 1
+    print(f"Created workspace {ws.id}: {ws.name}")
+    if args.no_refresh:
+        return 0
+    backend.set_workspace_as_current(ws.id, refresh=False)
+    return _refresh(backend)
+
+
+def _cmd_refresh(backend: PicReview, args: argparse.Namespace) -> int:
+    if not _open_workspace(backend, args.workspace):
+        return 1
+    return _refresh(backend)
+
+
+def _refresh(backend: PicReview) -> int:
+    report = backend.refresh_current_workspace(progress=_Progress("indexing"))
+    if report is None:
+        return 1
+    print(report.summary())
+    return 0 if report.files_failed == 0 else 2
+
+
+def _cmd_move(backend: PicReview, args: argparse.Namespace) -> int:
+    ws = backend.find_workspace(args.workspace)
+    if ws is None:
+        _log.error(f"No such workspace: {args.workspace}")
+        return 1
+    ws = backend.move_workspace_root(ws.id, args.path)
+    if ws is None:
+        return 1
+    print(f"Workspace {ws.name} now points to {ws.path}")
+    return 0
+
+
+def _cmd_rules(backend: PicReview, args: argparse.Namespace) -> int:
+    ws = backend.find_workspace(args.workspace)
+    if ws is None:
+        _log.error(f"No such workspace: {args.workspace}")
+        return 1
+    rules = ScanRules() if args.reset else backend.get_scan_rules(ws.id)
+    if args.patterns is not None:
+        patterns = sys.stdin.read() if args.patterns == "-" else Path(args.patterns).read_text(encoding="utf-8")
+        rules = replace(rules, patterns=patterns)
+    if args.extensions is not None:
+        extensions = ScanRules.parse_extensions(" ".join(args.extensions))
+        if not extensions:
+            raise ValueError("No extensions given")
+        rules = replace(rules, extensions=extensions)
+    if args.reset or args.patterns is not None or args.extensions is not None:
+        backend.set_scan_rules(ws.id, rules)
+        _log.info(f"Rules of {ws.name} updated, they apply from the next refresh")
+    print(f"extensions: {' '.join(rules.extensions)}")
+    for line in rules.patterns.splitlines():
+        print(line)
+    return 0
+
+
+def _cmd_histogram(backend: PicReview, args: argparse.Namespace) -> int:
+    if not _open_workspace(backend, args.workspace):
+        return 1
+    histogram = backend.get_current_workspace_images_rank_histogram()
+    widest = max(histogram.values(), default=0)
+    for rank, count in histogram.items():
+        bar = "#" * (count * _HISTOGRAM_WIDTH // widest)
+        print(f"{rank:>5} {count:>8} {bar}")
+    print(f"total {sum(histogram.values()):>8}")
+    return 0
+
+
+def _print_bulk_report(report: BulkOpReport) -> int:
+    print(report)
+    if report.journal is not None:
+        print(f"Not complete, resume or roll back with the journal: {report.journal}")
+    return 0 if report.files_failed == 0 and report.journal is None else 2
+
+
+def _cmd_bulk(backend: PicReview, args: argparse.Namespace) -> int:
+    if not _open_workspace(backend, args.workspace):
+        return 1
+    operation = BulkOperation(args.operation)
+    report = backend.run_bulk_operation(operation, _rank_filter(args), args.destination, dry_run=args.dry_run)
+    return _print_bulk_report(report)
+
+
+def _cmd_interrupted(backend: PicReview, _args: argparse.Namespace) -> int:
+    for journal in backend.get_interrupted_bulk_operations():
+        print(journal)
+    return 0
+
+
+def _cmd_resume(backend: PicReview, args: argparse.Namespace) -> int:
+    return _print_bulk_report(backend.resume_bulk_operation(args.journal))
+
+
+def _cmd_rollback(backend: PicReview, args: argparse.Namespace) -> int:
+    return _print_bulk_report(backend.rollback_bulk_operation(args.journal))
+
+
+def _cmd_export(backend: PicReview, args: argparse.Namespace) -> int:
+    if not _open_workspace(backend, args.workspace):
+        return 1
+    archive_format = ArchiveFormat(args.format) if args.format else None
+    report = backend.export_archive(_rank_filter(args), args.output, archive_format, args.level)
+    return 0 if report.files_failed == 0 else 2
+
+
+def _cmd_publish(backend: PicReview, args: argparse.Namespace) -> int:
+    if not _open_workspace(backend, args.workspace):
+        return 1
+    settings = PublishSettings(format=PublishFormat(args.format), max_edge=args.max_edge, quality=args.quality)
+    report = backend.publish_images(_rank_filter(args), args.destination, settings)
+    return 0 if report.failed == 0 else 2
+
+
+def _cmd_maintenance(backend: PicReview, _args: argparse.Namespace) -> int:
+    report = backend.run_maintenance()
+    print(report)
+    return 0 if report.complete else 2
+
+
+_COMMANDS = {
+    "workspaces": _cmd_workspaces,
+    "create": _cmd_create,
+    "refresh": _cmd_refresh,
+    "move": _cmd_move,
+    "rules": _cmd_rules,
+    "histogram": _cmd_histogram,
+    "bulk": _cmd_bulk,
+    "interrupted": _cmd_interrupted,
+    "resume": _cmd_resume,
+    "rollback": _cmd_rollback,
+    "export": _cmd_export,
+    "publish": _cmd_publish,
+    "maintenance": _cmd_maintenance,
+}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = _build_parser().parse_args(argv)
+    # stdout may carry the payload (e.g. an archive), so logs go to stderr
+    logging.basicConfig(
+        level=logging.INFO,
+        stream=sys.stderr,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%H:%M:%S',
+    )
+    args.userdata.mkdir(parents=True, exist_ok=True)
+    backend = PicReview(args.userdata.joinpath("database.sqlite3"), background=False)
+    try:
+        return _COMMANDS[args.command](backend, args)
+    except (ValueError, OSError) as e:
+        _log.error(str(e))
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+SQLite connections of the repository. A database file is opened in WAL mode with a single writer connection,
+which runs write jobs one by one on its own thread, and a pool of read-only connections for any thread.
+Readers see the last committed state and are never blocked by a write transaction in progress.
+
+Other processes may use the same database file. Write transactions take the write lock when they start
+(`BEGIN IMMEDIATE`), a connection waits up to its busy timeout for a lock held by another process, and a write
+job failing on a lock anyway is rolled back and retried with exponential backoff.
+
+Images of a workspace are in a database of their own, attached to a connection as `ws` when a query needs it,
+see `attach_workspace`. A connection has one workspace attached at a time.
+"""
+import logging
+import queue
+import random
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, ContextManager, Iterator, List, Optional, Tuple, TypeVar
+
+_log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CACHE_SIZE_KIB = 16 * 1024  # page cache of every connection
+MMAP_SIZE = 256 * 1024 * 1024
+MAX_IDLE_READERS = 4
+BUSY_TIMEOUT = 5.0  # seconds a connection waits for a lock held by another process
+BUSY_RETRIES = 5
+BUSY_BACKOFF = 0.05  # seconds before the first retry, doubled with every next one
+
+
+def is_busy(e: sqlite3.Error) -> bool:
+    """
+    Whether the error is a lock held by another connection, the operation may succeed if repeated.
+    """
+    code = getattr(e, "sqlite_errorcode", None)
+    if code is None:
+        return isinstance(e, sqlite3.OperationalError) and "locked" in str(e)
+    return code & 0xFF in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)  # incl. extended codes, e.g. BUSY_SNAPSHOT
+
+
+def run_with_retry(
+        job: Callable[[sqlite3.Connection], T],
+        connection: sqlite3.Connection,
+        retries: int = BUSY_RETRIES,
+        backoff: float = BUSY_BACKOFF,
+) -> T:
+    """
+    Runs the write job, if it fails because the database is locked, rolls it back and runs it again after
+    a randomized exponential backoff. Jobs must be whole transactions, so they can be repeated.
+    """
+    attempt = 0
+    while True:
+        try:
+            return job(connection)
+        except sqlite3.Error as e:
+            if not is_busy(e) or attempt >= retries:
+                raise
+            if connection.in_transaction:
+                connection.rollback()
+            delay = backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            attempt += 1
+            _log.warning(f"Database is locked ({e}), retry {attempt}/{retries} in {delay:.2f}s")
+            time.sleep(delay)
+
+
+class DbConnection(sqlite3.Connection):
+    """
+    Connection remembering the workspace whose database is attached to it.
+    """
+    read_only: bool = False
+    workspace_id: Optional[int] = None
+
+
+def _configure_schema(connection: sqlite3.Connection, schema: str):
+    # NORMAL is safe from corruption in WAL mode, a power loss may only roll back the last transactions
+    connection.execute(f"PRAGMA {schema}.synchronous = NORMAL")
+    connection.execute(f"PRAGMA {schema}.cache_size = -{CACHE_SIZE_KIB}")
+    connection.execute(f"PRAGMA {schema}.mmap_size = {MMAP_SIZE}")
+
+
+def init_journaling(connection: sqlite3.Connection) -> str:
+    """
+    Switches the database file to WAL, returns the journal mode it's in. A new database also gets incremental
+    auto vacuum, which can only be turned on before anything is written to it, for an existing one it's a no-op.
+    """
+    connection.execute("PRAGMA auto_vacuum = INCREMENTAL")  # freed pages are reclaimed by `app.maintenance`
+    return connection.execute("PRAGMA journal_mode = WAL").fetchone()[0]
+
+
+def configure_connection(connection: sqlite3.Connection, read_only: bool):
+    _configure_schema(connection, "main")
+    connection.execute("PRAGMA temp_store = MEMORY")  # sorting of the image lists
+    if isinstance(connection, DbConnection):
+        connection.read_only = read_only
+    if read_only:
+        connection.execute("PRAGMA query_only = ON")
+    else:
+        connection.execute("PRAGMA foreign_keys = ON")
+
+
+def attach_workspace(connection: DbConnection, workspace_id: Optional[int], database: Optional[str]):
+    """
+    Attaches the database (a file name or URI) of the workspace as `ws`, detaching the one attached before.
+    None detaches only. Can't be called within a transaction.
+    """
+    if connection.workspace_id == workspace_id:
+        return
+    if connection.workspace_id is not None:
+        connection.execute("DETACH DATABASE ws")
+        connection.workspace_id = None
+    if database is not None:
+        if connection.read_only and not database.startswith("file:"):
+            database = f"{Path(database).absolute().as_uri()}?mode=ro"  # not created if it doesn't exist
+        connection.execute("ATTACH DATABASE ? AS ws", (database,))
+        _configure_schema(connection, "ws")
+        connection.workspace_id = workspace_id
+
+
+class DbConnections(ABC):
+    """
+    Runs write jobs on the writer connection and hands out connections for reading.
+    """
+
+    @abstractmethod
+    def write(self, job: Callable[[DbConnection], T]) -> T:
+        """
+        Runs the job on the writer connection and returns its result, jobs never run concurrently.
+        """
+
+    @abstractmethod
+    def read(self) -> ContextManager[DbConnection]:
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+    @abstractmethod
+    def detach_workspace(self, workspace_id: int):
+        """
+        Detaches the workspace database from idle connections and the writer, so its file can be removed.
+        """
+
+
+class SharedConnection(DbConnections):
+    """
+    A single connection for reads and writes, used by one thread at a time. In-memory databases can't be
+    shared between connections, so they don't get a writer thread and readers.
+    """
+    __connection: Optional[DbConnection]
+    __lock: threading.RLock
+
+    def __init__(self, connection: DbConnection):
+        self.__connection = connection
+        self.__lock = threading.RLock()
+
+    def write(self, job: Callable[[DbConnection], T]) -> T:
+        with self.__lock:
+            return job(self.__connection)
+
+    @contextmanager
+    def read(self) -> Iterator[DbConnection]:
+        with self.__lock:
+            yield self.__connection
+
+    def close(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
+
+    def detach_workspace(self, workspace_id: int):
+        with self.__lock:
+            if self.__connection is not None and self.__connection.workspace_id == workspace_id:
+                attach_workspace(self.__connection, None, None)
+
+
+class WalConnections(DbConnections):
+    """
+    The writer connection lives on a dedicated thread fed by a queue of jobs; read-only connections are
+    opened on demand, up to `max_idle` of them are kept for reuse.
+    """
+    __writer: DbConnection
+    __jobs: 'queue.SimpleQueue[Optional[Tuple[Callable[[DbConnection], object], Future]]]'
+    __thread: threading.Thread
+    __connect_reader: Callable[[], DbConnection]
+    __idle_readers: List[DbConnection]
+    __readers_lock: threading.Lock
+    __max_idle: int
+    __closed: bool = False
+
+    def __init__(
+            self,
+            writer: DbConnection,
+            connect_reader: Callable[[], DbConnection],
+            max_idle: int = MAX_IDLE_READERS,
+            busy_retries: int = BUSY_RETRIES,
+    ):
+        self.__writer = writer
+        self.__jobs = queue.SimpleQueue()
+        self.__connect_reader = connect_reader
+        self.__idle_readers = []
+        self.__readers_lock = threading.Lock()
+        self.__max_idle = max_idle
+        # the thread references the queue and the connection only, not the owner, so the owner can be collected
+        self.__thread = threading.Thread(
+            target=WalConnections.__run_writer, args=(writer, self.__jobs, busy_retries), name="db-writer",
+            daemon=True,
+        )
+        self.__thread.start()
+
+    @staticmethod
+    def __run_writer(
+            connection: DbConnection,
+            jobs: 'queue.SimpleQueue[Optional[Tuple[Callable[[DbConnection], object], Future]]]',
+            busy_retries: int,
+    ):
+        while (item := jobs.get()) is not None:
+            job, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(run_with_retry(job, connection, busy_retries))
+            except BaseException as e:
+                future.set_exception(e)
+            # jobs reference the repository, which closes the connections when it's collected
+            del item, job, future
+        connection.close()
+
+    def write(self, job: Callable[[DbConnection], T]) -> T:
+        if threading.current_thread() is self.__thread:
+            return job(self.__writer)  # a job calling another one
+        if self.__closed:
+            raise sqlite3.ProgrammingError("Cannot operate on a closed database.")
+        future = Future()
+        self.__jobs.put((job, future))
+        return future.result()
+
+    @contextmanager
+    def read(self) -> Iterator[DbConnection]:
+        with self.__readers_lock:
+            connection = self.__idle_readers.pop() if self.__idle_readers else None
+        if connection is None:
+            connection = self.__connect_reader()
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()  # never keep an old snapshot around
+            with self.__readers_lock:
+                keep = not self.__closed and len(self.__idle_readers) < self.__max_idle
+                if keep:
+                    self.__idle_readers.append(connection)
+            if not keep:
+                connection.close()
+
+    def detach_workspace(self, workspace_id: int):
+        def detach(connection: DbConnection):
+            if connection.workspace_id == workspace_id:
+                attach_workspace(connection, None, None)
+        self.write(detach)
+        with self.__readers_lock:
+            idle = [c for c in self.__idle_readers if c.workspace_id == workspace_id]
+            self.__idle_readers = [c for c in self.__idle_readers if c.workspace_id != workspace_id]
+        for connection in idle:
+            connection.close()
+
+    def close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        self.__jobs.put(None)
+        if threading.current_thread() is not self.__thread:
+            self.__thread.join()
+        with self.__readers_lock:
+            readers, self.__idle_readers = self.__idle_readers, []
+        for connection in readers:
+            connection.close()
+
+
+def open_connections(
+        db_file: Path,
+        on_connect: Callable[[DbConnection], None],
+        busy_timeout: float = BUSY_TIMEOUT,
+) -> DbConnections:
+    """
+    `on_connect` is called for every connection opened, after it's configured.
+    """
+    if str(db_file) == ":memory:":
+        connection = sqlite3.connect(db_file, uri=True, factory=DbConnection, check_same_thread=False)
+        init_journaling(connection)
+        configure_connection(connection, read_only=False)
+        on_connect(connection)
+        return SharedConnection(connection)
+
+    # implicit transactions take the write lock upfront, a deferred one reading first could fail on upgrading
+    # its lock without waiting if another process committed meanwhile
+    writer = sqlite3.connect(db_file, timeout=busy_timeout, isolation_level="IMMEDIATE", factory=DbConnection,
+                             check_same_thread=False)
+    journal_mode = init_journaling(writer)
+    if journal_mode.lower() != "wal":
+        _log.warning(f"Couldn't enable WAL journaling, using {journal_mode}")
+    configure_connection(writer, read_only=False)
+    on_connect(writer)
+    reader_uri = f"{db_file.absolute().as_uri()}?mode=ro"
+
+    def connect_reader() -> DbConnection:
+        # handed between threads by the pool, but used by one thread at a time
+        reader = sqlite3.connect(reader_uri, uri=True, timeout=busy_timeout, factory=DbConnection,
+                                 check_same_thread=False)
+        configure_connection(reader, read_only=True)
+        on_connect(reader)
+        return reader
+
+    return WalConnections(writer, connect_reader)
@@ -0,0 +1,237 @@
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional, Dict, Deque, List, Any
+
+from app.perf import percentile
+
+_log = logging.getLogger(__name__)
+
+_WHITESPACE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+
+@dataclass(frozen=True)
+class StatementStats:
+    sql: str
+    count: int
+    total_time: float  # seconds, execution and fetching
+    p95_time: float
+    max_time: float
+    rows: int  # rows returned
+
+
+@dataclass(frozen=True)
+class QueryStatsSnapshot:
+    statements: List[StatementStats]  # the most time consuming first
+    commits: int
+    commit_time: float
+    slow_queries: int
+
+    @property
+    def query_count(self) -> int:
+        return sum(s.count for s in self.statements)
+
+    @property
+    def total_time(self) -> float:
+        return sum(s.total_time for s in self.statements) + self.commit_time
+
+
+class _StatementAccumulator:
+    count: int = 0
+    total_time: float = 0.0
+    max_time: float = 0.0
+    rows: int = 0
+    samples: Deque[float]
+
+    def __init__(self, max_samples: int):
+        self.samples = deque(maxlen=max_samples)
+
+
+class QueryStats:
+    """
+    Per statement execution stats. Statements taking longer than the slow query threshold
+    are logged along with their query plan.
+    """
+    slow_query_threshold: Optional[float]
+    __max_samples: int
+    __statements: Dict[str, _StatementAccumulator]
+    __commits: int
+    __commit_time: float
+    __slow_queries: int
+    __lock: threading.Lock
+
+    def __init__(self, slow_query_threshold: Optional[float] = None, max_samples: int = 1024):
+        self.slow_query_threshold = slow_query_threshold
+        self.__max_samples = max_samples
+        self.__lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.__lock:
+            self.__statements = {}
+            self.__commits = 0
+            self.__commit_time = 0.0
+            self.__slow_queries = 0
+
+    def is_slow(self, seconds: float) -> bool:
+        return self.slow_query_threshold is not None and seconds >= self.slow_query_threshold
+
+    def record(self, sql: str, seconds: float, rows: int, plan: Optional[List[str]] = None):
+        key = _WHITESPACE.sub(" ", sql).strip()
+        with self.__lock:
+            acc = self.__statements.get(key)
+            if acc is None:
+                acc = self.__statements[key] = _StatementAccumulator(self.__max_samples)
+            acc.count += 1
+            acc.total_time += seconds
+            acc.max_time = max(acc.max_time, seconds)
+            acc.rows += rows
+            acc.samples.append(seconds)
+            if self.is_slow(seconds):
+                self.__slow_queries += 1
+        if self.is_slow(seconds):
+            plan_text = "\n    ".join(plan) if plan else "n/a"
+            _log.warning(f"Slow query ({seconds * 1000:.1f} ms, {rows} rows): {key}\n  query plan:\n    {plan_text}")
+
+    def record_commit(self, seconds: float):
+        with self.__lock:
+            self.__commits += 1
+            self.__commit_time += seconds
+
+    @property
+    def total_time(self) -> float:
+        """
+        Total time of all statements and commits, cheap enough to be sampled every frame.
+        """
+        with self.__lock:
+            return sum(acc.total_time for acc in self.__statements.values()) + self.__commit_time
+
+    def snapshot(self) -> QueryStatsSnapshot:
+        with self.__lock:
+            statements = [
+                StatementStats(
+                    sql=sql,
+                    count=acc.count,
+                    total_time=acc.total_time,
+                    p95_time=percentile(sorted(acc.samples), 95),
+                    max_time=acc.max_time,
+                    rows=acc.rows,
+                ) for sql, acc in self.__statements.items()
+            ]
+            return QueryStatsSnapshot(
+                statements=sorted(statements, key=lambda s: s.total_time, reverse=True),
+                commits=self.__commits,
+                commit_time=self.__commit_time,
+                slow_queries=self.__slow_queries,
+            )
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """
+    Cursor timing each statement from execution until the next one or closing, including fetches.
+    """
+    __stats: QueryStats
+    __sql: Optional[str]
+    __parameters: Any
+    __elapsed: float
+    __rows: int
+
+    def __init__(self, connection: sqlite3.Connection, stats: QueryStats):
+        super().__init__(connection)
+        self.__stats = stats
+        self.__sql = None
+        self.__parameters = None
+        self.__elapsed = 0.0
+        self.__rows = 0
+
+    def __finish(self):
+        if self.__sql is None:
+            return
+        sql, self.__sql = self.__sql, None
+        plan = None
+        if self.__stats.is_slow(self.__elapsed):
+            plan = self.__explain(sql, self.__parameters)
+        self.__stats.record(sql, self.__elapsed, self.__rows, plan)
+
+    def __explain(self, sql: str, parameters: Any) -> Optional[List[str]]:
+        if parameters is None or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        try:
+            return [row[-1] for row in self.connection.execute(f"EXPLAIN QUERY PLAN {sql}", parameters).fetchall()]
+        except sqlite3.Error as e:
+            _log.debug(f"Couldn't explain {sql}: {e}")
+            return None
+
+    def __start(self, sql: str, parameters: Any, t: float):
+        self.__sql = sql
+        self.__parameters = parameters
+        self.__elapsed = time.perf_counter() - t
+        self.__rows = 0
+
+    def __fetched(self, t: float, rows: int):
+        self.__elapsed += time.perf_counter() - t
+        self.__rows += rows
+
+    def execute(self, sql: str, parameters: Any = (), /):
+        self.__finish()
+        t = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.__start(sql, parameters, t)
+
+    def executemany(self, sql: str, seq_of_parameters, /):
+        self.__finish()
+        t = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.__start(sql, None, t)
+
+    def executescript(self, sql_script: str, /):
+        self.__finish()
+        t = time.perf_counter()
+        try:
+            return super().executescript(sql_script)
+        finally:
+            self.__start(sql_script, None, t)
+
+    def fetchone(self):
+        t = time.perf_counter()
+        row = super().fetchone()
+        self.__fetched(t, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size: int = 1):
+        t = time.perf_counter()
+        rows = super().fetchmany(size)
+        self.__fetched(t, len(rows))
+        return rows
+
+    def fetchall(self):
+        t = time.perf_counter()
+        rows = super().fetchall()
+        self.__fetched(t, len(rows))
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.__fetched(t, 0)
+            raise
+        self.__fetched(t, 1)
+        return row
+
+    def close(self):
+        self.__finish()
+        super().close()
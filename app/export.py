@@ -0,0 +1,290 @@
+import enum
+import gzip
+import logging
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from io import BytesIO
+from pathlib import Path
+from typing import Optional, BinaryIO, Iterator, Tuple
+
+from app.model.image_data import ImageData
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.utils import bounded_map, sizeof_fmt
+
+_log = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 1024 * 1024
+# files up to this size are read ahead by the worker pool, bigger ones are streamed from disk in chunks
+_READ_AHEAD_MAX_FILE_SIZE = 16 * 1024 * 1024
+
+
+def zstandard_module():
+    """
+    The zstandard module, None if it's not installed: it's optional, only needed for .tar.zst archives, and
+    imported on first use.
+    """
+    try:
+        import zstandard
+        return zstandard
+    except ImportError:
+        return None
+
+
+class ArchiveFormat(enum.Enum):
+    ZIP = "zip"
+    TAR = "tar"
+    TAR_GZ = "tar.gz"
+    TAR_ZST = "tar.zst"
+
+    @staticmethod
+    def from_path(path: Path) -> 'ArchiveFormat':
+        name = path.name.lower()
+        if name.endswith(".tgz"):
+            return ArchiveFormat.TAR_GZ
+        for fmt in sorted(ArchiveFormat, key=lambda f: len(f.value), reverse=True):
+            if name.endswith("." + fmt.value):
+                return fmt
+        raise ValueError(f"Can't guess the archive format of {path.name}")
+
+
+@dataclass(frozen=True)
+class ExportReport:
+    output: str
+    files: int
+    files_failed: int
+    bytes_read: int
+    bytes_written: int
+    elapsed: timedelta
+
+    def __str__(self) -> str:
+        return f"{self.files} files ({sizeof_fmt(self.bytes_read)}) exported to {self.output} " \
+               f"({sizeof_fmt(self.bytes_written)}) in {self.elapsed}, failed: {self.files_failed}"
+
+
+@dataclass(frozen=True)
+class _Payload:
+    size: int
+    mtime: float
+    data: Optional[bytes]  # None when the file is too big to be read ahead
+
+
+class _CountingWriter:
+    """
+    Write-only stream wrapper counting bytes, for outputs which can't be stat'ed afterwards.
+    """
+    def __init__(self, raw: BinaryIO):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, b) -> int:
+        self.count += len(b)
+        return self.raw.write(b)
+
+    def flush(self):
+        self.raw.flush()
+
+
+def _read_ahead(img: ImageData) -> _Payload:
+    with open(img.path, "rb") as f:
+        stats = os.fstat(f.fileno())
+        data = f.read() if stats.st_size <= _READ_AHEAD_MAX_FILE_SIZE else None
+    return _Payload(size=stats.st_size if data is None else len(data), mtime=stats.st_mtime, data=data)
+
+
+class ArchiveExporter:
+    """
+    Streams images matching a rank filter straight from the workspace into an archive.
+
+    Images are listed from the database lazily and read ahead by a small thread pool within
+    a bounded window, so memory use does not depend on the selection size and nothing is staged on disk.
+    """
+    __repository: Repository
+    __workers: int
+
+    def __init__(self, repo: Repository, workers: int = 4):
+        assert workers > 0, "workers must be > 0"
+        self.__repository = repo
+        self.__workers = workers
+
+    def export(
+            self,
+            ws: Workspace,
+            rank_filter: RankFilter,
+            output: Path | str,
+            archive_format: Optional[ArchiveFormat] = None,
+            compression_level: Optional[int] = None,
+    ) -> ExportReport:
+        """
+        Writes the archive to `output`, which is "-" for stdout. The format is guessed from the output
+        file name if not given. Zip entries are stored as is unless compression level is set.
+        """
+        to_stdout = str(output) == "-"
+        if archive_format is None:
+            if to_stdout:
+                raise ValueError("Archive format must be set when writing to stdout")
+            archive_format = ArchiveFormat.from_path(Path(output))
+        if archive_format is ArchiveFormat.TAR_ZST and zstandard_module() is None:
+            raise ValueError("zstandard package is required for .tar.zst archives")
+
+        _log.info(f"Exporting images with rank {rank_filter} from {ws.name} to {output} ({archive_format.value})")
+        t = time.perf_counter()
+        if to_stdout:
+            out = _CountingWriter(sys.stdout.buffer)
+            files, failed, bytes_read = self._write_archive(out, ws, rank_filter, archive_format, compression_level)
+            out.flush()
+            bytes_written = out.count
+        else:
+            output = Path(output).absolute()
+            output.parent.mkdir(parents=True, exist_ok=True)
+            part_path = output.with_name(output.name + ".part")
+            try:
+                with open(part_path, "wb") as out:
+                    files, failed, bytes_read = self._write_archive(
+                        out, ws, rank_filter, archive_format, compression_level,
+                    )
+                os.replace(part_path, output)
+            except BaseException:
+                part_path.unlink(missing_ok=True)
+                raise
+            bytes_written = output.stat().st_size
+
+        report = ExportReport(
+            output=str(output),
+            files=files,
+            files_failed=failed,
+            bytes_read=bytes_read,
+            bytes_written=bytes_written,
+            elapsed=timedelta(seconds=time.perf_counter() - t),
+        )
+        _log.info(f"Export done: {report}")
+        return report
+
+    def _write_archive(
+            self,
+            out: BinaryIO,
+            ws: Workspace,
+            rank_filter: RankFilter,
+            archive_format: ArchiveFormat,
+            compression_level: Optional[int],
+    ) -> Tuple[int, int, int]:
+        files, failed, bytes_read = 0, 0, 0
+        with ExitStack() as stack:
+            if archive_format is ArchiveFormat.ZIP:
+                compression = zipfile.ZIP_STORED if compression_level is None else zipfile.ZIP_DEFLATED
+                archive = stack.enter_context(
+                    zipfile.ZipFile(out, "w", compression=compression, compresslevel=compression_level)
+                )
+                add_entry = self._add_zip_entry
+            else:
+                if archive_format is ArchiveFormat.TAR_GZ:
+                    out = stack.enter_context(gzip.GzipFile(
+                        fileobj=out, mode="wb", compresslevel=6 if compression_level is None else compression_level,
+                    ))
+                elif archive_format is ArchiveFormat.TAR_ZST:
+                    level = 3 if compression_level is None else compression_level
+                    compressor = zstandard_module().ZstdCompressor(level=level)
+                    out = stack.enter_context(compressor.stream_writer(out, closefd=False))
+                archive = stack.enter_context(tarfile.open(fileobj=out, mode="w|"))
+                add_entry = self._add_tar_entry
+
+            ws_root = Path(ws.path)
+            for img, payload in self._read_images(ws, rank_filter):
+                if payload is None:
+                    failed += 1
+                    continue
+                src = Path(img.path)
+                arcname = (src.relative_to(ws_root) if src.is_relative_to(ws_root) else Path(src.name)).as_posix()
+                if not add_entry(archive, img, arcname, payload):
+                    failed += 1
+                    continue
+                files += 1
+                bytes_read += payload.size
+        return files, failed, bytes_read
+
+    def _read_images(self, ws: Workspace, rank_filter: RankFilter) -> Iterator[Tuple[ImageData, Optional[_Payload]]]:
+        images = self.__repository.iter_images_by_rank(ws.id, rank_filter)
+        with ThreadPoolExecutor(max_workers=self.__workers, thread_name_prefix="export-read") as executor:
+            for img, future in bounded_map(executor, _read_ahead, images, window=self.__workers * 2):
+                error = future.exception()
+                if error is None:
+                    yield img, future.result()
+                elif isinstance(error, OSError):
+                    _log.warning(f"Couldn't read {img.path}, skipping: {error}")
+                    yield img, None
+                else:
+                    raise error
+
+    @staticmethod
+    def _add_zip_entry(archive: zipfile.ZipFile, img: ImageData, arcname: str, payload: _Payload) -> bool:
+        """
+        Returns False if the image file couldn't be opened, nothing is written then.
+        """
+        date_time = max(time.localtime(payload.mtime)[:6], (1980, 1, 1, 0, 0, 0))
+        info = zipfile.ZipInfo(arcname, date_time=date_time)
+        info.compress_type = archive.compression
+        info.file_size = payload.size
+        if payload.data is not None:
+            with archive.open(info, "w", force_zip64=payload.size > zipfile.ZIP64_LIMIT) as dst:
+                dst.write(payload.data)
+            return True
+        with ArchiveExporter._open_streamed(img) as src:
+            if src is None:
+                return False
+            with ArchiveExporter._streaming(img), \
+                    archive.open(info, "w", force_zip64=payload.size > zipfile.ZIP64_LIMIT) as dst:
+                while chunk := src.read(_CHUNK_SIZE):
+                    dst.write(chunk)
+        return True
+
+    @staticmethod
+    def _add_tar_entry(archive: tarfile.TarFile, img: ImageData, arcname: str, payload: _Payload) -> bool:
+        """
+        Returns False if the image file couldn't be opened, nothing is written then.
+        """
+        info = tarfile.TarInfo(arcname)
+        info.size = payload.size
+        info.mtime = payload.mtime
+        info.mode = 0o644
+        if payload.data is not None:
+            archive.addfile(info, BytesIO(payload.data))
+            return True
+        with ArchiveExporter._open_streamed(img) as src:
+            if src is None:
+                return False
+            with ArchiveExporter._streaming(img):
+                # fails if the file is truncated meanwhile, the header has the size it had when read ahead
+                archive.addfile(info, src)
+        return True
+
+    @staticmethod
+    @contextmanager
+    def _open_streamed(img: ImageData) -> Iterator[Optional[BinaryIO]]:
+        """
+        The image file too big to be read ahead, None if it can't be opened, e.g. removed meanwhile.
+        """
+        try:
+            src = open(img.path, "rb")
+        except OSError as e:
+            _log.warning(f"Couldn't read {img.path}, skipping: {e}")
+            yield None
+            return
+        with src:
+            yield src
+
+    @staticmethod
+    @contextmanager
+    def _streaming(img: ImageData) -> Iterator[None]:
+        # an entry can't be taken back once partly written, the archive can't be finished
+        try:
+            yield
+        except OSError as e:
+            raise OSError(f"Export aborted, the archive is incomplete: {img.path} failed while added: {e}") from e
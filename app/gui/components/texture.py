@@ -1,11 +1,68 @@
+import ctypes
 import dataclasses
+import enum
 import io
 import os
-from typing import Union, Tuple
+from contextlib import contextmanager
+from typing import Union, Tuple, Optional, Any, Iterator, TYPE_CHECKING
 
 import OpenGL.GL as GL
+import OpenGL.raw.GL.VERSION.GL_1_1 as RAW_GL
 import imgui
-from PIL import Image
+
+if TYPE_CHECKING:  # PIL and numpy are imported on first use, no textures are needed to show the first frame
+    import PIL.Image
+    import numpy
+
+# live textures stats, for monitoring
+_live_count: int = 0
+_live_mem_size: int = 0
+
+
+class PixelFormat(enum.Enum):
+    """
+    Layouts of 8 bits per channel pixels, uploaded as they are: (channels, internal format, format).
+    """
+    L = (1, GL.GL_R8, GL.GL_RED)  # drawn gray, see `_GRAY_SWIZZLE`
+    RGB = (3, GL.GL_RGB8, GL.GL_RGB)
+    RGBA = (4, GL.GL_RGBA8, GL.GL_RGBA)
+
+    def __init__(self, channels: int, internal_format: int, gl_format: int):
+        self.channels = channels
+        self.internal_format = internal_format
+        self.gl_format = gl_format
+
+    @staticmethod
+    def of_channels(channels: int) -> 'PixelFormat':
+        for pixel_format in PixelFormat:
+            if pixel_format.channels == channels:
+                return pixel_format
+        raise ValueError(f"No pixel format with {channels} channels")
+
+
+# the core profile has no luminance textures, the red channel is replicated instead
+_GRAY_SWIZZLE = [GL.GL_RED, GL.GL_RED, GL.GL_RED, GL.GL_ONE]
+_PIL_MODES = {"L": PixelFormat.L, "RGB": PixelFormat.RGB, "RGBA": PixelFormat.RGBA}
+# GL 4.6 core, and the EXT_texture_filter_anisotropic everyone has had before it
+_GL_TEXTURE_MAX_ANISOTROPY = 0x84FE
+_GL_MAX_TEXTURE_MAX_ANISOTROPY = 0x84FF
+_max_anisotropy: Optional[float] = None  # of the context, queried on first use
+
+
+@dataclasses.dataclass(frozen=True)
+class Sampling:
+    """
+    How a texture is sampled when drawn at a size other than its own. With mipmaps, a texture drawn smaller
+    is sampled trilinearly from the levels closest to the size drawn at, rather than skipping pixels; they take
+    a third more memory. Anisotropy above 1 sharpens textures squeezed more in one direction than the other,
+    it's capped by what the driver supports.
+    """
+    mipmaps: bool = False
+    anisotropy: float = 1.0
+
+
+LINEAR = Sampling()
+TRILINEAR = Sampling(mipmaps=True)
 
 
 @dataclasses.dataclass(frozen=True, eq=True)
@@ -14,6 +71,30 @@ class Texture:
     w: int
     h: int
     mem_size: int
+    pixel_format: PixelFormat = PixelFormat.RGB
+    sampling: Sampling = LINEAR
+
+    def __post_init__(self):
+        global _live_count, _live_mem_size
+        _live_count += 1
+        _live_mem_size += self.mem_size
+
+    def release(self):
+        global _live_count, _live_mem_size
+        GL.glDeleteTextures([self.texture_id])
+        _live_count -= 1
+        _live_mem_size -= self.mem_size
+
+    @staticmethod
+    def live_count() -> int:
+        return _live_count
+
+    @staticmethod
+    def live_mem_size() -> int:
+        """
+        Approximate video memory taken by the live textures, in bytes.
+        """
+        return _live_mem_size
 
     def render(self, w: float = None, h: float = None, keep_aspect_ratio: bool = True):
         if keep_aspect_ratio:
@@ -33,36 +114,248 @@ class Texture:
         return self.w * aspect_ratio, self.h * aspect_ratio
 
     @staticmethod
-    def create_form(source: Union[str, os.PathLike, bytes, Image]) -> 'Texture':
-        if isinstance(source, str) or isinstance(source, os.PathLike):
-            return Texture._load_from_path(str(source))
+    def create_form(
+            source: Union[str, os.PathLike, bytes, memoryview, 'PIL.Image.Image', 'numpy.ndarray'],
+            sampling: Sampling = LINEAR,
+            max_edge: Optional[int] = None,
+    ) -> 'Texture':
+        """
+        Bytes and memoryviews are encoded images, e.g. thumbnails; pixels are given as a numpy array,
+        see `from_pixels`. Images, but not arrays, longer than `max_edge` are scaled down to it before
+        the upload, keeping the aspect ratio.
+        """
+        import PIL.Image
+        import numpy
+        if isinstance(source, numpy.ndarray):
+            height, width = source.shape[:2]
+            return Texture.from_pixels(source, width, height, sampling=sampling)
+        elif isinstance(source, str) or isinstance(source, os.PathLike):
+            return Texture._load_from_path(str(source), sampling, max_edge)
         elif isinstance(source, bytes):
-            return Texture._load_from_bytes(source)
-        elif isinstance(source, Image):
-            return Texture._load_from_image(source)
+            return Texture._load_from_bytes(source, sampling, max_edge)
+        elif isinstance(source, memoryview):
+            return Texture._load_from_view(source, sampling, max_edge)
+        elif isinstance(source, PIL.Image.Image):
+            return Texture._load_from_image(source, sampling, max_edge)
         else:
-            raise ValueError("The argument is not of type str, PathLike, or bytes")
+            raise ValueError("The argument is not of type str, PathLike, bytes, memoryview, Image or ndarray")
 
     @staticmethod
-    def _load_from_path(p: str) -> 'Texture':
-        with Image.open(p) as image:
-            return Texture._load_from_image(image)
+    def _load_from_path(p: str, sampling: Sampling, max_edge: Optional[int]) -> 'Texture':
+        import PIL.Image
+        with PIL.Image.open(p) as image:
+            _draft(image, max_edge)
+            return Texture._load_from_image(image, sampling, max_edge)
 
     @staticmethod
-    def _load_from_bytes(image_data: bytes) -> 'Texture':
+    def _load_from_bytes(image_data: bytes, sampling: Sampling, max_edge: Optional[int]) -> 'Texture':
+        import PIL.Image
         with io.BytesIO(image_data) as buffer:
-            with Image.open(buffer) as image:
-                return Texture._load_from_image(image)
+            with PIL.Image.open(buffer) as image:
+                _draft(image, max_edge)
+                return Texture._load_from_image(image, sampling, max_edge)
 
     @staticmethod
-    def _load_from_image(image: Image) -> 'Texture':
-        image: Image = image.convert("RGB")
+    def _load_from_view(image_data: memoryview, sampling: Sampling, max_edge: Optional[int]) -> 'Texture':
+        import PIL.Image
+        # `BytesIO` would copy the view, e.g. a thumbnail in the mapped pack file
+        with _ViewReader(image_data) as buffer:
+            with PIL.Image.open(buffer) as image:
+                _draft(image, max_edge)
+                return Texture._load_from_image(image, sampling, max_edge)
+
+    @staticmethod
+    def _load_from_image(
+            image: 'PIL.Image.Image',
+            sampling: Sampling = LINEAR,
+            max_edge: Optional[int] = None,
+    ) -> 'Texture':
+        if max_edge is not None and max(image.size) > max_edge:
+            import PIL.Image
+            image = image.resize(_fit(image.size, max_edge), PIL.Image.Resampling.BOX)
+        pixel_format = _PIL_MODES.get(image.mode)
+        if pixel_format is None:  # e.g. palette thumbnails
+            has_alpha = "A" in image.getbands() or "transparency" in image.info
+            pixel_format = PixelFormat.RGBA if has_alpha else PixelFormat.RGB
+            image = image.convert(pixel_format.name)
         width, height = image.size
-        image_data: bytes = image.tobytes()
+        # the only copy of the pixels, Pillow doesn't expose its buffers
+        return Texture.from_pixels(image.tobytes(), width, height, pixel_format, sampling)
+
+    @staticmethod
+    def from_pixels(
+            pixels: Any,
+            width: int,
+            height: int,
+            pixel_format: Optional[PixelFormat] = None,
+            sampling: Sampling = LINEAR,
+    ) -> 'Texture':
+        """
+        Uploads pixels without copying them: a numpy array of `uint8` of (height, width) or (height, width,
+        channels) shape, rows may be padded, e.g. a crop of a bigger array; or any other object supporting
+        the buffer protocol, with rows packed one after another. The format is told by the channels of an
+        array and is RGBA for other objects, unless given.
+        """
+        array = _pixel_array(pixels, width, height, pixel_format)
+        pixel_format = PixelFormat.of_channels(array.shape[2])
         texture_id = GL.glGenTextures(1)
         GL.glBindTexture(GL.GL_TEXTURE_2D, texture_id)
-        GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, image_data)
-        GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+        with _unpacking(array):
+            RAW_GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, pixel_format.internal_format, width, height, 0,
+                                pixel_format.gl_format, GL.GL_UNSIGNED_BYTE, _data(array))
+        mem_size = width * height * pixel_format.channels
+        if sampling.mipmaps:
+            GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR_MIPMAP_LINEAR)
+            mem_size = mem_size * 4 // 3
+        else:
+            GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
         GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+        anisotropy = min(sampling.anisotropy, _get_max_anisotropy())
+        if anisotropy > 1.0:
+            GL.glTexParameterf(GL.GL_TEXTURE_2D, _GL_TEXTURE_MAX_ANISOTROPY, anisotropy)
+        if pixel_format is PixelFormat.L:
+            GL.glTexParameteriv(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_SWIZZLE_RGBA, _GRAY_SWIZZLE)
         GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
-        return Texture(texture_id=texture_id, w=width, h=height, mem_size=len(image_data))
+        return Texture(texture_id=texture_id, w=width, h=height, mem_size=mem_size, pixel_format=pixel_format,
+                       sampling=sampling)
+
+    def update(self, pixels: Any, x: int = 0, y: int = 0, width: Optional[int] = None, height: Optional[int] = None):
+        """
+        Replaces a rectangle of the texture in place, the pixels are given as to `from_pixels`, in the format
+        of the texture. The rectangle is as big as an array, or reaches to the edges of the texture by default.
+        """
+        shape = getattr(pixels, "shape", (self.h - y, self.w - x))
+        width = shape[1] if width is None else width
+        height = shape[0] if height is None else height
+        if x < 0 or y < 0 or x + width > self.w or y + height > self.h:
+            raise ValueError(f"Rectangle {width}x{height} at ({x}, {y}) is out of the {self.w}x{self.h} texture")
+        array = _pixel_array(pixels, width, height, self.pixel_format)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, self.texture_id)
+        with _unpacking(array):
+            RAW_GL.glTexSubImage2D(GL.GL_TEXTURE_2D, 0, x, y, width, height, self.pixel_format.gl_format,
+                                   GL.GL_UNSIGNED_BYTE, _data(array))
+        if self.sampling.mipmaps:
+            GL.glGenerateMipmap(GL.GL_TEXTURE_2D)
+        GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+
+
+def _draft(image: 'PIL.Image.Image', max_edge: Optional[int]):
+    # JPEGs are decoded at the smallest scale at least `max_edge` long, other formats ignore it
+    if max_edge is not None:
+        image.draft(None, (max_edge, max_edge))
+
+
+def _fit(size: Tuple[int, int], max_edge: int) -> Tuple[int, int]:
+    width, height = size
+    scale = max_edge / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _get_max_anisotropy() -> float:
+    global _max_anisotropy
+    if _max_anisotropy is None:
+        try:
+            _max_anisotropy = float(GL.glGetFloatv(_GL_MAX_TEXTURE_MAX_ANISOTROPY))
+        except GL.error.GLError:  # neither GL 4.6 nor the extension
+            _max_anisotropy = 1.0
+    return _max_anisotropy
+
+
+def _pixel_array(pixels: Any, width: int, height: int, pixel_format: Optional[PixelFormat]) -> 'numpy.ndarray':
+    """
+    The pixels as an array of (height, width, channels), a view of them unless their layout can't be read by GL.
+    """
+    import numpy
+    if not isinstance(pixels, numpy.ndarray):
+        channels = (pixel_format or PixelFormat.RGBA).channels
+        pixels = numpy.frombuffer(pixels, dtype=numpy.uint8)
+        if len(pixels) != width * height * channels:
+            raise ValueError(f"{len(pixels)} bytes are not {width}x{height} pixels of {channels} channels")
+        return pixels.reshape((height, width, channels))
+    if pixels.dtype != numpy.uint8:
+        raise ValueError(f"Pixels must be uint8, not {pixels.dtype}")
+    if pixels.ndim == 2:
+        pixels = pixels[:, :, numpy.newaxis]
+    if pixels.ndim != 3 or pixels.shape[:2] != (height, width):
+        raise ValueError(f"Pixels of {pixels.shape} shape are not {width}x{height}")
+    if pixel_format is not None and pixels.shape[2] != pixel_format.channels:
+        raise ValueError(f"Pixels of {pixels.shape[2]} channels are not {pixel_format.name}")
+    channels = pixels.shape[2]
+    row_stride, pixel_stride, channel_stride = pixels.strides
+    if channel_stride != 1 or pixel_stride != channels or row_stride < width * channels or row_stride % channels:
+        pixels = numpy.ascontiguousarray(pixels)  # can't be described to GL as rows of packed pixels
+    return pixels
+
+
+def _unpack_alignment(row_stride: int) -> int:
+    """
+    The largest alignment GL accepts that the rows are at, rows of 3 channels don't always start at 4 bytes.
+    """
+    for alignment in (8, 4, 2):
+        if row_stride % alignment == 0:
+            return alignment
+    return 1
+
+
+@contextmanager
+def _unpacking(array: 'numpy.ndarray') -> Iterator[None]:
+    """
+    Sets up unpacking of the pixels of the array for an upload, restoring the defaults afterwards.
+    """
+    height, width, channels = array.shape
+    row_stride = array.strides[0]
+    padded = row_stride != width * channels
+    GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, _unpack_alignment(row_stride))
+    if padded:  # rows of a bigger array, otherwise drivers take their fast paths for packed rows
+        GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, row_stride // channels)
+    try:
+        yield
+    finally:
+        GL.glPixelStorei(GL.GL_UNPACK_ALIGNMENT, 4)
+        if padded:
+            GL.glPixelStorei(GL.GL_UNPACK_ROW_LENGTH, 0)
+
+
+def _data(array: 'numpy.ndarray') -> ctypes.c_void_p:
+    # a pointer to the raw functions: the wrapped ones would copy an array with padded rows to a contiguous one,
+    # and reset the pack state on every call
+    return ctypes.c_void_p(array.ctypes.data)
+
+
+class _ViewReader(io.RawIOBase):
+    """
+    Seekable read-only file over a memoryview, reads copy only the chunks requested.
+    """
+    __view: memoryview
+    __position: int = 0
+
+    def __init__(self, view: memoryview):
+        super().__init__()
+        self.__view = view.cast("B")
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.__position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.__position, io.SEEK_END: len(self.__view)}[whence]
+        self.__position = max(0, base + offset)
+        return self.__position
+
+    def read(self, size: int = -1) -> bytes:
+        end = len(self.__view) if size is None or size < 0 else min(len(self.__view), self.__position + size)
+        chunk = self.__view[self.__position:end].tobytes()
+        self.__position = max(self.__position, end)
+        return chunk
+
+    def readinto(self, buffer) -> int:
+        chunk = self.__view[self.__position:self.__position + len(buffer)]
+        buffer[:len(chunk)] = chunk
+        self.__position += len(chunk)
+        return len(chunk)
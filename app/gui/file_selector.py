@@ -1,21 +1,51 @@
 import logging
 import os
 import platform
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import List, Dict, Callable
+from typing import List, Dict, Callable, Optional, Tuple
 
 import imgui
 
 _log = logging.getLogger(__name__)
 _TREE_FLAGS = imgui.TREE_NODE_OPEN_ON_ARROW | imgui.TREE_NODE_OPEN_ON_DOUBLE_CLICK
+# how often a shown directory is checked for changes, by its modification time
+_REVALIDATE_INTERVAL = 2.0  # seconds
+# listings of directories not shown for this long are dropped before they start, e.g. of a collapsed node
+_STALE_AFTER = 1.0  # seconds
+
+
+@dataclass(frozen=True)
+class _Entry:
+    path: Path
+    name: str
+    is_dir: bool  # of the `DirEntry`, so rendering never stats
+
+
+@dataclass(frozen=True)
+class _Listing:
+    entries: List[_Entry]  # directories first, then by name case-insensitive
+    mtime_ns: Optional[int]  # of the directory when listed, None if it couldn't be listed
+    checked_at: float  # monotonic
 
 
 class FileSelector:
+    """
+    Tree of the file system. Directories are listed on a background thread, a directory being listed for the
+    first time shows a placeholder, the ones already listed are shown as they were until they are listed again
+    after a change, so a slow mount doesn't freeze the window.
+    """
     _root: Path
     _roots: List[Path] = []
-    _cache: Dict[Path, Dict] = {}
+    _listings: Dict[Path, _Listing]
+    _pending: Dict[Path, Future]  # listings in progress, by directory
+    _shown_at: Dict[Path, float]  # monotonic, by directory
     _initial_selection: Path
-    filter_predicate: Callable[[Path], bool]
+    filter_predicate: Callable[[os.DirEntry], bool]
     selection: Path
     selection_updated: bool
 
@@ -23,7 +53,7 @@ class FileSelector:
             self,
             root: Path = Path(os.path.sep),
             selected: Path = Path.home().absolute(),
-            filter_predicate: Callable[[Path], bool] = lambda _: True,
+            filter_predicate: Callable[[os.DirEntry], bool] = lambda _: True,
     ):
         self._root = root
         self._refresh_roots()
@@ -31,7 +61,9 @@ class FileSelector:
         self.selection = selected
         self._initial_selection = selected
         self.selection_updated = True
-        self._cache = {}
+        self._listings = {}
+        self._pending = {}
+        self._shown_at = {}
 
     def _refresh_roots(self):
         if platform.system() == "Windows":
@@ -44,46 +76,126 @@ class FileSelector:
         self.selection_updated = False
         for root in self._roots:
             if imgui.tree_node(str(root), _TREE_FLAGS | imgui.TREE_NODE_DEFAULT_OPEN):
-                if root not in self._cache:
-                    self._cache[root] = self._fill_entries(root)
-                self._render_tree(root, self._cache[root])
+                self._render_tree(root)
                 imgui.tree_pop()
 
-    def _render_tree(self, current_path: Path, items: Dict[Path, dict]):
-        for k, v in items.items():
-            this_path_level = current_path.joinpath(k)
+    def _render_tree(self, directory: Path):
+        entries = self._entries(directory)
+        if entries is None:
+            imgui.text_disabled("loading...")
+            return
+        for entry in entries:
             tree_node_flags = _TREE_FLAGS
-            if self.selection == k.absolute():
+            if self.selection == entry.path:
                 tree_node_flags |= imgui.TREE_NODE_SELECTED
-            if self._initial_selection.is_relative_to(this_path_level):
+            if self._initial_selection.is_relative_to(entry.path):
                 tree_node_flags |= imgui.TREE_NODE_DEFAULT_OPEN
-            if k.is_dir():
-                node = imgui.tree_node(k.name, tree_node_flags)
-                node_clicked = imgui.is_item_clicked()
-                if node:
-                    if v is None:
-                        entries = self._fill_entries(this_path_level)
-                        items[k] = entries
-                        self._render_tree(this_path_level, entries)
-                    else:
-                        self._render_tree(this_path_level, v)
-                    imgui.tree_pop()
-            else:
-                node = imgui.tree_node(k.name, tree_node_flags)
-                node_clicked = imgui.is_item_clicked()
-                if node:
-                    imgui.tree_pop()
+            node = imgui.tree_node(entry.name, tree_node_flags)
+            node_clicked = imgui.is_item_clicked()
+            if node:
+                if entry.is_dir:
+                    self._render_tree(entry.path)
+                imgui.tree_pop()
             if node_clicked:
-                _log.debug(f"Selection change: {self.selection} -> {k.absolute()}")
-                self.selection = k.absolute()
+                _log.debug(f"Selection change: {self.selection} -> {entry.path}")
+                self.selection = entry.path
                 self.selection_updated = True
 
-    def _fill_entries(self, scan_path: Path) -> Dict[Path, Dict]:
+    def _entries(self, directory: Path) -> Optional[List[_Entry]]:
+        """
+        Entries of the directory as last listed, None if it's being listed for the first time. Lists it again
+        in the background if it may have changed.
+        """
+        now = self._shown_at[directory] = time.monotonic()
+        future = self._pending.get(directory)
+        if future is not None and future.done():
+            del self._pending[directory]
+            if not future.cancelled():  # dropped as stale otherwise, listed again below
+                self._store_listing(directory, future)
+        listing = self._listings.get(directory)
+        if directory not in self._pending and (listing is None or now - listing.checked_at >= _REVALIDATE_INTERVAL):
+            mtime_ns = listing.mtime_ns if listing is not None else None
+            self._pending[directory] = _in_background(
+                lambda: time.monotonic() - self._shown_at[directory] < _STALE_AFTER,
+                _list_directory, directory, self.filter_predicate, mtime_ns,
+            )
+        return listing.entries if listing is not None else None
+
+    def _store_listing(self, directory: Path, future: Future):
+        previous = self._listings.get(directory)
+        try:
+            listing = future.result()
+        except Exception as e:  # a bug rather than the file system, `_list_directory` handles its errors
+            _log.error(f"Listing {directory} failed", exc_info=e)
+            listing = _Listing(previous.entries if previous is not None else [], None, time.monotonic())
+        if listing is None:  # unchanged
+            listing = replace(previous, checked_at=time.monotonic())
+        self._listings[directory] = listing
+
+
+def _list_directory(
+        directory: Path,
+        filter_predicate: Callable[[os.DirEntry], bool],
+        mtime_ns: Optional[int] = None,
+) -> Optional[_Listing]:
+    """
+    Lists the directory, None if it's still of the given modification time.
+    """
+    try:
+        current_mtime_ns = os.stat(directory).st_mtime_ns
+        if current_mtime_ns == mtime_ns:
+            return None
+        entries = []
+        with os.scandir(directory) as it:
+            for e in it:
+                try:
+                    if filter_predicate(e):
+                        entries.append(_Entry(Path(e.path), e.name, e.is_dir()))
+                except OSError as error:  # e.g. gone meanwhile
+                    _log.debug(f"Can't read {e.path}: {error} - skipping")
+    except PermissionError:
+        _log.debug(f"No permission to traverse {directory}")
+        return _Listing([], None, time.monotonic())
+    except OSError as e:
+        _log.debug(f"Can't list {directory}: {e}")
+        return _Listing([], None, time.monotonic())
+    # sort dirs first, then names case-insensitive
+    entries.sort(key=lambda entry: (not entry.is_dir, entry.name.lower()))
+    return _Listing(entries, current_mtime_ns, time.monotonic())
+
+
+# listings waiting for the worker: the future, whether it's still wanted, the function and its arguments
+_requests: 'queue.SimpleQueue[Tuple[Future, Callable[[], bool], Callable, tuple]]' = queue.SimpleQueue()
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+
+def _in_background(wanted: Callable[[], bool], fn: Callable, *args) -> Future:
+    """
+    Runs the function on the listing worker, after the ones requested before, unless it's not `wanted` by then.
+    """
+    global _worker
+    # a daemon thread rather than an executor, whose threads are joined on exit: a hung mount must not keep
+    # the application from quitting; one for all the listings, a hung mount holds up the others, not piles up
+    # threads
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_work, name="file-selector-listing", daemon=True)
+            _worker.start()
+    future = Future()
+    _requests.put((future, wanted, fn, args))
+    return future
+
+
+def _work():
+    while True:
+        future, wanted, fn, args = _requests.get()
+        if not wanted():
+            future.cancel()
+            continue
+        if not future.set_running_or_notify_cancel():
+            continue
         try:
-            paths = [Path(e.path) for e in os.scandir(scan_path) if self.filter_predicate(Path(e.path))]
-            # sort dirs first, then names case-insensitive
-            paths = sorted(paths, key=lambda p: (not p.is_dir(), p.name.lower()))
-            return {p: None for p in paths}
-        except PermissionError:
-            _log.debug(f"No permission to traverse {scan_path}")
-            return {}
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
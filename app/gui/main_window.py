@@ -1,7 +1,7 @@
 import logging
 import sys
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Callable
 
 import OpenGL.GL as GL
 import glfw
@@ -10,10 +10,13 @@ from imgui.integrations.glfw import GlfwRenderer
 
 from app.gui.image_view_window import ImageViewWindow
 from app.gui.navigator_window import NavigatorWindow
+from app.gui.perf_overlay import PerfOverlay
 from app.gui.workspace_selector import WorkspaceSelector
+from app.perf import PerfMonitor, GAUGE_BACKGROUND_JOBS, GAUGE_DECODE_QUEUE
 from app.pic_review import PicReview
 
 _log = logging.getLogger(__name__)
+_SLOW_QUERY_THRESHOLD = 0.05  # seconds
 
 
 class MainWindow:
@@ -28,15 +31,22 @@ class MainWindow:
     __show_demo: bool = False
     __show_style_editor: bool = False
     __show_metrics: bool = False
+    __show_perf_overlay: bool = False
 
     __workspace_selector: WorkspaceSelector
     __navigator_window: NavigatorWindow
     __image_view_window: ImageViewWindow
+    __perf: PerfMonitor
+    __perf_overlay: PerfOverlay
 
     def __init__(self, window_title: str, backend: PicReview, imgui_ini_file_location: Path = Path("imgui.ini")):
         self.__window_title = window_title
         self.__imgui_ini_file_location = str(imgui_ini_file_location.absolute())
         self._backend = backend
+        self.__perf = PerfMonitor()
+        self.__perf.register_counter("db queries", backend.get_db_statements_executed)
+        self.__perf.register_counter("db ms", lambda: backend.get_db_time_total() * 1000)
+        self.__perf.register_gauge(GAUGE_BACKGROUND_JOBS, backend.get_background_jobs)
 
     def update_title(self, title: Optional[str] = None, postfix: Optional[str] = None):
         if title is not None:
@@ -45,7 +55,7 @@ class MainWindow:
             self.__window_title_postfix = postfix
         glfw.set_window_title(self.__window, self.__window_title + self.__window_title_postfix)
 
-    def show(self):
+    def show(self, on_first_frame: Optional[Callable[[], None]] = None):
         if self.__started:
             _log.warning("Window has been shown already")
             return
@@ -60,13 +70,23 @@ class MainWindow:
         self.__workspace_selector = WorkspaceSelector(self._backend)
         self.__navigator_window = NavigatorWindow(self._backend)
         self.__image_view_window = ImageViewWindow(self._backend)
+        self.__perf_overlay = PerfOverlay(self.__perf, self._backend)
+        # thumbnails still to be decoded: by the refresh, and into textures by the navigator
+        self.__perf.register_gauge(
+            GAUGE_DECODE_QUEUE,
+            lambda: self._backend.get_thumbnails_pending() + self.__navigator_window.pending_textures,
+        )
         _log.debug("GUI init done")
         self.__started = True
 
         _log.info("Starting GUI")
         while not glfw.window_should_close(self.__window):
-            glfw.poll_events()
-            window_renderer.process_inputs()
+            self.__perf.begin_frame()
+            with self.__perf.section("events"):
+                glfw.poll_events()
+                window_renderer.process_inputs()
+                if MainWindow.__has_input(io):
+                    self._backend.touch()
 
             imgui.new_frame()
 
@@ -79,16 +99,23 @@ class MainWindow:
                 imgui.show_style_editor()
             if self.__show_metrics:
                 imgui.show_metrics_window()
-
-            GL.glClearColor(0.11, 0.11, 0.09, 1)
-            GL.glClear(GL.GL_COLOR_BUFFER_BIT)
-
-            imgui.render()
-            try:
-                window_renderer.render(imgui.get_draw_data())
-            except GL.error.GLError as e:
-                _log.error(e)
-            glfw.swap_buffers(self.__window)
+            if self.__show_perf_overlay:
+                self.__perf_overlay.render()
+
+            with self.__perf.section("gl render"):
+                GL.glClearColor(0.11, 0.11, 0.09, 1)
+                GL.glClear(GL.GL_COLOR_BUFFER_BIT)
+
+                imgui.render()
+                try:
+                    window_renderer.render(imgui.get_draw_data())
+                except GL.error.GLError as e:
+                    _log.error(e)
+            with self.__perf.section("swap"):
+                glfw.swap_buffers(self.__window)
+            if on_first_frame is not None:
+                on_first_frame()
+                on_first_frame = None
 
         window_renderer.shutdown()
         glfw.terminate()
@@ -107,6 +134,7 @@ class MainWindow:
                 clicked_demo, _ = imgui.menu_item("imgui demo", None, self.__show_demo)
                 clicked_style_editor, _ = imgui.menu_item("style editor", None, self.__show_style_editor)
                 clicked_metrics, _ = imgui.menu_item("imgui metrics", None, self.__show_metrics)
+                clicked_perf_overlay, _ = imgui.menu_item("performance overlay", None, self.__show_perf_overlay)
 
                 if clicked_demo:
                     self.__show_demo = not self.__show_demo
@@ -117,21 +145,36 @@ class MainWindow:
                 if clicked_metrics:
                     self.__show_metrics = not self.__show_metrics
 
+                if clicked_perf_overlay:
+                    self.__show_perf_overlay = not self.__show_perf_overlay
+                    if self.__show_perf_overlay:
+                        self._backend.enable_db_instrumentation(slow_query_threshold=_SLOW_QUERY_THRESHOLD)
+                    else:
+                        self._backend.disable_db_instrumentation()
+
                 imgui.end_menu()
 
             imgui.end_main_menu_bar()
 
     def __draw_windows(self):
         if self._backend.get_workspace_dir() is None:
-            self.__workspace_selector.render()
+            with self.__perf.section("ws selector"):
+                self.__workspace_selector.render()
             ws_path = self._backend.get_workspace_dir()
             if ws_path is not None:
                 window_postfix = f" :: {ws_path}" if ws_path is not None else ""
                 if window_postfix != self.__window_title_postfix:
                     self.update_title(postfix=window_postfix)
         else:
-            self.__navigator_window.render()
-            self.__image_view_window.render()
+            with self.__perf.section("navigator"):
+                self.__navigator_window.render()
+            with self.__perf.section("image view"):
+                self.__image_view_window.render()
+
+    @staticmethod
+    def __has_input(io) -> bool:
+        return bool(io.mouse_delta.x or io.mouse_delta.y or io.mouse_wheel or io.mouse_wheel_horizontal
+                    or any(io.mouse_down) or any(io.keys_down))
 
     @staticmethod
     def __glfw_init_window(window_title: str):
@@ -1,55 +1,194 @@
-from typing import Optional, List
+import bisect
+import time
+from dataclasses import replace
+from typing import Optional, List, Dict, Tuple
 
 import imgui
 from imgui.core import _DrawList
 
-from app.gui.components.texture import Texture
+from app.gui.components.texture import Texture, TRILINEAR
+from app.model.image_data import ImageData
+from app.model.workspace_change import WorkspaceChange
 from app.pic_review import PicReview
 
+# textures are kept for this many screens of thumbnails around the visible ones, so scrolling back is instant
+_TEXTURE_CACHE_SCREENS = 2
+_POSITION_SAVE_INTERVAL = 1.0  # seconds
+# time a frame may spend making textures, the ones nearest to the current image first, the rest wait a frame
+_TEXTURE_LOAD_BUDGET = 0.008  # seconds
+_MIN_THUMB_SIZE = 32.0
+_MAX_THUMB_SIZE = 256.0
+
 
 class NavigatorWindow:
     _backend: PicReview
-    _thumbs: Optional[List[Texture]] = None
+    _workspace_id: Optional[int] = None
+    # metadata of all the workspace images ordered by path, thumbnails are loaded for the visible ones only
+    _images: List[ImageData]
+    _paths: List[str]
+    _textures: Dict[str, Optional[Texture]]  # None - the image has no thumbnail
+    _rank_histogram: Dict[int, int]
     _thumb_size: float = 100.0
     _current_image: Optional[int] = None
+    _saved_image_path: Optional[str] = None
+    _saved_at: float = 0.0
+    _thumbnail_focus: Optional[Tuple[str, str, str]] = None  # reported to the backend, see `_focus_thumbnails`
+    pending_textures: int = 0  # visible thumbnails left for the next frames by the texture load budget
 
     def __init__(self, backend: PicReview) -> None:
         self._backend = backend
+        self._images = []
+        self._paths = []
+        self._textures = {}
+        self._rank_histogram = {}
 
     def render(self):
         ws = self._backend.get_current_workspace()
         if ws is None:
             return
 
-        if not self._thumbs:
-            images = self._backend.get_current_workspace_images()
-            if images:
-                self._thumbs = [Texture.create_form(i.with_populated_thumbnail().thumbnail) for i in images]
-                self._current_image = 0
+        if ws.id != self._workspace_id:
+            self._load_workspace(ws.id)
+        else:
+            self._apply_changes(self._backend.poll_workspace_changes())
 
         with imgui.begin("Navigator", closable=False):
             dl: _DrawList = imgui.get_window_draw_list()
-            imgui.text(f"Navigator: {self._backend.get_current_workspace_images_rank_histogram()}")
-            if self._thumbs is not None:
-                total_images = len(self._thumbs)
+            refreshing = " (refreshing...)" if self._backend.is_reconciling() else ""
+            imgui.text(f"Navigator: {self._rank_histogram}{refreshing}")
+            self._draw_thumb_size_slider()
+            if self._images:
+                total_images = len(self._images)
 
                 spacing = 3.0
                 thumb_and_spacing_w = spacing + self._thumb_size
                 images_to_display = int(imgui.get_content_region_available_width() / thumb_and_spacing_w)
                 visible_range = self._find_visible_range(total_images, images_to_display)
                 imgui.text(str(visible_range))
-
-                for i, tx in enumerate(self._thumbs[visible_range.start:visible_range.stop]):
-                    i and imgui.same_line(spacing=spacing)
-                    if i + visible_range.start == self._current_image:
-                        cur = imgui.get_cursor_screen_pos()
+                self._focus_thumbnails(visible_range)
+                self._update_textures(visible_range, images_to_display)
+
+                for i in visible_range:
+                    i != visible_range.start and imgui.same_line(spacing=spacing)
+                    tx = self._textures.get(self._paths[i])
+                    cur = imgui.get_cursor_screen_pos()
+                    if tx is not None:
                         tx.render(w=self._thumb_size, h=self._thumb_size, keep_aspect_ratio=True)
-                        self._highlight_texture(dl, cur.x, cur.y)
                     else:
-                        tx.render(w=self._thumb_size, h=self._thumb_size, keep_aspect_ratio=True)
+                        imgui.dummy(self._thumb_size, self._thumb_size)
+                    if i == self._current_image:
+                        self._highlight_texture(dl, cur.x, cur.y)
                     # todo: render image rank - number, and also higher is rank is above current
                     # rank range, middle if within current range filter, and lower if rank is below the range filter
                 self._draw_current_image_slider(total_images)
+        self._save_position()
+
+    def _load_workspace(self, ws_id: int):
+        """
+        Shows what the DB knows about the workspace right away, the background refresh brings the rest.
+        """
+        self._release_textures(list(self._textures))
+        self._workspace_id = ws_id
+        self._images = self._backend.get_current_workspace_image_index() or []
+        self._paths = [i.path for i in self._images]
+        self._rank_histogram = self._backend.get_current_workspace_images_rank_histogram() or {}
+        self._saved_image_path = self._backend.get_current_image_path()
+        self._current_image = None
+        if self._images:
+            position = bisect.bisect_left(self._paths, self._saved_image_path) if self._saved_image_path else 0
+            self._current_image = min(position, len(self._images) - 1)
+
+    def _apply_changes(self, changes: List[WorkspaceChange]):
+        if not changes:
+            return
+        if any(change.reload for change in changes):
+            self._load_workspace(self._workspace_id)
+            return
+        current_path = self._paths[self._current_image] if self._current_image is not None else None
+        for change in changes:
+            for img in change.updated:
+                i = bisect.bisect_left(self._paths, img.path)
+                img = replace(img, thumbnail=None)
+                if i < len(self._paths) and self._paths[i] == img.path:
+                    if self._images[i] != img:  # the same change may come twice, see `poll_workspace_changes`
+                        self._images[i] = img
+                        self._release_textures([img.path])  # outdated thumbnail
+                else:
+                    self._images.insert(i, img)
+                    self._paths.insert(i, img.path)
+            self._release_textures(change.thumbnails)  # previews made in the background
+            for path in change.removed:
+                i = bisect.bisect_left(self._paths, path)
+                if i < len(self._paths) and self._paths[i] == path:
+                    del self._images[i]
+                    del self._paths[i]
+                    self._release_textures([path])
+        # stay on the same image, or the one next to it if it was removed
+        if self._images:
+            position = bisect.bisect_left(self._paths, current_path) if current_path is not None else 0
+            self._current_image = min(position, len(self._images) - 1)
+        else:
+            self._current_image = None
+        self._rank_histogram = self._backend.get_current_workspace_images_rank_histogram() or {}
+
+    def _update_textures(self, visible_range: range, images_per_screen: int):
+        margin = _TEXTURE_CACHE_SCREENS * max(1, images_per_screen)
+        keep = set(self._paths[max(0, visible_range.start - margin):visible_range.stop + margin])
+        self._release_textures([p for p in self._textures if p not in keep])
+
+        # after a jump the ones of the previous position aren't in the range any more, they're never loaded
+        missing = [i for i in visible_range if self._paths[i] not in self._textures]
+        self.pending_textures = 0
+        if missing:
+            missing.sort(key=lambda i: abs(i - self._current_image))
+            # previews where there are, so bigger thumbnails aren't blurry, mipmaps are there for smaller ones
+            thumbnails = self._backend.get_thumbnails([self._paths[i] for i in missing], previews=True)
+            deadline = time.perf_counter() + _TEXTURE_LOAD_BUDGET
+            self.pending_textures = len(missing)
+            for i in missing:
+                path = self._paths[i]
+                thumbnail = thumbnails.get(path)
+                self._textures[path] = \
+                    Texture.create_form(thumbnail, TRILINEAR, self._max_texture_edge()) if thumbnail else None
+                self.pending_textures -= 1
+                if time.perf_counter() >= deadline:
+                    break
+
+    def _focus_thumbnails(self, visible_range: range):
+        if not visible_range:
+            return
+        focus = (self._paths[self._current_image], self._paths[visible_range.start], self._paths[visible_range[-1]])
+        if focus != self._thumbnail_focus:
+            self._thumbnail_focus = focus
+            self._backend.focus_thumbnails(*focus)
+
+    @staticmethod
+    def _max_texture_edge() -> int:
+        """
+        Textures are uploaded once, big enough for the largest thumbnails on this display, and drawn smaller
+        from their mipmaps, so resizing the thumbnails doesn't decode them again.
+        """
+        scale = max(imgui.get_io().display_framebuffer_scale)
+        return upload_edge(_MAX_THUMB_SIZE * max(1.0, scale))
+
+    def _release_textures(self, paths: List[str]):
+        for path in paths:
+            tx = self._textures.pop(path, None)
+            if tx is not None:
+                tx.release()
+
+    def _save_position(self):
+        """
+        Remembers the current image, so the workspace is reopened at it. Written at most once per interval.
+        """
+        if self._current_image is None:
+            return
+        path = self._paths[self._current_image]
+        now = time.monotonic()
+        if path != self._saved_image_path and now - self._saved_at >= _POSITION_SAVE_INTERVAL:
+            self._backend.set_current_image_path(path)
+            self._saved_image_path = path
+            self._saved_at = now
 
     def _find_visible_range(self, range_size: int, subrange_size: int) -> range:
         # Ensure subrange_size is not greater than range_size
@@ -69,6 +208,17 @@ class NavigatorWindow:
 
         return range(start, end)
 
+    def _draw_thumb_size_slider(self):
+        imgui.push_item_width(200.0)
+        _changed, self._thumb_size = imgui.slider_float(
+            label="Thumbnail size",
+            value=self._thumb_size,
+            min_value=_MIN_THUMB_SIZE,
+            max_value=_MAX_THUMB_SIZE,
+            format="%.0f px",
+        )
+        imgui.pop_item_width()
+
     def _draw_current_image_slider(self, total_images: int):
         imgui.push_item_width(-1.0)
         _changed, self._current_image = imgui.slider_int(
@@ -83,3 +233,13 @@ class NavigatorWindow:
     def _highlight_texture(self, dl: _DrawList, x: float, y: float):
         highlight_color = imgui.get_color_u32_rgba(1, 1, 0, 1)
         dl.add_rect(x - 2, y - 2, x + self._thumb_size + 2, y + self._thumb_size + 2, highlight_color)
+
+
+def upload_edge(max_size: float) -> int:
+    """
+    The power of two at least `max_size` pixels, mipmaps of it halve down to every smaller size.
+    """
+    edge = 1
+    while edge < max_size:
+        edge *= 2
+    return edge
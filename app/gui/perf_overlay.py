@@ -0,0 +1,84 @@
+import time
+from array import array
+from typing import Optional
+
+import imgui
+
+from app.gui.components.texture import Texture
+from app.db_stats import QueryStatsSnapshot
+from app.perf import PerfMonitor
+from app.pic_review import PicReview
+from app.utils import sizeof_fmt
+
+_OVERLAY_FLAGS = imgui.WINDOW_NO_DECORATION | imgui.WINDOW_ALWAYS_AUTO_RESIZE | imgui.WINDOW_NO_FOCUS_ON_APPEARING \
+                 | imgui.WINDOW_NO_NAV | imgui.WINDOW_NO_SAVED_SETTINGS
+_PAD = 10.0
+_TOP_STATEMENTS = 5
+_DB_STATS_REFRESH_INTERVAL = 0.5  # seconds, the snapshot is too expensive to take every frame
+
+
+class PerfOverlay:
+    _perf: PerfMonitor
+    _backend: PicReview
+    _db_stats: Optional[QueryStatsSnapshot] = None
+    _db_stats_taken_at: float = 0.0
+
+    def __init__(self, perf: PerfMonitor, backend: PicReview) -> None:
+        self._perf = perf
+        self._backend = backend
+
+    def render(self):
+        w, _h = imgui.get_io().display_size
+        imgui.set_next_window_position(w - _PAD, imgui.get_frame_height() + _PAD, imgui.ALWAYS, 1.0, 0.0)
+        imgui.set_next_window_bg_alpha(0.75)
+        expanded, _opened = imgui.begin("Performance", False, _OVERLAY_FLAGS)
+        if expanded:
+            self._render_frame_times()
+            imgui.separator()
+            self._render_sections()
+            imgui.separator()
+            self._render_counters_and_gauges()
+            self._render_db_stats()
+        imgui.end()
+
+    def _render_frame_times(self):
+        percentiles = self._perf.frame_time_percentiles()
+        imgui.text("Frame time, ms: " + "  ".join(
+            f"{'max' if p == 100 else f'p{p}'} {v * 1000:.1f}" for p, v in percentiles.items()
+        ))
+        frame_times = self._perf.frame_times
+        if frame_times:
+            imgui.plot_lines(
+                "##frame times",
+                array('f', (t * 1000 for t in frame_times)),
+                scale_min=0.0,
+                scale_max=max(33.3, percentiles[100] * 1000),
+                graph_size=(320, 48),
+            )
+
+    def _render_sections(self):
+        imgui.text("Section        last ms   avg ms   max ms")
+        for name, t in self._perf.section_times().items():
+            imgui.text(f"{name:<13} {t['last'] * 1000:8.2f} {t['avg'] * 1000:8.2f} {t['max'] * 1000:8.2f}")
+
+    def _render_counters_and_gauges(self):
+        imgui.text("Per frame      last      avg      max")
+        for name, d in self._perf.counter_deltas().items():
+            imgui.text(f"{name:<13} {d['last']:8.0f} {d['avg']:8.1f} {d['max']:8.0f}")
+        imgui.separator()
+        imgui.text(f"textures: {Texture.live_count()} ({sizeof_fmt(Texture.live_mem_size())} VRAM)")
+        for name, value in self._perf.gauges().items():
+            imgui.text(f"{name}: {'n/a' if value is None else value}")
+
+    def _render_db_stats(self):
+        if time.perf_counter() - self._db_stats_taken_at > _DB_STATS_REFRESH_INTERVAL:
+            self._db_stats = self._backend.get_db_stats()
+            self._db_stats_taken_at = time.perf_counter()
+        stats = self._db_stats
+        if stats is None:
+            return
+        imgui.separator()
+        imgui.text(f"DB total: {stats.query_count} queries, {stats.total_time * 1000:.0f} ms, "
+                   f"{stats.commits} commits ({stats.commit_time * 1000:.0f} ms), slow: {stats.slow_queries}")
+        for s in stats.statements[:_TOP_STATEMENTS]:
+            imgui.text(f"{s.total_time * 1000:7.0f} ms x{s.count:<6} p95 {s.p95_time * 1000:6.2f} ms  {s.sql[:60]}")
@@ -20,7 +20,7 @@ class WorkspaceSelector:
     _input_path: str = ""
     _input_name: str = ""
     _show_create_dialog: bool = False
-    _file_selector: FileSelector = FileSelector(filter_predicate=lambda path: path.is_dir())
+    _file_selector: FileSelector = FileSelector(filter_predicate=lambda entry: entry.is_dir())
     # delete modal
     _show_delete_ws_id: Optional[int] = None
 
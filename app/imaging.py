@@ -0,0 +1,24 @@
+from typing import Tuple, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:  # PIL is imported on first use, it's not needed to start up
+    import PIL.Image
+
+# how much bigger than the target the image is decoded before the final resampling,
+# keeps quality while letting JPEG decode at 1/2, 1/4 or 1/8 of the full resolution
+REDUCING_GAP = 3.0
+
+
+def fit_within(
+        img: 'PIL.Image.Image',
+        max_size: Tuple[int, int],
+        resample: Optional['PIL.Image.Resampling'] = None,
+) -> 'PIL.Image.Image':
+    """
+    Shrinks the freshly opened image in place to fit within `max_size`, keeping the aspect ratio.
+    Decoders supporting it (JPEG) decode straight at a reduced resolution, others are reduced
+    by integer factors before resampling, so big images never get fully resampled.
+    """
+    import PIL.Image
+    resample = resample if resample is not None else PIL.Image.Resampling.BICUBIC
+    img.thumbnail(max_size, resample=resample, reducing_gap=REDUCING_GAP)
+    return img
@@ -0,0 +1,208 @@
+"""
+Maintenance of the databases and thumbnail packs, run in the background while the application is idle:
+files of removed workspaces are removed, thumbnail packs with much dead space are compacted, free pages
+of the databases are given back to the file system by an incremental vacuum, and statistics of the query
+planner are updated.
+
+A pass is a sequence of short steps, each a write job of its own, so a write of the application waits for
+one step at most. The pass stops between steps as soon as the application stops being idle and starts over
+in the next idle period. Only two kinds of steps take long: rebuilding a database created before incremental
+vacuum was on by default, once, and compacting a thumbnail pack, which happens rarely.
+"""
+import logging
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable, Iterator, Optional
+
+from app.repository import Repository
+from app.utils import sizeof_fmt
+
+_log = logging.getLogger(__name__)
+
+IDLE_AFTER = 30.0  # seconds without user activity
+PASS_INTERVAL = 60 * 60.0  # seconds from a complete pass to the next one
+COMPACTION_THRESHOLD = 16 * 1024 * 1024  # bytes of dead space in a thumbnail pack worth rewriting it
+_IDLE_CHECK_INTERVAL = 5.0  # seconds
+
+
+@dataclass
+class MaintenanceReport:
+    started_at: datetime
+    duration: float = 0.0  # seconds
+    complete: bool = False  # False if interrupted by activity or an error
+    orphan_files: int = 0  # of removed workspaces and old generations of thumbnail packs
+    orphan_bytes: int = 0
+    packs_compacted: int = 0
+    thumbnail_bytes: int = 0  # dead space of the compacted packs
+    databases_rebuilt: int = 0  # to turn incremental vacuum on
+    vacuum_bytes: int = 0  # free pages given back to the file system, by the rebuilds too
+    databases_optimized: int = 0
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return self.orphan_bytes + self.thumbnail_bytes + self.vacuum_bytes
+
+    def __str__(self) -> str:
+        state = "complete" if self.complete else "interrupted"
+        return f"Maintenance {state} in {self.duration:.1f}s, reclaimed {sizeof_fmt(self.reclaimed_bytes)}: " \
+               f"orphan files: {self.orphan_files} ({sizeof_fmt(self.orphan_bytes)}), " \
+               f"packs compacted: {self.packs_compacted} ({sizeof_fmt(self.thumbnail_bytes)}), " \
+               f"vacuum: {sizeof_fmt(self.vacuum_bytes)} ({self.databases_rebuilt} databases rebuilt), " \
+               f"databases optimized: {self.databases_optimized}"
+
+
+class Maintenance:
+    """
+    Runs maintenance passes on a thread of its own, see `start`. The application reports user activity with
+    `touch` and wraps work running in the background in `busy`, it's idle when there is none of either.
+    """
+    __repo: Repository
+    __idle_after: float
+    __pass_interval: float
+    __compaction_threshold: int
+    __touched_at: float
+    __busy: int = 0
+    __lock: threading.Lock
+    __pass_lock: threading.Lock  # held by the pass in progress, passes never overlap
+    __stop: threading.Event
+    __wake_events: 'weakref.WeakSet[threading.Event]'  # set on activity, see `wake_on_activity`
+    __thread: Optional[threading.Thread] = None
+    last_report: Optional[MaintenanceReport] = None
+
+    def __init__(
+            self,
+            repo: Repository,
+            idle_after: float = IDLE_AFTER,
+            pass_interval: float = PASS_INTERVAL,
+            compaction_threshold: int = COMPACTION_THRESHOLD,
+    ):
+        self.__repo = repo
+        self.__idle_after = idle_after
+        self.__pass_interval = pass_interval
+        self.__compaction_threshold = compaction_threshold
+        self.__touched_at = time.monotonic()
+        self.__lock = threading.Lock()
+        self.__pass_lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__wake_events = weakref.WeakSet()
+
+    def __del__(self):
+        self.stop()
+
+    def touch(self):
+        self.__touched_at = time.monotonic()
+        self.__wake()
+
+    def wake_on_activity(self, event: threading.Event):
+        """
+        Sets the event on user activity and when work starts in the background, a wait on it ends right away.
+        """
+        with self.__lock:
+            self.__wake_events.add(event)
+
+    def __wake(self):
+        with self.__lock:
+            events = list(self.__wake_events)
+        for event in events:
+            event.set()
+
+    @contextmanager
+    def busy(self) -> Iterator[None]:
+        with self.__lock:
+            self.__busy += 1
+        self.__wake()
+        try:
+            yield
+        finally:
+            with self.__lock:
+                self.__busy -= 1
+            self.touch()
+
+    def is_idle(self, idle_after: Optional[float] = None) -> bool:
+        """
+        Idle for `idle_after` seconds, the one of the maintenance if not given.
+        """
+        idle_after = idle_after if idle_after is not None else self.__idle_after
+        return self.__busy == 0 and time.monotonic() - self.__touched_at >= idle_after
+
+    def is_running(self) -> bool:
+        """
+        A pass is in progress.
+        """
+        return self.__pass_lock.locked()
+
+    def start(self):
+        if self.__thread is None:
+            # the thread doesn't keep the owner alive, it ends once the owner is collected
+            self.__thread = threading.Thread(
+                target=Maintenance.__run_when_idle, args=(weakref.ref(self), self.__stop), name="maintenance",
+                daemon=True,
+            )
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the thread after the step in progress, if any.
+        """
+        self.__stop.set()
+
+    @staticmethod
+    def __run_when_idle(ref: 'weakref.ref[Maintenance]', stop: threading.Event):
+        completed_at: Optional[float] = None
+        while not stop.wait(_IDLE_CHECK_INTERVAL):
+            maintenance = ref()
+            if maintenance is None:
+                return
+            due = completed_at is None or time.monotonic() - completed_at >= maintenance.__pass_interval
+            if due and maintenance.is_idle():
+                report = maintenance.run(cancel=lambda: stop.is_set() or not maintenance.is_idle())
+                if report.complete:
+                    completed_at = time.monotonic()
+            del maintenance
+
+    def run(self, cancel: Callable[[], bool] = lambda: False) -> MaintenanceReport:
+        """
+        Runs a pass, checking `cancel` between the steps. Waits for the pass in progress, if any, to end first.
+        """
+        with self.__pass_lock:
+            report = MaintenanceReport(datetime.now())
+            started = time.perf_counter()
+            try:
+                for _ in self.__steps(report):
+                    if cancel():
+                        break
+                else:
+                    report.complete = True
+            except Exception as e:
+                _log.error("Maintenance failed", exc_info=e)
+            report.duration = time.perf_counter() - started
+        _log.info(str(report))
+        self.last_report = report
+        return report
+
+    def __steps(self, report: MaintenanceReport) -> Iterator[None]:
+        repo = self.__repo
+        report.orphan_files, report.orphan_bytes = repo.remove_orphan_files()
+        yield
+        # the main database, with the thumbnail cache, then the databases of the workspaces
+        for ws_id in [None, *(ws.id for ws in repo.get_all_workspaces())]:
+            if repo.thumbnail_garbage(ws_id) >= self.__compaction_threshold:
+                reclaimed = repo.compact_thumbnail_cache() if ws_id is None else repo.compact_thumbnails(ws_id)
+                report.packs_compacted += 1
+                report.thumbnail_bytes += reclaimed
+                yield
+            rebuilt = repo.enable_incremental_vacuum(ws_id)
+            if rebuilt is not None:
+                report.databases_rebuilt += 1
+                report.vacuum_bytes += rebuilt
+                yield
+            while (freed := repo.incremental_vacuum(ws_id)) > 0:
+                report.vacuum_bytes += freed
+                yield
+            if repo.optimize(ws_id):
+                report.databases_optimized += 1
+            yield
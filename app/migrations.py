@@ -0,0 +1,562 @@
+"""
+Versioned schema migrations. The version the database is at is stored in `PRAGMA user_version`,
+every migration brings it one version up in its own transaction.
+
+The main database holds the workspace catalog, images of every workspace are in a database file of their own
+(`workspace_db_file`) with its own schema version, see `WORKSPACE_MIGRATIONS`.
+"""
+import logging
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, List, Optional, Sequence
+
+from app.db_connections import init_journaling
+from app.thumbnail_pack import ThumbnailPack, thumbnail_key
+from app.utils import datetime_to_ns, split_path
+
+_log = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int  # the version the migration brings the database to
+    description: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+def _execute_all(connection: sqlite3.Connection, statements: Sequence[str]):
+    # not executescript - it commits, migrations have to stay within their transaction
+    for statement in statements:
+        connection.execute(statement)
+
+
+def _iso_to_ns(value: Optional[str]) -> Optional[int]:
+    return datetime_to_ns(datetime.fromisoformat(value)) if value is not None else None
+
+
+def _v1_initial_schema(connection: sqlite3.Connection):
+    # `IF NOT EXISTS` - databases created before the schema was versioned are at version 0 too
+    _execute_all(connection, [
+        """
+        CREATE TABLE IF NOT EXISTS workspace (
+            id              integer PRIMARY KEY AUTOINCREMENT,
+            name            text    NOT NULL,
+            path            text    NOT NULL,
+            last_used_at    text
+        )
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_workspace_name ON workspace(name)",
+        "CREATE INDEX IF NOT EXISTS idx_workspace_last_used_at ON workspace(last_used_at)",
+        """
+        CREATE TABLE IF NOT EXISTS image_data (
+            workspace_id    integer NOT NULL,
+            path            text    NOT NULL,
+
+            size            integer NOT NULL,
+            last_updated_at text    NOT NULL,
+            width           integer NOT NULL,
+            height          integer NOT NULL,
+            thumbnail       blob    NULL,
+            rank            integer DEFAULT 0 NOT NULL,
+
+            PRIMARY KEY     (workspace_id, path),
+            CONSTRAINT      fk_workspace
+                FOREIGN KEY (workspace_id)
+                REFERENCES  workspace(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_image_data_path ON image_data(path)",
+        "CREATE INDEX IF NOT EXISTS idx_image_data_last_updated_at ON image_data(last_updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_image_data_rank ON image_data(rank)",
+    ])
+
+
+def _v2_workspace_state(connection: sqlite3.Connection):
+    _execute_all(connection, [
+        """
+        CREATE TABLE IF NOT EXISTS workspace_state (
+            workspace_id        integer PRIMARY KEY,
+            current_image_path  text    NULL,
+
+            CONSTRAINT      fk_workspace
+                FOREIGN KEY (workspace_id)
+                REFERENCES  workspace(id)
+                ON DELETE CASCADE
+        )
+        """,
+    ])
+
+
+def _v3_typed_columns(connection: sqlite3.Connection):
+    """
+    Timestamps as integer nanoseconds instead of ISO text, indexes matching the queries.
+    SQLite can't change column types, so the tables are rebuilt.
+    """
+    connection.create_function("iso_to_ns", 1, _iso_to_ns, deterministic=True)
+    row = connection.execute("SELECT seq FROM sqlite_sequence WHERE name='workspace'").fetchone()
+    workspace_seq = row[0] if row is not None else 0
+    _execute_all(connection, [
+        """
+        CREATE TABLE workspace_v3 (
+            id              integer PRIMARY KEY AUTOINCREMENT,
+            name            text    NOT NULL,
+            path            text    NOT NULL,
+            last_used_ns    integer NULL
+        )
+        """,
+        "INSERT INTO workspace_v3 (id, name, path, last_used_ns)"
+        " SELECT id, name, path, iso_to_ns(last_used_at) FROM workspace",
+        "DROP TABLE workspace",
+        "ALTER TABLE workspace_v3 RENAME TO workspace",
+        "CREATE UNIQUE INDEX idx_workspace_name ON workspace(name)",
+        # workspaces are listed by last use
+        "CREATE INDEX idx_workspace_last_used ON workspace(last_used_ns DESC, name)",
+        """
+        CREATE TABLE image_data_v3 (
+            workspace_id    integer NOT NULL,
+            path            text    NOT NULL,
+
+            size            integer NOT NULL,
+            last_updated_ns integer NOT NULL,
+            width           integer NOT NULL,
+            height          integer NOT NULL,
+            thumbnail       blob    NULL,
+            rank            integer DEFAULT 0 NOT NULL,
+
+            PRIMARY KEY     (workspace_id, path),
+            CONSTRAINT      fk_workspace
+                FOREIGN KEY (workspace_id)
+                REFERENCES  workspace(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "INSERT INTO image_data_v3 (workspace_id, path, size, last_updated_ns, width, height, thumbnail, rank)"
+        " SELECT workspace_id, path, CAST(size AS integer), iso_to_ns(last_updated_at),"
+        " CAST(width AS integer), CAST(height AS integer), thumbnail, rank FROM image_data",
+        "DROP TABLE image_data",
+        "ALTER TABLE image_data_v3 RENAME TO image_data",
+        # covers the workspace image list and the refresh diff, so neither reads the pages with thumbnails
+        "CREATE INDEX idx_image_data_metadata"
+        " ON image_data(workspace_id, path, last_updated_ns, rank, size, width, height)",
+        # covers rank filters (ordered by path) and the rank histogram
+        "CREATE INDEX idx_image_data_rank ON image_data(workspace_id, rank, path)",
+    ])
+    connection.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name='workspace'", (workspace_seq,))
+
+
+def _v4_directories(connection: sqlite3.Connection):
+    """
+    Image paths as (directory, file name), directories relative to the workspace root are stored once.
+    Moving the workspace root is a single row update of `workspace.path`.
+    """
+    _execute_all(connection, [
+        """
+        CREATE TABLE directory (
+            id              integer PRIMARY KEY,
+            workspace_id    integer NOT NULL,
+            relative        integer NOT NULL,  -- 1 - path is relative to the workspace root, 0 - as is
+            path            text    NOT NULL,  -- with trailing separator, '' is the workspace root
+
+            CONSTRAINT      fk_workspace
+                FOREIGN KEY (workspace_id)
+                REFERENCES  workspace(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "CREATE UNIQUE INDEX idx_directory_path ON directory(workspace_id, relative, path)",
+        "CREATE TEMP TABLE image_location (image_rowid integer PRIMARY KEY, directory_id integer, name text)",
+    ])
+    directories, locations = {}, []
+    rows = connection.execute(
+        "SELECT i.rowid, i.workspace_id, i.path, w.path FROM image_data i JOIN workspace w ON w.id = i.workspace_id"
+    ).fetchall()
+    for rowid, workspace_id, path, root in rows:
+        relative, directory, name = split_path(path, root)
+        directory_id = directories.setdefault((workspace_id, relative, directory), len(directories) + 1)
+        locations.append((rowid, directory_id, name))
+    connection.executemany(
+        "INSERT INTO directory (id, workspace_id, relative, path) VALUES (?, ?, ?, ?)",
+        ((directory_id, *key) for key, directory_id in directories.items()),
+    )
+    connection.executemany("INSERT INTO image_location VALUES (?, ?, ?)", locations)
+    _execute_all(connection, [
+        """
+        CREATE TABLE image_data_v4 (
+            directory_id    integer NOT NULL,
+            name            text    NOT NULL,
+
+            size            integer NOT NULL,
+            last_updated_ns integer NOT NULL,
+            width           integer NOT NULL,
+            height          integer NOT NULL,
+            rank            integer DEFAULT 0 NOT NULL,
+            thumbnail       blob    NULL,  -- last, reading the other columns never touches its overflow pages
+
+            PRIMARY KEY     (directory_id, name),
+            CONSTRAINT      fk_directory
+                FOREIGN KEY (directory_id)
+                REFERENCES  directory(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "INSERT INTO image_data_v4 (directory_id, name, size, last_updated_ns, width, height, rank, thumbnail)"
+        " SELECT l.directory_id, l.name, i.size, i.last_updated_ns, i.width, i.height, i.rank, i.thumbnail"
+        " FROM image_data i JOIN temp.image_location l ON l.image_rowid = i.rowid",
+        "DROP TABLE temp.image_location",
+        "DROP TABLE image_data",
+        "ALTER TABLE image_data_v4 RENAME TO image_data",
+        # covers workspace image lists, the refresh diff, rank filters and the rank histogram, directory by directory
+        "CREATE INDEX idx_image_data_metadata"
+        " ON image_data(directory_id, name, last_updated_ns, rank, size, width, height)",
+    ])
+
+
+def _v5_change_tracking(connection: sqlite3.Connection):
+    _execute_all(connection, [
+        # one row, incremented by every write transaction changing images or workspaces; rows changed by it
+        # are stamped with the new value, so other processes can read what changed since the value they saw
+        """
+        CREATE TABLE change_counter (
+            id              integer PRIMARY KEY CHECK (id = 1),
+            seq             integer NOT NULL,
+            pruned_seq      integer NOT NULL  -- removals up to this one are forgotten
+        )
+        """,
+        "INSERT INTO change_counter (id, seq, pruned_seq) VALUES (1, 0, 0)",
+        "ALTER TABLE workspace ADD COLUMN change_seq integer NOT NULL DEFAULT 0",
+        # after the thumbnail, but it's only searched by the index and written, never read from the table
+        "ALTER TABLE image_data ADD COLUMN change_seq integer NOT NULL DEFAULT 0",
+        "CREATE INDEX idx_image_data_change ON image_data(change_seq)",
+        """
+        CREATE TABLE image_removal (
+            seq             integer NOT NULL,
+            workspace_id    integer NOT NULL,
+            path            text    NOT NULL,
+
+            CONSTRAINT      fk_workspace
+                FOREIGN KEY (workspace_id)
+                REFERENCES  workspace(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX idx_image_removal_seq ON image_removal(seq)",
+    ])
+
+
+def _v6_workspace_databases(connection: sqlite3.Connection):
+    """
+    Images of every workspace move to a database file of their own, the main database keeps the catalog.
+    """
+    main_file = connection.execute("PRAGMA database_list").fetchone()[2]  # '' if in memory
+    created = []
+    try:
+        if main_file:  # in-memory databases are always new, there are no images yet
+            for workspace_id, in connection.execute("SELECT id FROM workspace").fetchall():
+                created.append(workspace_db_file(Path(main_file), workspace_id))
+                _copy_workspace_images(connection, workspace_id, created[-1])
+        _execute_all(connection, ["DROP TABLE image_removal", "DROP TABLE image_data", "DROP TABLE directory"])
+    except BaseException:
+        for ws_file in created:
+            remove_workspace_db(ws_file)
+        raise
+
+
+def _copy_workspace_images(connection: sqlite3.Connection, workspace_id: int, ws_file: Path):
+    remove_workspace_db(ws_file)  # left by a failed attempt
+    ws_file.parent.mkdir(parents=True, exist_ok=True)
+    target = sqlite3.connect(ws_file)
+    try:
+        init_journaling(target)
+        migrate(target, WORKSPACE_MIGRATIONS[:1])  # the layout of the tables copied
+        target.executemany(
+            "INSERT INTO directory (id, workspace_id, relative, path) VALUES (?, ?, ?, ?)",
+            connection.execute("SELECT id, workspace_id, relative, path FROM directory WHERE workspace_id=?",
+                               (workspace_id,)),
+        )
+        columns = "directory_id, name, size, last_updated_ns, width, height, rank, change_seq, thumbnail"
+        target.executemany(
+            f"INSERT INTO image_data ({columns}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            connection.execute(
+                f"SELECT {columns} FROM image_data WHERE directory_id IN"
+                " (SELECT id FROM directory WHERE workspace_id=?)",
+                (workspace_id,),
+            ),
+        )
+        target.executemany(
+            "INSERT INTO image_removal (seq, workspace_id, path) VALUES (?, ?, ?)",
+            connection.execute("SELECT seq, workspace_id, path FROM image_removal WHERE workspace_id=?",
+                               (workspace_id,)),
+        )
+        target.commit()
+        init_workspace_db(target)
+    finally:
+        target.close()
+
+
+def _v7_thumbnail_cache(connection: sqlite3.Connection):
+    _execute_all(connection, [
+        # thumbnails shared by the workspaces, their images have a key to find them by before decoding a file;
+        # the thumbnails are in a pack file of their own, like the ones of a workspace, see `thumbnail_cache_pack`
+        """
+        CREATE TABLE thumbnail_cache (
+            key             blob    PRIMARY KEY,  -- `ImageData.thumbnail_source_key` of the image file
+            offset          integer NOT NULL,
+            length          integer NOT NULL,
+            width           integer NOT NULL,     -- of the image
+            height          integer NOT NULL,
+            refs            integer NOT NULL,     -- images of all the workspaces with this thumbnail
+            used_ns         integer NOT NULL      -- last referenced, the least recently used are evicted first
+        ) WITHOUT ROWID
+        """,
+        "CREATE INDEX idx_thumbnail_cache_eviction ON thumbnail_cache(refs > 0, used_ns)",
+        """
+        CREATE TABLE thumbnail_cache_pack (
+            id              integer PRIMARY KEY CHECK (id = 1),
+            generation      integer NOT NULL,
+            size            integer NOT NULL  -- of the cached thumbnails, the file has dead space too
+        )
+        """,
+        "INSERT INTO thumbnail_cache_pack (id, generation, size) VALUES (1, 1, 0)",
+    ])
+
+
+def _v8_scan_rules(connection: sqlite3.Connection):
+    _execute_all(connection, [
+        # see `ScanRules`, NULL for the defaults
+        "ALTER TABLE workspace_state ADD COLUMN scan_patterns text NULL",  # gitignore-style, one per line
+        "ALTER TABLE workspace_state ADD COLUMN image_extensions text NULL",  # space separated, with the dots
+    ])
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial schema", _v1_initial_schema),
+    Migration(2, "workspace state", _v2_workspace_state),
+    Migration(3, "typed timestamp columns and covering indexes", _v3_typed_columns),
+    Migration(4, "directory table", _v4_directories),
+    Migration(5, "change tracking", _v5_change_tracking),
+    Migration(6, "workspace databases", _v6_workspace_databases),
+    Migration(7, "thumbnail cache", _v7_thumbnail_cache),
+    Migration(8, "scan rules", _v8_scan_rules),
+]
+SCHEMA_VERSION = MIGRATIONS[-1].version
+
+
+def _ws_v1_images(connection: sqlite3.Connection):
+    # the layout the tables had in the main database at version 5, a workspace still has directories
+    # with ids of their own, its id is kept to leave queries the same
+    _execute_all(connection, [
+        """
+        CREATE TABLE directory (
+            id              integer PRIMARY KEY,
+            workspace_id    integer NOT NULL,
+            relative        integer NOT NULL,  -- 1 - path is relative to the workspace root, 0 - as is
+            path            text    NOT NULL   -- with trailing separator, '' is the workspace root
+        )
+        """,
+        "CREATE UNIQUE INDEX idx_directory_path ON directory(workspace_id, relative, path)",
+        """
+        CREATE TABLE image_data (
+            directory_id    integer NOT NULL,
+            name            text    NOT NULL,
+
+            size            integer NOT NULL,
+            last_updated_ns integer NOT NULL,
+            width           integer NOT NULL,
+            height          integer NOT NULL,
+            rank            integer DEFAULT 0 NOT NULL,
+            change_seq      integer DEFAULT 0 NOT NULL,
+            thumbnail       blob    NULL,  -- last, reading the other columns never touches its overflow pages
+
+            PRIMARY KEY     (directory_id, name),
+            CONSTRAINT      fk_directory
+                FOREIGN KEY (directory_id)
+                REFERENCES  directory(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "CREATE INDEX idx_image_data_metadata"
+        " ON image_data(directory_id, name, last_updated_ns, rank, size, width, height)",
+        "CREATE INDEX idx_image_data_change ON image_data(change_seq)",
+        """
+        CREATE TABLE image_removal (
+            seq             integer NOT NULL,
+            workspace_id    integer NOT NULL,
+            path            text    NOT NULL
+        )
+        """,
+        "CREATE INDEX idx_image_removal_seq ON image_removal(seq)",
+    ])
+
+
+def _ws_v2_thumbnail_pack(connection: sqlite3.Connection):
+    """
+    Thumbnails move out of the database to the pack file next to it, see `app.thumbnail_pack`.
+    """
+    _execute_all(connection, [
+        # the index of the pack
+        """
+        CREATE TABLE thumbnail (
+            key             blob    PRIMARY KEY,  -- `thumbnail_key` of the encoded thumbnail
+            offset          integer NOT NULL,
+            length          integer NOT NULL
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE thumbnail_pack (
+            id              integer PRIMARY KEY CHECK (id = 1),
+            generation      integer NOT NULL  -- of the pack file, incremented by every compaction
+        )
+        """,
+        "INSERT INTO thumbnail_pack (id, generation) VALUES (1, 1)",
+        """
+        CREATE TABLE image_data_new (
+            directory_id    integer NOT NULL,
+            name            text    NOT NULL,
+
+            size            integer NOT NULL,
+            last_updated_ns integer NOT NULL,
+            width           integer NOT NULL,
+            height          integer NOT NULL,
+            rank            integer DEFAULT 0 NOT NULL,
+            change_seq      integer DEFAULT 0 NOT NULL,
+            thumbnail_key   blob    NULL,
+
+            PRIMARY KEY     (directory_id, name),
+            CONSTRAINT      fk_directory
+                FOREIGN KEY (directory_id)
+                REFERENCES  directory(id)
+                ON DELETE CASCADE
+        )
+        """,
+        "INSERT INTO image_data_new (directory_id, name, size, last_updated_ns, width, height, rank, change_seq)"
+        " SELECT directory_id, name, size, last_updated_ns, width, height, rank, change_seq FROM image_data",
+    ])
+    ws_file = connection.execute("PRAGMA database_list").fetchone()[2]  # in-memory ones are always new
+    pack = ThumbnailPack.for_database(Path(ws_file)) if ws_file else None
+    stored = set()
+    rows = connection.execute("SELECT directory_id, name, thumbnail FROM image_data WHERE thumbnail IS NOT NULL")
+    while batch := rows.fetchmany(1000):  # not all of them in memory at once
+        if not stored:
+            pack.file(1).unlink(missing_ok=True)  # left by a failed attempt, nothing refers to it
+        keyed = [(thumbnail_key(thumbnail), thumbnail, directory_id, name) for directory_id, name, thumbnail in batch]
+        new = {key: thumbnail for key, thumbnail, _directory_id, _name in keyed if key not in stored}
+        offsets = pack.append(1, new.values())
+        connection.executemany(
+            "INSERT INTO thumbnail (key, offset, length) VALUES (?, ?, ?)",
+            ((key, offset, len(thumbnail)) for (key, thumbnail), offset in zip(new.items(), offsets)),
+        )
+        connection.executemany(
+            "UPDATE image_data_new SET thumbnail_key=? WHERE directory_id=? AND name=?",
+            ((key, directory_id, name) for key, _thumbnail, directory_id, name in keyed),
+        )
+        stored.update(new)
+    _execute_all(connection, [
+        "DROP TABLE image_data",
+        "ALTER TABLE image_data_new RENAME TO image_data",
+        "CREATE INDEX idx_image_data_metadata"
+        " ON image_data(directory_id, name, last_updated_ns, rank, size, width, height)",
+        "CREATE INDEX idx_image_data_change ON image_data(change_seq)",
+    ])
+
+
+def _ws_v3_thumbnail_source(connection: sqlite3.Connection):
+    # the thumbnail cache entry an image has its thumbnail from, see `_v7_thumbnail_cache`
+    connection.execute("ALTER TABLE image_data ADD COLUMN source_key blob NULL")
+
+
+def _ws_v4_previews(connection: sqlite3.Connection):
+    # the larger level of the thumbnail, in the same pack, made in the background, see `app.thumbnail_worker`
+    connection.execute("ALTER TABLE image_data ADD COLUMN preview_key blob NULL")
+
+
+WORKSPACE_MIGRATIONS: List[Migration] = [
+    Migration(1, "workspace images", _ws_v1_images),
+    Migration(2, "thumbnail pack", _ws_v2_thumbnail_pack),
+    Migration(3, "thumbnail source", _ws_v3_thumbnail_source),
+    Migration(4, "previews", _ws_v4_previews),
+]
+
+
+def workspace_db_file(db_file: Path, workspace_id: int) -> Path:
+    """
+    Database file with images of the workspace, next to the main database. Workspace ids are never reused.
+    """
+    return _workspaces_dir(db_file).joinpath(f"{workspace_id}.sqlite3")
+
+
+def thumbnail_cache_pack(db_file: Path) -> ThumbnailPack:
+    """
+    Pack of the thumbnail cache shared by the workspaces, next to their databases.
+    """
+    return ThumbnailPack(_workspaces_dir(db_file), "cache")
+
+
+def _workspaces_dir(db_file: Path) -> Path:
+    return db_file.with_name(f"{db_file.stem}.workspaces")
+
+
+def init_workspace_db(connection: sqlite3.Connection) -> int:
+    """
+    Brings a workspace database to the current schema, returns its version. New ones are switched to WAL.
+    """
+    if get_version(connection) == 0:
+        init_journaling(connection)
+    return migrate(connection, WORKSPACE_MIGRATIONS)
+
+
+def remove_workspace_db(ws_file: Path):
+    ThumbnailPack.for_database(ws_file).remove_generations()
+    for path in [ws_file, ws_file.with_name(f"{ws_file.name}-wal"), ws_file.with_name(f"{ws_file.name}-shm")]:
+        path.unlink(missing_ok=True)
+
+
+def get_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection: sqlite3.Connection, migrations: List[Migration] = MIGRATIONS) -> int:
+    """
+    Applies migrations the database is missing, returns the resulting version.
+    A failed migration is rolled back, leaving the database at the previous version.
+    """
+    version = get_version(connection)
+    latest = migrations[-1].version
+    if version == latest:
+        _log.debug(f"Schema is up to date (version {version})")
+        return version
+    if version > latest:
+        raise sqlite3.DatabaseError(f"Database schema version {version} is newer than supported {latest}")
+
+    if connection.in_transaction:
+        connection.commit()
+    # tables are rebuilt by migrations, cascades must not fire meanwhile; can't be changed within a transaction
+    foreign_keys = connection.execute("PRAGMA foreign_keys").fetchone()[0]
+    connection.execute("PRAGMA foreign_keys = OFF")
+    try:
+        for migration in migrations:
+            if migration.version <= version:
+                continue
+            # takes the write lock first, another process may be migrating the same database
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if get_version(connection) >= migration.version:
+                    connection.execute("COMMIT")
+                    version = get_version(connection)
+                    continue
+                _log.info(f"Migrating database to version {migration.version}: {migration.description}")
+                migration.apply(connection)
+                violations = connection.execute("PRAGMA foreign_key_check").fetchall()
+                if violations:
+                    raise sqlite3.IntegrityError(f"Foreign key violations after migration: {violations[:10]}")
+                connection.execute(f"PRAGMA user_version = {migration.version}")
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            version = migration.version
+    finally:
+        connection.execute(f"PRAGMA foreign_keys = {'ON' if foreign_keys else 'OFF'}")
+    return version
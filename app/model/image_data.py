@@ -1,19 +1,28 @@
+import hashlib
 import logging
 import sys
-from collections import namedtuple
 from dataclasses import dataclass, field, fields, replace
 from datetime import datetime
 from io import BytesIO
 from pathlib import Path
-from sqlite3 import Cursor, Row
-from typing import Optional, Self, Tuple
+from sqlite3 import Cursor
+from typing import Optional, Self, Tuple, TYPE_CHECKING
 
-import PIL.Image
+from app.imaging import fit_within
+from app.row_mapping import RowMapper
+from app.utils import sizeof_fmt, ns_to_datetime
 
-from app.utils import sizeof_fmt
+if TYPE_CHECKING:  # PIL is imported on first use, it's not needed to start up
+    import PIL.Image
 
 _log = logging.getLogger(__name__)
 
+THUMBNAIL_SIZE = 64
+PREVIEW_SIZE = 256  # the larger level of the thumbnail, for thumbnails shown big
+# how thumbnails are made, part of the thumbnail cache keys: a change makes the cached ones unused
+_THUMBNAIL_PARAMS = f"{THUMBNAIL_SIZE}x{THUMBNAIL_SIZE} png palette-256".encode()
+_HASH_CHUNK = 1024 * 1024
+
 
 @dataclass(eq=True, frozen=True)
 class ImageData:
@@ -27,12 +36,14 @@ class ImageData:
 
     rank: int
     thumbnail: Optional[bytes] = field(compare=False, hash=False, repr=False, default=None)
+    # `thumbnail_source_key` of the file the thumbnail was made of, if it goes to the thumbnail cache
+    source_key: Optional[bytes] = field(compare=False, hash=False, repr=False, default=None)
 
     @property
     def dimensions(self):
         return self.width, self.height
 
-    def with_populated_thumbnail(self, thumb_max_size: Tuple[int, int] | int = 64, force_reload: bool = False) -> Self:
+    def with_populated_thumbnail(self, thumb_max_size: Tuple[int, int] | int = THUMBNAIL_SIZE, force_reload: bool = False) -> Self:
         assert type(thumb_max_size) is int \
                or type(thumb_max_size) is tuple, f"thumbnail max size has wrong type: {type(thumb_max_size)}"
         thumb_size = (thumb_max_size, thumb_max_size) if type(thumb_max_size) is int else thumb_max_size
@@ -42,12 +53,11 @@ class ImageData:
         if not force_reload and self.thumbnail is not None:
             return self
 
+        import PIL.Image
         try:
             with PIL.Image.open(self.path) as img:
-                img.thumbnail(thumb_size)
-                img = img.convert(mode='P', palette=PIL.Image.Palette.ADAPTIVE, colors=256)
-                img_bytes = BytesIO()
-                img.save(img_bytes, 'PNG', optimize=True)
+                fit_within(img, thumb_size)
+                thumbnail = ImageData.encode_thumbnail(img)
         except FileNotFoundError:
             _log.info(f"File {self.path} not found")
             return None
@@ -56,14 +66,53 @@ class ImageData:
             return None
 
         _log.debug(f"Populated image with thumbnail, now object size is {sizeof_fmt(self.memory_footprint)}")
-        return replace(self, thumbnail=img_bytes.getvalue())
+        return replace(self, thumbnail=thumbnail)
 
     @property
     def memory_footprint(self) -> int:
         return sum(sys.getsizeof(getattr(self, f.name)) for f in fields(self))
 
+    @staticmethod
+    def encode_thumbnail(img: 'PIL.Image.Image') -> bytes:
+        """
+        Encodes already downsized image as a palette PNG, the format thumbnails are stored in.
+        """
+        import PIL.Image
+        img = img.convert(mode='P', palette=PIL.Image.Palette.ADAPTIVE, colors=256)
+        img_bytes = BytesIO()
+        img.save(img_bytes, 'PNG', optimize=True)
+        return img_bytes.getvalue()
+
+    @staticmethod
+    def encode_preview(path: Path) -> Tuple[bytes, bytes]:
+        """
+        Decodes the image once for its preview and thumbnail, made of the preview: (thumbnail, preview).
+        """
+        import PIL.Image
+        with PIL.Image.open(path) as img:
+            fit_within(img, (PREVIEW_SIZE, PREVIEW_SIZE))
+            preview = ImageData.encode_thumbnail(img)
+            thumbnail = ImageData.encode_thumbnail(fit_within(img.copy(), (THUMBNAIL_SIZE, THUMBNAIL_SIZE)))
+        return thumbnail, preview
+
+    @staticmethod
+    def thumbnail_source_key(source: Path | bytes) -> bytes:
+        """
+        Key of the thumbnail of the file in the thumbnail cache: a hash of the file content and the way
+        thumbnails are made. Reads the whole file, unless given its content, but doesn't decode it.
+        """
+        digest = hashlib.blake2b(_THUMBNAIL_PARAMS, digest_size=16)
+        if isinstance(source, bytes):
+            digest.update(source)
+        else:
+            with open(source, "rb") as f:
+                while chunk := f.read(_HASH_CHUNK):
+                    digest.update(chunk)
+        return digest.digest()
+
     @staticmethod
     def from_file(path: Path, workspace_id: int, with_thumbnail: bool = True) -> Optional['ImageData']:
+        import PIL.Image
         try:
             with PIL.Image.open(path) as img:
                 stats = path.stat()
@@ -79,7 +128,7 @@ class ImageData:
             workspace_id=workspace_id,
             path=str(path),
             size=stats.st_size,
-            last_updated_at=datetime.fromtimestamp(stats.st_mtime_ns / 1e9),
+            last_updated_at=ns_to_datetime(stats.st_mtime_ns),
             width=img_w,
             height=img_h,
             rank=0,
@@ -87,18 +136,12 @@ class ImageData:
         return image_data.with_populated_thumbnail() if with_thumbnail else image_data
 
     @staticmethod
-    def row_factory(cursor: Cursor, row: Row) -> 'ImageData':
-        column_names = [column[0] for column in cursor.description]
-        tpl = namedtuple("Row", column_names)(*row)
-        return ImageData(
-            workspace_id=tpl.workspace_id,
-            path=tpl.path,
-
-            size=tpl.size,
-            last_updated_at=datetime.fromisoformat(tpl.last_updated_at),
-            width=tpl.width,
-            height=tpl.height,
-
-            rank=tpl.rank,
-            thumbnail=tpl.thumbnail,
-        )
+    def row_factory(cursor: Cursor, row: tuple) -> 'ImageData':
+        return _row_mapper(cursor, row)
+
+
+_row_mapper = RowMapper(
+    ImageData,
+    ["workspace_id", "path", "size", "last_updated_ns", "width", "height", "rank", "thumbnail"],
+    {"last_updated_ns": ns_to_datetime},
+)
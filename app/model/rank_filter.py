@@ -0,0 +1,23 @@
+import dataclasses
+from typing import Optional
+
+
+@dataclasses.dataclass(eq=True, frozen=True)
+class RankFilter:
+    """
+    Inclusive range of image ranks, a missing bound means the range is open on that side.
+    """
+    min_rank: Optional[int] = None
+    max_rank: Optional[int] = None
+
+    def matches(self, rank: int) -> bool:
+        if self.min_rank is not None and rank < self.min_rank:
+            return False
+        if self.max_rank is not None and rank > self.max_rank:
+            return False
+        return True
+
+    def __str__(self) -> str:
+        lo = "-inf" if self.min_rank is None else str(self.min_rank)
+        hi = "+inf" if self.max_rank is None else str(self.max_rank)
+        return f"[{lo}, {hi}]"
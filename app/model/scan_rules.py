@@ -0,0 +1,128 @@
+"""
+Which files under a workspace root are its images: files with an image extension, less the ones excluded by
+gitignore-style patterns. The patterns are compiled once per scan, and a directory they exclude is never
+listed, nothing under it can be included again (as with git).
+
+Patterns, one per line, the last one matching a path decides:
+
+    # a comment
+    .cache/          a directory named .cache anywhere, the trailing / matches directories only
+    /latents         latents at the root, a / at the start or in the middle anchors a pattern to the root
+    **/venv/         ** matches any number of directories
+    *.tmp.png        * and ? match within a name, [a-z] a character of the class
+    !keep.tmp.png    ! includes what earlier patterns excluded
+"""
+import dataclasses
+import os
+import re
+from typing import List, Optional, Pattern, Tuple
+
+DEFAULT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
+# paths are case-insensitive on Windows
+_FLAGS = re.IGNORECASE if os.name == "nt" else 0
+
+
+@dataclasses.dataclass(frozen=True)
+class ScanRules:
+    patterns: str = ""  # gitignore-style, one per line
+    extensions: Tuple[str, ...] = DEFAULT_EXTENSIONS  # lower case, with the dot
+
+    @staticmethod
+    def parse_extensions(extensions: str) -> Tuple[str, ...]:
+        """
+        Extensions separated by spaces or commas, with or without the dots, e.g. "jpg, .png webp".
+        """
+        names = [e.strip().lower().lstrip(".") for e in re.split(r"[\s,]+", extensions)]
+        return tuple(dict.fromkeys(f".{name}" for name in names if name))
+
+    def compile(self) -> 'ScanMatcher':
+        rules = [rule for line in self.patterns.splitlines() if (rule := _compile_pattern(line)) is not None]
+        return ScanMatcher(rules, self.extensions)
+
+
+@dataclasses.dataclass(frozen=True)
+class _Rule:
+    regex: Pattern
+    dir_only: bool
+    negated: bool
+
+
+class ScanMatcher:
+    """
+    Compiled `ScanRules`. Paths are relative to the workspace root, separated by /.
+    """
+    __rules: List[_Rule]
+    __extensions: Tuple[str, ...]
+    # all the patterns that could match a file and a directory in one regex each, most paths match none
+    __any_file: Optional[Pattern] = None
+    __any_dir: Optional[Pattern] = None
+
+    def __init__(self, rules: List[_Rule], extensions: Tuple[str, ...]):
+        self.__rules = rules
+        self.__extensions = extensions
+        if rules:
+            self.__any_dir = re.compile("|".join(f"(?:{r.regex.pattern})" for r in rules), _FLAGS)
+        file_rules = [r for r in rules if not r.dir_only]
+        if file_rules:
+            self.__any_file = re.compile("|".join(f"(?:{r.regex.pattern})" for r in file_rules), _FLAGS)
+
+    def is_image(self, name: str) -> bool:
+        return name.lower().endswith(self.__extensions)
+
+    def excludes(self, relative_path: str, is_dir: bool) -> bool:
+        any_rule = self.__any_dir if is_dir else self.__any_file
+        if any_rule is None or any_rule.fullmatch(relative_path) is None:
+            return False
+        for rule in reversed(self.__rules):
+            if (is_dir or not rule.dir_only) and rule.regex.fullmatch(relative_path):
+                return not rule.negated
+        return False
+
+
+def _compile_pattern(line: str) -> Optional[_Rule]:
+    pattern = line.strip()
+    if not pattern or pattern.startswith("#"):
+        return None
+    negated = pattern.startswith("!")
+    if negated:
+        pattern = pattern[1:]
+    elif pattern.startswith("\\"):  # an escaped leading ! or #
+        pattern = pattern[1:]
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    if not pattern:
+        return None
+    regex = [] if anchored else ["(?:.*/)?"]  # a name at any depth
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**", i) and (i == 0 or pattern[i - 1] == "/"):
+            if i + 2 == len(pattern):  # everything inside
+                regex.append(".*")
+                i += 2
+                continue
+            if pattern[i + 2] == "/":  # any directories
+                regex.append("(?:.*/)?")
+                i += 3
+                continue
+        if c == "*":
+            regex.append("[^/]*")
+            while i + 1 < len(pattern) and pattern[i + 1] == "*":
+                i += 1
+        elif c == "?":
+            regex.append("[^/]")
+        elif c == "[" and (end := pattern.find("]", i + 2)) != -1:
+            chars = pattern[i + 1:end]
+            negated_class = chars[0] in "!^"
+            chars = (chars[1:] if negated_class else chars).replace("\\", "\\\\")
+            regex.append(f"[{'^' if negated_class else ''}{chars}]")
+            i = end
+        elif c == "\\" and i + 1 < len(pattern):
+            regex.append(re.escape(pattern[i + 1]))
+            i += 1
+        else:
+            regex.append(re.escape(c))
+        i += 1
+    return _Rule(re.compile("".join(regex), _FLAGS), dir_only, negated)
@@ -1,9 +1,11 @@
 import dataclasses
-from collections import namedtuple
 from datetime import datetime
-from sqlite3 import Cursor, Row
+from sqlite3 import Cursor
 from typing import Optional
 
+from app.row_mapping import RowMapper
+from app.utils import ns_to_datetime
+
 
 @dataclasses.dataclass(eq=True, frozen=True)
 class Workspace:
@@ -13,12 +15,8 @@ class Workspace:
     last_used_at: Optional[datetime]
 
     @staticmethod
-    def row_factory(cursor: Cursor, row: Row) -> 'Workspace':
-        column_names = [column[0] for column in cursor.description]
-        tpl = namedtuple("Row", column_names)(*row)
-        return Workspace(
-            id=tpl.id,
-            name=tpl.name,
-            path=tpl.path,
-            last_used_at=datetime.fromisoformat(tpl.last_used_at),
-        )
+    def row_factory(cursor: Cursor, row: tuple) -> 'Workspace':
+        return _row_mapper(cursor, row)
+
+
+_row_mapper = RowMapper(Workspace, ["id", "name", "path", "last_used_ns"], {"last_used_ns": ns_to_datetime})
@@ -0,0 +1,18 @@
+import dataclasses
+from typing import List
+
+from app.model.image_data import ImageData
+
+
+@dataclasses.dataclass(frozen=True)
+class WorkspaceChange:
+    """
+    A batch of changes written to the DB by a workspace refresh or another process: added or updated images
+    and paths of removed ones, and paths of images which got thumbnails or previews made in the background.
+    With `reload` the changes are unknown and the whole workspace has to be reloaded.
+    """
+    workspace_id: int
+    updated: List[ImageData]
+    removed: List[str]
+    reload: bool = False
+    thumbnails: List[str] = dataclasses.field(default_factory=list)
@@ -0,0 +1,110 @@
+import math
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from typing import Deque, Dict, Callable, Optional, List, Any, Iterator
+
+# gauges of the performance overlay, see `MainWindow`
+GAUGE_BACKGROUND_JOBS = "background jobs"
+GAUGE_DECODE_QUEUE = "decode queue"
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values, `p` is within [0, 100].
+    """
+    if not sorted_values:
+        return 0.0
+    rank = math.ceil(p / 100 * len(sorted_values))
+    return sorted_values[min(len(sorted_values), max(1, rank)) - 1]
+
+
+class PerfMonitor:
+    """
+    Collects per-frame timings: total frame time, time spent in named sections of a frame,
+    per-frame deltas of monotonic counters (e.g. DB statements executed) and current values of gauges.
+    Everything is kept for the last `window` frames only.
+    """
+    __window: int
+    __frame_times: Deque[float]
+    __frame_start: Optional[float]
+    __sections: Dict[str, Deque[float]]
+    __current_sections: Dict[str, float]
+    __counters: Dict[str, Callable[[], float]]
+    __counter_last_totals: Dict[str, float]
+    __counter_deltas: Dict[str, Deque[float]]
+    __gauges: Dict[str, Callable[[], Any]]
+
+    def __init__(self, window: int = 300):
+        self.__window = window
+        self.__frame_times = deque(maxlen=window)
+        self.__frame_start = None
+        self.__sections = defaultdict(lambda: deque(maxlen=window))
+        self.__current_sections = defaultdict(float)
+        self.__counters = {}
+        self.__counter_last_totals = {}
+        self.__counter_deltas = defaultdict(lambda: deque(maxlen=window))
+        self.__gauges = {}
+
+    def register_counter(self, name: str, total_fn: Callable[[], float]):
+        """
+        `total_fn` returns a monotonically growing total, the monitor keeps its per-frame increments.
+        """
+        self.__counters[name] = total_fn
+        self.__counter_last_totals[name] = total_fn()
+
+    def register_gauge(self, name: str, value_fn: Callable[[], Any]):
+        self.__gauges[name] = value_fn
+
+    def begin_frame(self):
+        now = time.perf_counter()
+        if self.__frame_start is not None:
+            self.__frame_times.append(now - self.__frame_start)
+            self.__close_frame()
+        self.__frame_start = now
+
+    def __close_frame(self):
+        for name in set(self.__sections) | set(self.__current_sections):
+            self.__sections[name].append(self.__current_sections.get(name, 0.0))
+        self.__current_sections.clear()
+        for name, total_fn in self.__counters.items():
+            total = total_fn()
+            self.__counter_deltas[name].append(total - self.__counter_last_totals[name])
+            self.__counter_last_totals[name] = total
+
+    @contextmanager
+    def section(self, name: str) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.__current_sections[name] += time.perf_counter() - t
+
+    @property
+    def frame_times(self) -> List[float]:
+        return list(self.__frame_times)
+
+    def frame_time_percentiles(self, ps=(50, 95, 99, 100)) -> Dict[int, float]:
+        values = sorted(self.__frame_times)
+        return {p: percentile(values, p) for p in ps}
+
+    def section_times(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per section: time in the last frame, average and max over the window, in seconds.
+        """
+        return {
+            name: {"last": times[-1], "avg": sum(times) / len(times), "max": max(times)}
+            for name, times in sorted(self.__sections.items()) if times
+        }
+
+    def counter_deltas(self) -> Dict[str, Dict[str, float]]:
+        """
+        Per counter: increment in the last frame, average and max per frame over the window.
+        """
+        return {
+            name: {"last": deltas[-1], "avg": sum(deltas) / len(deltas), "max": max(deltas)}
+            for name, deltas in sorted(self.__counter_deltas.items()) if deltas
+        }
+
+    def gauges(self) -> Dict[str, Any]:
+        return {name: fn() for name, fn in self.__gauges.items()}
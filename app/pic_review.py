@@ -1,35 +1,203 @@
 import logging
+import threading
+import time
+from collections import deque
 from pathlib import Path
-from typing import Optional, List, Dict
+from typing import Optional, List, Dict, Callable, Deque, Tuple, TYPE_CHECKING
 
+from app.bulk_ops import BulkOpsEngine, BulkOperation, BulkOpReport
+from app.db_stats import QueryStatsSnapshot
+from app.maintenance import Maintenance, MaintenanceReport
 from app.model.image_data import ImageData
+from app.model.rank_filter import RankFilter
+from app.model.scan_rules import ScanRules
 from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.refresh_report import RefreshReport
 from app.repository import Repository
+from app.thumbnail_scheduler import ThumbnailScheduler
+from app.thumbnail_worker import ThumbnailWorker
 from app.workspace_mgr import WorkspaceManager
 
+if TYPE_CHECKING:  # archive and multiprocessing modules are imported on first export/publish
+    from app.export import ArchiveExporter, ArchiveFormat, ExportReport
+    from app.publish import Publisher, PublishSettings, PublishReport
+
 _log = logging.getLogger(__name__)
+_DB_CHANGES_POLL_INTERVAL = 0.5  # seconds, how often the DB is checked for changes made by other processes
+# a cancelled reconciliation stops after the image in progress, this is waited for it at most
+_RECONCILIATION_STOP_TIMEOUT = 10.0  # seconds
 
 
 class PicReview:
     __repo: Repository
     __workspace_manager: WorkspaceManager
+    __bulk_ops: BulkOpsEngine
+    __maintenance: Maintenance  # runs when the user leaves the application idle
+    __thumbnail_worker: ThumbnailWorker  # makes previews when the user leaves the application idle
+    __archive_exporter: Optional['ArchiveExporter'] = None
+    __publisher: Optional['Publisher'] = None
+    # background reconciliation of the current workspace with the filesystem
+    __reconciliation: Optional[threading.Thread] = None
+    __reconciliation_cancel: Optional[threading.Event] = None
+    __thumbnail_scheduler: Optional[ThumbnailScheduler] = None  # of the reconciliation
+    __thumbnail_focus: Optional[Tuple[str, str, str]] = None  # see `focus_thumbnails`
+    __workspace_changes: Deque[WorkspaceChange]
+    # the DB change counter the current workspace is up to date with, see `Repository.get_changes_since`
+    __change_seq: int = 0
+    __changes_polled_at: float = 0.0
 
-    def __init__(self, db_file: Path):
+    def __init__(self, db_file: Path, background: bool = True):
+        """
+        Without `background` nothing runs while the application is idle (maintenance, previews), e.g. for the
+        headless commands, which run what they need themselves.
+        """
+        self.__workspace_changes = deque()
         self.__repo = Repository(db_file)
-        self.__workspace_manager = WorkspaceManager(self.__repo)
+        self.__workspace_manager = WorkspaceManager(self.__repo, reports_dir=db_file.parent.joinpath("reports"))
+        self.__bulk_ops = BulkOpsEngine(self.__repo, journal_dir=db_file.parent.joinpath("journal"))
+        self.__maintenance = Maintenance(self.__repo)
+        self.__thumbnail_worker = ThumbnailWorker(
+            self.__repo, self.__maintenance, self.get_current_workspace, self.__workspace_changes.append,
+        )
+        if background:
+            self.__maintenance.start()
+            self.__thumbnail_worker.start()
         _log.info("PicReview backend initialized")
 
+    def touch(self):
+        """
+        Reports user input, the work done in the background while the user is idle waits for it to stop.
+        """
+        self.__maintenance.touch()
+
     def get_workspace_dir(self) -> Optional[Path]:
         return self.__workspace_manager.get_current_workspace_dir()
 
     def create_new_workspace(self, path: Path, name: str, set_current: bool = True) -> Optional[Workspace]:
+        """
+        With `set_current` the new workspace is opened right away and its images are indexed in the background.
+        """
         _log.debug(f"Adding workspace name: {name}, path: {path}")
-        return self.__workspace_manager.create_new_workspace(path=path, name=name, set_current=set_current)
+        self.__maintenance.touch()
+        ws = self.__workspace_manager.create_new_workspace(path=path, name=name, set_current=False)
+        if ws is not None and set_current:
+            self.set_workspace_as_current(ws.id, refresh=True)
+        return ws
 
     def set_workspace_as_current(self, ws_id: int, refresh: bool):
+        """
+        Switches to the workspace as the DB knows it, without waiting for the filesystem.
+        With `refresh` the workspace is reconciled with the filesystem in the background,
+        the changes are delivered by `poll_workspace_changes`.
+        """
+        self.__maintenance.touch()
+        self.__stop_reconciliation()
+        self.__change_seq = self.__repo.get_change_seq()  # whatever is committed after loading is polled again
         self.__workspace_manager.set_workspace_as_current(ws_id)
+        self.__workspace_changes.clear()
+        self.__thumbnail_focus = None
         if refresh:
-            self.__workspace_manager.refresh_current_workspace()
+            self.__start_reconciliation()
+
+    def __start_reconciliation(self):
+        cancel = threading.Event()
+        # one per reconciliation, a cancelled one may still take an image
+        scheduler = ThumbnailScheduler(self.__thumbnail_focus)
+
+        def reconcile():
+            try:
+                with self.__maintenance.busy():
+                    self.__workspace_manager.refresh_current_workspace(
+                        on_change=self.__workspace_changes.append,
+                        cancel=cancel,
+                        scheduler=scheduler,
+                    )
+            except Exception as e:
+                _log.error("Workspace reconciliation failed", exc_info=e)
+
+        self.__reconciliation_cancel = cancel
+        self.__thumbnail_scheduler = scheduler
+        self.__reconciliation = threading.Thread(target=reconcile, name="workspace-reconciliation", daemon=True)
+        self.__reconciliation.start()
+
+    def __stop_reconciliation(self):
+        """
+        Cancels the reconciliation and waits for it to end, so it doesn't write images of the workspace or the
+        root it was started for meanwhile.
+        """
+        if self.__reconciliation_cancel is not None:
+            self.__reconciliation_cancel.set()
+        reconciliation = self.__reconciliation
+        if reconciliation is not None:
+            reconciliation.join(_RECONCILIATION_STOP_TIMEOUT)
+            if reconciliation.is_alive():
+                _log.warning(f"Workspace reconciliation still running {_RECONCILIATION_STOP_TIMEOUT}s after cancel")
+        self.__reconciliation = None
+        self.__reconciliation_cancel = None
+        self.__thumbnail_scheduler = None
+
+    def is_reconciling(self) -> bool:
+        return self.__reconciliation is not None and self.__reconciliation.is_alive()
+
+    def get_background_jobs(self) -> int:
+        """
+        Number of reconciliations, maintenance passes and preview runs in progress.
+        """
+        return sum([
+            self.is_reconciling(), self.__maintenance.is_running(), self.__thumbnail_worker.is_running(),
+        ])
+
+    def get_thumbnails_pending(self) -> int:
+        """
+        Images the reconciliation in progress is yet to make thumbnails of, see `focus_thumbnails`.
+        """
+        scheduler = self.__thumbnail_scheduler
+        return len(scheduler) if scheduler is not None else 0
+
+    def wait_for_reconciliation(self, timeout: Optional[float] = None) -> bool:
+        """
+        Returns False if the reconciliation is still running after the timeout.
+        """
+        reconciliation = self.__reconciliation
+        if reconciliation is not None:
+            reconciliation.join(timeout)
+            return not reconciliation.is_alive()
+        return True
+
+    def poll_workspace_changes(self) -> List[WorkspaceChange]:
+        """
+        Changes of the current workspace made by the background reconciliation since the last poll, and those
+        made by other processes sharing the DB (checked every `_DB_CHANGES_POLL_INTERVAL`). Applying the same
+        change twice must be harmless, changes written by this process may be delivered by both.
+        """
+        ws = self.get_current_workspace()
+        changes = []
+        while self.__workspace_changes:
+            change = self.__workspace_changes.popleft()
+            if ws is not None and change.workspace_id == ws.id:
+                changes.append(change)
+        if ws is not None and time.monotonic() - self.__changes_polled_at >= _DB_CHANGES_POLL_INTERVAL:
+            changes.extend(self.__poll_db_changes(ws))
+        return changes
+
+    def __poll_db_changes(self, ws: Workspace) -> List[WorkspaceChange]:
+        self.__changes_polled_at = time.monotonic()
+        self.__change_seq, change = self.__repo.get_changes_since(ws.id, self.__change_seq)
+        if change is None:
+            _log.info(f"Workspace {ws.name} was changed by another process, reloading it")
+            self.__stop_reconciliation()  # its root may have moved
+            self.__workspace_manager.set_workspace_as_current(ws.id)
+            self.__workspace_changes.clear()
+            return [WorkspaceChange(ws.id, [], [], reload=True)]
+        return [change] if change.updated or change.removed else []
+
+    def refresh_current_workspace(
+            self,
+            progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Optional[RefreshReport]:
+        with self.__maintenance.busy():
+            return self.__workspace_manager.refresh_current_workspace(progress)
 
     def is_workspace_selected(self) -> bool:
         return self.__workspace_manager.get_current_workspace_dir() is not None
@@ -43,14 +211,175 @@ class PicReview:
             return None
         return self.__repo.get_all_images_for_workspace(ws.id)
 
+    def get_current_workspace_image_index(self) -> Optional[List[ImageData]]:
+        """
+        All images of the current workspace ordered by path, without thumbnails, see `get_thumbnails`.
+        """
+        ws = self.get_current_workspace()
+        if ws is None:
+            return None
+        return self.__repo.get_image_index(ws.id)
+
+    def get_thumbnails(self, paths: List[str], previews: bool = False) -> Dict[str, Optional[memoryview]]:
+        """
+        With `previews` the previews of the images that have them already, see `app.thumbnail_worker`.
+        """
+        ws = self.get_current_workspace()
+        if ws is None:
+            return {}
+        self.__maintenance.touch()  # scrolling
+        return self.__repo.get_thumbnails(ws.id, paths, previews)
+
+    def focus_thumbnails(self, current_path: str, first_visible_path: str, last_visible_path: str):
+        """
+        Tells which images the user is looking at: the background reconciliation makes their thumbnails first.
+        """
+        self.__thumbnail_focus = (current_path, first_visible_path, last_visible_path)
+        scheduler = self.__thumbnail_scheduler
+        if scheduler is not None:
+            scheduler.focus(*self.__thumbnail_focus)
+
+    def get_current_image_path(self) -> Optional[str]:
+        ws = self.get_current_workspace()
+        if ws is None:
+            return None
+        return self.__repo.get_current_image_path(ws.id)
+
+    def set_current_image_path(self, path: Optional[str]):
+        ws = self.get_current_workspace()
+        if ws is not None:
+            self.__maintenance.touch()
+            self.__repo.set_current_image_path(ws.id, path)
+
     def get_current_workspace_images_rank_histogram(self) -> Optional[Dict[int, int]]:
         ws = self.get_current_workspace()
         if ws is None:
             return None
         return self.__repo.get_image_rank_histogram(ws.id)
 
+    def find_workspace(self, name_or_id: str) -> Optional[Workspace]:
+        workspaces = self.get_workspaces()
+        by_name = next((ws for ws in workspaces if ws.name == name_or_id), None)
+        if by_name is not None or not name_or_id.isdigit():
+            return by_name
+        return next((ws for ws in workspaces if ws.id == int(name_or_id)), None)
+
+    def get_db_statements_executed(self) -> int:
+        return self.__repo.statements_executed
+
+    def enable_db_instrumentation(self, slow_query_threshold: Optional[float] = None):
+        self.__repo.enable_instrumentation(slow_query_threshold)
+
+    def disable_db_instrumentation(self):
+        self.__repo.disable_instrumentation()
+
+    def get_db_stats(self) -> Optional[QueryStatsSnapshot]:
+        return self.__repo.query_stats()
+
+    def get_db_time_total(self) -> float:
+        return self.__repo.query_time_total
+
     def get_workspaces(self) -> List[Workspace]:
         return self.__repo.get_all_workspaces()
 
+    def move_workspace_root(self, ws_id: int, path: Path) -> Optional[Workspace]:
+        self.__maintenance.touch()
+        ws = self.get_current_workspace()
+        if ws is not None and ws.id == ws_id:
+            self.__stop_reconciliation()  # it's walking the old root
+        return self.__workspace_manager.move_workspace_root(ws_id, path)
+
+    def get_scan_rules(self, ws_id: int) -> ScanRules:
+        return self.__repo.get_scan_rules(ws_id)
+
+    def set_scan_rules(self, ws_id: int, rules: ScanRules):
+        """
+        Rules the next refresh of the workspace scans by, images they exclude are removed from the workspace.
+        """
+        self.__maintenance.touch()
+        self.__repo.set_scan_rules(ws_id, rules)
+
     def rm_workspace(self, ws_id: int):
+        self.__maintenance.touch()
+        ws = self.get_current_workspace()
+        if ws is not None and ws.id == ws_id:
+            self.__stop_reconciliation()
         self.__workspace_manager.rm_workspace(ws_id)
+
+    # BULK OPERATIONS #
+
+    def run_bulk_operation(
+            self,
+            operation: BulkOperation,
+            rank_filter: RankFilter,
+            destination: Optional[Path] = None,
+            dry_run: bool = False,
+    ) -> Optional[BulkOpReport]:
+        ws = self.get_current_workspace()
+        if ws is None:
+            return None
+        with self.__maintenance.busy():
+            return self.__bulk_ops.run(ws, operation, rank_filter, destination=destination, dry_run=dry_run)
+
+    def get_interrupted_bulk_operations(self) -> List[Path]:
+        return self.__bulk_ops.interrupted_runs()
+
+    def resume_bulk_operation(self, journal: Path) -> BulkOpReport:
+        with self.__maintenance.busy():
+            return self.__bulk_ops.resume(journal)
+
+    def rollback_bulk_operation(self, journal: Path) -> BulkOpReport:
+        with self.__maintenance.busy():
+            return self.__bulk_ops.rollback(journal)
+
+    # EXPORT #
+
+    def export_archive(
+            self,
+            rank_filter: RankFilter,
+            output: Path | str,
+            archive_format: Optional['ArchiveFormat'] = None,
+            compression_level: Optional[int] = None,
+    ) -> Optional['ExportReport']:
+        ws = self.get_current_workspace()
+        if ws is None:
+            return None
+        if self.__archive_exporter is None:
+            from app.export import ArchiveExporter
+            self.__archive_exporter = ArchiveExporter(self.__repo)
+        with self.__maintenance.busy():
+            return self.__archive_exporter.export(
+                ws, rank_filter, output, archive_format=archive_format, compression_level=compression_level,
+            )
+
+    def publish_images(
+            self,
+            rank_filter: RankFilter,
+            destination: Path,
+            settings: 'PublishSettings',
+    ) -> Optional['PublishReport']:
+        ws = self.get_current_workspace()
+        if ws is None:
+            return None
+        if self.__publisher is None:
+            from app.publish import Publisher
+            self.__publisher = Publisher(self.__repo)
+        with self.__maintenance.busy():
+            return self.__publisher.publish(ws, rank_filter, destination, settings)
+
+    # MAINTENANCE #
+
+    def run_maintenance(self) -> MaintenanceReport:
+        """
+        Runs a whole maintenance pass right away, e.g. from cron, rather than waiting for the application
+        to be left idle.
+        """
+        # the one started while idle, if any, stops at its next step
+        with self.__maintenance.busy():
+            return self.__maintenance.run()
+
+    def get_maintenance_report(self) -> Optional[MaintenanceReport]:
+        """
+        Report of the last maintenance pass, None if there was none yet.
+        """
+        return self.__maintenance.last_report
@@ -0,0 +1,184 @@
+import enum
+import logging
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from app.imaging import fit_within
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.utils import bounded_map, sizeof_fmt
+
+_log = logging.getLogger(__name__)
+
+
+class PublishFormat(enum.Enum):
+    JPEG = "jpeg"
+    WEBP = "webp"
+    PNG = "png"
+
+    @property
+    def extension(self) -> str:
+        return ".jpg" if self is PublishFormat.JPEG else f".{self.value}"
+
+
+@dataclass(frozen=True)
+class PublishSettings:
+    format: PublishFormat
+    max_edge: Optional[int] = None  # keep the original size if not set
+    quality: int = 90
+
+
+@dataclass(frozen=True)
+class PublishReport:
+    images: int
+    skipped: int
+    failed: int
+    bytes_in: int
+    bytes_out: int
+    elapsed: timedelta
+
+    @property
+    def images_per_sec(self) -> float:
+        seconds = self.elapsed.total_seconds()
+        return self.images / seconds if seconds > 0 else 0.0
+
+    @property
+    def bytes_saved(self) -> int:
+        return self.bytes_in - self.bytes_out
+
+    def __str__(self) -> str:
+        return f"{self.images} images published in {self.elapsed} ({self.images_per_sec:.1f} images/sec), " \
+               f"{sizeof_fmt(self.bytes_in)} -> {sizeof_fmt(self.bytes_out)}, saved {sizeof_fmt(self.bytes_saved)}, " \
+               f"skipped: {self.skipped}, failed: {self.failed}"
+
+
+class _Status(enum.Enum):
+    DONE = "done"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+
+def _publish_one(job: Tuple[str, str, PublishSettings]) -> Tuple[_Status, int, int]:
+    """
+    Runs in a worker process. Returns the status, source and output sizes.
+    """
+    import PIL.Image
+    import PIL.ImageOps
+    src, dst, settings = job
+    try:
+        src_stat = os.stat(src)
+        try:
+            if os.stat(dst).st_mtime_ns >= src_stat.st_mtime_ns:
+                return _Status.SKIPPED, 0, 0
+        except FileNotFoundError:
+            pass
+
+        with PIL.Image.open(src) as img:
+            if settings.max_edge is not None:
+                fit_within(img, (settings.max_edge, settings.max_edge), resample=PIL.Image.Resampling.LANCZOS)
+            img = PIL.ImageOps.exif_transpose(img)
+            if settings.format is PublishFormat.JPEG and img.mode != "RGB":
+                img = img.convert("RGB")
+            elif settings.format is not PublishFormat.JPEG and img.mode not in ("RGB", "RGBA", "L", "LA"):
+                img = img.convert("RGBA")
+
+            Path(dst).parent.mkdir(parents=True, exist_ok=True)
+            tmp = f"{dst}.{os.getpid()}.part"
+            try:
+                if settings.format is PublishFormat.JPEG:
+                    img.save(tmp, "JPEG", quality=settings.quality, optimize=True, progressive=True)
+                elif settings.format is PublishFormat.WEBP:
+                    img.save(tmp, "WEBP", quality=settings.quality, method=4)
+                else:
+                    img.save(tmp, "PNG", optimize=True)
+                os.replace(tmp, dst)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        return _Status.DONE, src_stat.st_size, os.stat(dst).st_size
+    except (OSError, ValueError, PIL.UnidentifiedImageError, PIL.Image.DecompressionBombError) as e:
+        # ValueError of modes and palettes a format can't save; anything escaping fails the whole publish
+        _log.error(f"Couldn't publish {src}: {e}")
+        return _Status.FAILED, 0, 0
+
+
+def _targets(sources: List[Path], ws_root: Path, destination: Path, extension: str) -> List[Tuple[Path, Path]]:
+    """
+    Output of each source image. Images differing by the extension only, e.g. a.png and a.jpg, would be
+    published to the same file, they keep the extension of the source in the name instead: a.png.jpg, a.jpg.jpg.
+    """
+    def target(src: Path) -> Path:
+        relative = src.relative_to(ws_root) if src.is_relative_to(ws_root) else Path(src.name)
+        return destination.joinpath(relative)
+
+    # sources by output
+    outputs: Dict[str, int] = Counter(os.path.normcase(target(src).with_suffix(extension)) for src in sources)
+    targets = []
+    for src in sources:
+        dst = target(src)
+        if outputs[os.path.normcase(dst.with_suffix(extension))] > 1:
+            targets.append((src, dst.with_name(dst.name + extension)))
+        else:
+            targets.append((src, dst.with_suffix(extension)))
+    return targets
+
+
+class Publisher:
+    """
+    Resizes and re-encodes images matching a rank filter into a destination directory
+    on a process pool. Outputs newer than their source are kept as they are.
+    """
+    __repository: Repository
+    __workers: int
+
+    def __init__(self, repo: Repository, workers: Optional[int] = None):
+        self.__repository = repo
+        self.__workers = workers or os.cpu_count() or 1
+
+    def publish(self, ws: Workspace, rank_filter: RankFilter, destination: Path, settings: PublishSettings) -> PublishReport:
+        destination = destination.absolute()
+        ws_root = Path(ws.path)
+        if destination.is_relative_to(ws_root):
+            # the next refresh would index the outputs as new images
+            raise ValueError("Destination must be outside the workspace directory")
+        _log.info(f"Publishing images with rank {rank_filter} from {ws.name} to {destination}: {settings}")
+        targets = _targets(
+            [Path(img.path) for img in self.__repository.iter_images_by_rank(ws.id, rank_filter)],
+            ws_root, destination, settings.format.extension,
+        )
+
+        def jobs():
+            for src, dst in targets:
+                yield str(src), str(dst), settings
+
+        from concurrent.futures import ProcessPoolExecutor
+        images, skipped, failed, bytes_in, bytes_out = 0, 0, 0, 0, 0
+        t = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.__workers) as executor:
+            for job, future in bounded_map(executor, _publish_one, jobs(), window=self.__workers * 4):
+                status, size_in, size_out = future.result()
+                if status is _Status.DONE:
+                    images += 1
+                    bytes_in += size_in
+                    bytes_out += size_out
+                elif status is _Status.SKIPPED:
+                    skipped += 1
+                else:
+                    failed += 1
+
+        report = PublishReport(
+            images=images,
+            skipped=skipped,
+            failed=failed,
+            bytes_in=bytes_in,
+            bytes_out=bytes_out,
+            elapsed=timedelta(seconds=time.perf_counter() - t),
+        )
+        _log.info(f"Publishing done: {report}")
+        return report
@@ -0,0 +1,127 @@
+import heapq
+import json
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple, Iterator, Optional
+
+from app.model.workspace import Workspace
+
+_log = logging.getLogger(__name__)
+
+PHASE_WALK = "walk"
+PHASE_STAT = "stat"
+PHASE_DB_DIFF = "db diff"
+PHASE_THUMBNAIL_CACHE = "thumbnail cache"  # hashing the files and looking their thumbnails up
+PHASE_DECODE = "decode"
+PHASE_THUMBNAIL_ENCODE = "thumbnail encode"
+PHASE_DB_WRITE = "db write"
+
+_SLOWEST_FILES = 10
+_REPORTS_TO_KEEP = 50
+
+
+@dataclass
+class PhaseStats:
+    wall: float = 0.0  # seconds
+    cpu: float = 0.0  # seconds, process-wide
+    items: int = 0
+    bytes: int = 0
+
+    @property
+    def cpu_ratio(self) -> float:
+        """
+        Close to 1 (or above, with several threads busy) when CPU-bound, close to 0 when waiting for I/O.
+        """
+        return self.cpu / self.wall if self.wall > 0 else 0.0
+
+
+class RefreshReport:
+    """
+    Timings of a workspace refresh, split by phases. A phase can be entered many times,
+    e.g. once per file, the times add up.
+    """
+    workspace: Workspace
+    started_at: datetime
+    phases: Dict[str, PhaseStats]
+    files_found: int = 0
+    files_updated: int = 0
+    files_missing: int = 0
+    files_failed: int = 0
+    thumbnails_cached: int = 0  # files not decoded, their thumbnails were in the thumbnail cache
+    dirs_pruned: int = 0  # excluded by the scan rules, not listed
+    files_pruned: int = 0  # images excluded by the scan rules
+    __slowest_files: List[Tuple[float, str]]
+    __wall_start: float
+    __cpu_start: float
+    __wall_total: Optional[float] = None
+    __cpu_total: Optional[float] = None
+
+    def __init__(self, workspace: Workspace):
+        self.workspace = workspace
+        self.started_at = datetime.now()
+        self.phases = {}
+        self.__slowest_files = []
+        self.__wall_start = time.perf_counter()
+        self.__cpu_start = time.process_time()
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[PhaseStats]:
+        stats = self.phases.setdefault(name, PhaseStats())
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stats
+        finally:
+            stats.wall += time.perf_counter() - wall
+            stats.cpu += time.process_time() - cpu
+
+    def add_file_time(self, path: str, seconds: float):
+        if len(self.__slowest_files) < _SLOWEST_FILES:
+            heapq.heappush(self.__slowest_files, (seconds, path))
+        else:
+            heapq.heappushpop(self.__slowest_files, (seconds, path))
+
+    @property
+    def slowest_files(self) -> List[Tuple[str, float]]:
+        return [(p, s) for s, p in sorted(self.__slowest_files, reverse=True)]
+
+    def finish(self):
+        self.__wall_total = time.perf_counter() - self.__wall_start
+        self.__cpu_total = time.process_time() - self.__cpu_start
+
+    def to_json(self) -> dict:
+        return {
+            "workspace": {"id": self.workspace.id, "name": self.workspace.name, "path": self.workspace.path},
+            "started_at": self.started_at.isoformat(),
+            "wall": self.__wall_total,
+            "cpu": self.__cpu_total,
+            "files": {
+                "found": self.files_found,
+                "updated": self.files_updated,
+                "missing": self.files_missing,
+                "failed": self.files_failed,
+                "thumbnails_cached": self.thumbnails_cached,
+            },
+            "pruned": {"dirs": self.dirs_pruned, "files": self.files_pruned},
+            "phases": {name: {**asdict(p), "cpu_ratio": p.cpu_ratio} for name, p in self.phases.items()},
+            "slowest_files": [{"path": p, "seconds": s} for p, s in self.slowest_files],
+        }
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{name} {p.wall:.2f}s" for name, p in self.phases.items())
+        return f"refreshed {self.workspace.name} in {self.__wall_total or 0:.2f}s " \
+               f"(+{self.files_updated} -{self.files_missing} !{self.files_failed}): {phases}"
+
+    def write(self, reports_dir: Path) -> Path:
+        """
+        Writes the report as json, keeping only a limited number of the latest reports in the directory.
+        """
+        reports_dir.mkdir(parents=True, exist_ok=True)
+        path = reports_dir.joinpath(f"refresh-{self.started_at:%Y%m%d-%H%M%S-%f}-ws{self.workspace.id}.json")
+        path.write_text(json.dumps(self.to_json(), indent=2), encoding="utf8")
+        for old_report in sorted(reports_dir.glob("refresh-*.json"))[:-_REPORTS_TO_KEEP]:
+            old_report.unlink(missing_ok=True)
+        return path
@@ -1,67 +1,459 @@
+import functools
 import logging
+import time
+import os
+import shutil
 import sqlite3
+import sys
+import tempfile
+import threading
+import uuid
+from collections import Counter
+from dataclasses import replace
 from datetime import datetime
 from pathlib import Path
-from sqlite3 import Error, Connection
-from typing import List, Optional, Any, Tuple, Dict
+from sqlite3 import Error, Connection, Cursor, IntegrityError
+from typing import List, Optional, Any, Tuple, Dict, Iterable, Iterator, Set
 
+from app.db_connections import DbConnections, DbConnection, open_connections, attach_workspace, BUSY_TIMEOUT
+from app.db_stats import QueryStats, QueryStatsSnapshot, InstrumentedCursor
+from app.migrations import migrate, SCHEMA_VERSION, workspace_db_file, init_workspace_db, remove_workspace_db, \
+    thumbnail_cache_pack
 from app.model.image_data import ImageData
+from app.model.rank_filter import RankFilter
+from app.model.scan_rules import ScanRules, DEFAULT_EXTENSIONS
 from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.thumbnail_pack import ThumbnailPack, thumbnail_key, PACK_SUFFIX
+from app.utils import datetime_to_ns, split_path, PATH_SEPARATORS
 
 _log = logging.getLogger(__name__)
 
+_MAX_QUERY_PARAMETERS = 500  # kept well below SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+_IMAGES_PAGE_SIZE = 1000  # images read at once by `iter_images_by_rank`
+# changes (write transactions) whose removed paths are kept, a process polling less often reloads the workspace
+_REMOVALS_KEPT = 10_000
+THUMBNAIL_CACHE_SIZE = 256 * 1024 * 1024  # bytes of thumbnails shared by the workspaces
+_CACHE_EVICTED_TO = 0.9  # of the size, so that not every next write evicts again
+VACUUM_STEP_PAGES = 256  # freed pages given back to the file system by a step of the incremental vacuum
+_AUTO_VACUUM_INCREMENTAL = 2  # `PRAGMA auto_vacuum` value
+_ANALYSIS_LIMIT = 400  # rows of an index `PRAGMA optimize` looks at, see https://sqlite.org/lang_analyze.html
+
+
+class _StatementCounter:
+    """
+    SQLite trace callback counting executed statements. It's a separate object so the connection
+    doesn't keep a reference to the repository.
+    """
+    count: int = 0
+
+    def __call__(self, _statement: str):
+        self.count += 1
+
+
+def _reading(method):
+    """
+    Runs the method with a connection from the reader pool, `_cursor` and `_connection` use it.
+    """
+    @functools.wraps(method)
+    def wrapper(self: 'Repository', *args, **kwargs):
+        if self._bound_connection() is not None:  # called by another repository method
+            return method(self, *args, **kwargs)
+        with self._connections.read() as connection:
+            return self._bound(connection, method, *args, **kwargs)
+    return wrapper
+
+
+def _writing(method):
+    """
+    Runs the method on the writer connection (on the writer thread) and waits for the result.
+    """
+    @functools.wraps(method)
+    def wrapper(self: 'Repository', *args, **kwargs):
+        def job(connection: Connection):
+            self._local.change_seq = None  # of a previous attempt rolled back
+            return self._bound(connection, method, *args, **kwargs)
+        return self._connections.write(job)
+    return wrapper
+
 
 class Repository:
-    __connection: Connection = None
+    """
+    Thread-safe: writes are serialized on a single writer connection, reads use a pool of read-only
+    connections and never wait for writes, see `app.db_connections`.
+
+    Several processes may share the database. Every write changing images or workspaces increments
+    a change counter and stamps the rows with it, see `get_changes_since`.
 
-    def __init__(self, db_file: Path):
+    Images of every workspace are in a database of their own, created on first use and attached as `ws`
+    to the connection of a query that needs it, see `_attach`. Their thumbnails are in a pack file next to it,
+    see `app.thumbnail_pack`.
+
+    Thumbnails made of image files are also kept in a cache shared by all the workspaces, by the content hash
+    of the file, see `get_cached_thumbnail`. An entry counts the images using it; when the cache outgrows its
+    size, entries no image uses are evicted first, the least recently used first. Counts are updated along
+    with the images, but a workspace database and the main one don't commit atomically together, so after
+    a crash a count may be off, which only changes the order of eviction.
+    """
+    _connections: DbConnections
+    _local: threading.local  # the connection bound to the current thread
+    __statement_counter: _StatementCounter
+    __query_stats: Optional[QueryStats] = None
+    __query_time_before: float = 0.0  # seconds, of the instrumentation periods before the current one
+    # image paths are stored relative to the workspace root, see `_locate`
+    __workspace_roots: Dict[int, str]
+    # values of the change counter committed by this repository, replaced as a whole by the writer thread
+    __own_change_seqs: Set[int]
+    __db_file: Path
+    __busy_timeout: float
+    __memory_id: Optional[str]  # in-memory workspace databases are named after it
+    __workspace_dbs: Dict[int, str]  # file name or URI to attach, of the workspaces used so far
+    __workspace_dbs_lock: threading.Lock
+    __memory_dbs: Dict[int, Connection]  # an in-memory database lives as long as a connection to it
+    __thumbnail_packs: Dict[int, ThumbnailPack]
+    __memory_packs_dir: Optional[Path] = None  # a temporary directory for packs of in-memory workspaces
+    __thumbnail_cache_pack: Optional[ThumbnailPack] = None
+    __thumbnail_cache_size: int
+
+    def __init__(
+            self,
+            db_file: Path,
+            busy_timeout: float = BUSY_TIMEOUT,
+            thumbnail_cache_size: int = THUMBNAIL_CACHE_SIZE,
+    ):
+        self._local = threading.local()
+        self.__workspace_roots = {}
+        self.__own_change_seqs = set()
+        self.__db_file = db_file
+        self.__busy_timeout = busy_timeout
+        self.__memory_id = uuid.uuid4().hex if str(db_file) == ":memory:" else None
+        self.__workspace_dbs = {}
+        self.__workspace_dbs_lock = threading.Lock()
+        self.__memory_dbs = {}
+        self.__thumbnail_packs = {}
+        self.__thumbnail_cache_size = thumbnail_cache_size
+        self.__statement_counter = _StatementCounter()
+        counter = self.__statement_counter  # connections must not reference the repository
         try:
-            self.__connection = sqlite3.connect(db_file)
-            _log.debug(f"Using sqlite version {sqlite3.version}")
-            self._ensure_schema()
+            self._connections = open_connections(db_file, lambda c: c.set_trace_callback(counter), busy_timeout)
         except Error as e:
             _log.error("Couldn't connect to the database", exc_info=e)
             raise e
+        _log.debug(f"Using sqlite version {sqlite3.sqlite_version}")
+        try:
+            self._connections.write(migrate)
+        except Error as e:
+            _log.error("Couldn't set up the database schema", exc_info=e)
+            self.close()
+            raise e
 
     def __del__(self):
-        if self.__connection is not None:
-            self.__connection.close()
-            del self.__connection
+        self.close()
+
+    def close(self):
+        connections = getattr(self, "_connections", None)
+        if connections is not None:
+            connections.close()
+        for connection in getattr(self, "_Repository__memory_dbs", {}).values():
+            connection.close()
+        if self.__memory_packs_dir is not None:
+            shutil.rmtree(self.__memory_packs_dir, ignore_errors=True)
+            self.__memory_packs_dir = None
+
+    @property
+    def statements_executed(self) -> int:
+        """
+        Total number of SQL statements executed so far, for monitoring.
+        """
+        return self.__statement_counter.count
+
+    def enable_instrumentation(self, slow_query_threshold: Optional[float] = None):
+        """
+        Starts collecting per statement timings and rows, statements slower than the threshold (seconds)
+        are logged with their query plan. It adds some overhead to every query, so it's off by default.
+        """
+        if self.__query_stats is None:
+            self.__query_stats = QueryStats(slow_query_threshold)
+        else:
+            self.__query_stats.slow_query_threshold = slow_query_threshold
+        _log.info(f"Query instrumentation enabled, slow query threshold: {slow_query_threshold}")
+
+    def disable_instrumentation(self):
+        stats = self.__query_stats
+        if stats is not None:
+            self.__query_time_before += stats.total_time
+        self.__query_stats = None
+
+    def query_stats(self) -> Optional[QueryStatsSnapshot]:
+        return self.__query_stats.snapshot() if self.__query_stats is not None else None
+
+    @property
+    def query_time_total(self) -> float:
+        """
+        Total time spent in SQLite while instrumentation was enabled, over all the times it was. It never
+        decreases, it doesn't grow while instrumentation is disabled.
+        """
+        stats = self.__query_stats
+        return self.__query_time_before + (stats.total_time if stats is not None else 0.0)
+
+    def _bound_connection(self) -> Optional[Connection]:
+        return getattr(self._local, "connection", None)
+
+    def _bound(self, connection: Connection, method, *args, **kwargs):
+        previous = self._bound_connection()
+        self._local.connection = connection
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._local.connection = previous
+
+    def _connection(self) -> Connection:
+        connection = self._bound_connection()
+        assert connection is not None, "not called from a @_reading or @_writing method"
+        return connection
+
+    def _cursor(self, connection: Optional[Connection] = None) -> Cursor:
+        connection = connection or self._connection()
+        stats = self.__query_stats
+        if stats is None:
+            return connection.cursor()
+        return connection.cursor(lambda c: InstrumentedCursor(c, stats))
+
+    def _commit(self):
+        stats = self.__query_stats
+        t = time.perf_counter()
+        self._connection().commit()
+        if stats is not None:
+            stats.record_commit(time.perf_counter() - t)
+        change_seq = getattr(self._local, "change_seq", None)
+        if change_seq is not None:
+            self._local.change_seq = None
+            own = self.__own_change_seqs
+            if len(own) >= _REMOVALS_KEPT:
+                own = {seq for seq in own if seq > change_seq - _REMOVALS_KEPT}
+            own.add(change_seq)
+            self.__own_change_seqs = own
+
+    @staticmethod
+    def _workspace_to_row(obj: Workspace) -> Tuple[Any, ...]:
+        last_used_ns = datetime_to_ns(obj.last_used_at) if obj.last_used_at is not None else None
+        return obj.id, obj.name, obj.path, last_used_ns
+
+    @staticmethod
+    def _image_to_row(
+            obj: ImageData,
+            location: Tuple[int, bool, str, str],
+            change_seq: int,
+            key: Optional[bytes],
+    ) -> Tuple[Any, ...]:
+        return *location, obj.size, datetime_to_ns(obj.last_updated_at), obj.width, obj.height, obj.rank, \
+            key, obj.source_key, change_seq
 
-    def _ensure_schema(self):
-        _log.debug("Ensuring schema is initialized")
-        cur = self.__connection.cursor()
-        cur.execute("PRAGMA foreign_keys = ON;")
+    def _next_change_seq(self) -> int:
+        """
+        Increments the change counter, starting the write transaction, returns the value to stamp rows with.
+        """
+        cur = self._cursor()
         try:
-            cur.executescript(SQL_CREATE_WORKSPACE_TABLE)
-            cur.executescript(SQL_CREATE_IMAGE_TABLE)
-            cur.connection.commit()
+            cur.execute("UPDATE change_counter SET seq = seq + 1")
+            cur.execute("SELECT seq FROM change_counter")
+            self._local.change_seq = cur.fetchone()[0]  # it's this repository's once committed
+            return self._local.change_seq
         finally:
             cur.close()
 
     @staticmethod
-    def _dataclass_to_upsert_query(table_name: str, obj: Any) -> Tuple[str, Tuple[Any]]:
-        # Convert the dataclass object to a dictionary
-        workspace_dict = vars(obj)
+    def _record_removals(cur: Cursor, change_seq: int, workspace_id: int, paths: Iterable[str]):
+        cur.executemany(
+            "INSERT INTO ws.image_removal (seq, workspace_id, path) VALUES (?, ?, ?)",
+            ((change_seq, workspace_id, path) for path in paths),
+        )
+        pruned_seq = change_seq - _REMOVALS_KEPT
+        if pruned_seq > 0:
+            cur.execute("DELETE FROM ws.image_removal WHERE seq <= ?", (pruned_seq,))
+            cur.execute("UPDATE change_counter SET pruned_seq = ?", (pruned_seq,))
+
+    def _workspace_root(self, workspace_id: int) -> Optional[str]:
+        root = self.__workspace_roots.get(workspace_id)
+        if root is None:
+            cur = self._cursor()
+            try:
+                cur.execute("SELECT path FROM workspace WHERE id=?", (workspace_id,))
+                row = cur.fetchone()
+            finally:
+                cur.close()
+            if row is None:
+                return None
+            root = self.__workspace_roots[workspace_id] = row[0]
+        return root
+
+    def _workspace_db(self, workspace_id: int) -> Optional[str]:
+        """
+        Database of the workspace to attach, it's created if it doesn't exist yet. None for unknown workspaces.
+        """
+        database = self.__workspace_dbs.get(workspace_id)
+        if database is not None:
+            return database
+        if self._workspace_root(workspace_id) is None:
+            return None
+        with self.__workspace_dbs_lock:
+            database = self.__workspace_dbs.get(workspace_id)
+            if database is None:
+                database = self.__workspace_dbs[workspace_id] = self.__open_workspace_db(workspace_id)
+        return database
+
+    def __open_workspace_db(self, workspace_id: int) -> str:
+        if self.__memory_id is not None:
+            database = f"file:picreview-{self.__memory_id}-{workspace_id}?mode=memory&cache=shared"
+            connection = sqlite3.connect(database, uri=True, check_same_thread=False)
+            init_workspace_db(connection)
+            self.__memory_dbs[workspace_id] = connection
+            return database
+        ws_file = workspace_db_file(self.__db_file, workspace_id)
+        ws_file.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(ws_file, timeout=self.__busy_timeout)
+        try:
+            init_workspace_db(connection)  # another process may be creating it too, migrations take the lock
+        finally:
+            connection.close()
+        return str(ws_file)
+
+    def _attach(self, workspace_id: int) -> bool:
+        """
+        Attaches the workspace database as `ws` to the current connection, unless it's attached already.
+        Must be called before the transaction starts. False if there's no such workspace.
+        """
+        connection: DbConnection = self._connection()
+        if connection.workspace_id == workspace_id:
+            return True
+        database = self._workspace_db(workspace_id)
+        if database is None:
+            return False
+        attach_workspace(connection, workspace_id, database)
+        return True
+
+    def _drop_workspace_db(self, workspace_id: int):
+        """
+        Removes the database of a workspace removed from the catalog.
+        """
+        self.__workspace_roots.pop(workspace_id, None)
+        self.__workspace_dbs.pop(workspace_id, None)
+        self._connections.detach_workspace(workspace_id)
+        pack = self.__thumbnail_packs.pop(workspace_id, None)
+        memory_db = self.__memory_dbs.pop(workspace_id, None)
+        if memory_db is not None:
+            memory_db.close()
+            if pack is not None:
+                pack.remove_generations()
+        elif self.__memory_id is None:
+            try:
+                remove_workspace_db(workspace_db_file(self.__db_file, workspace_id))
+            except OSError as e:  # still open by a reader or another process on Windows
+                _log.warning(f"Couldn't remove database of workspace {workspace_id}: {e}")
+
+    def _thumbnail_pack(self, workspace_id: int) -> ThumbnailPack:
+        pack = self.__thumbnail_packs.get(workspace_id)
+        if pack is None:
+            with self.__workspace_dbs_lock:
+                pack = self.__thumbnail_packs.get(workspace_id)
+                if pack is None:
+                    pack = self.__thumbnail_packs[workspace_id] = self.__open_thumbnail_pack(workspace_id)
+        return pack
+
+    def __open_thumbnail_pack(self, workspace_id: int) -> ThumbnailPack:
+        if self.__memory_id is None:
+            return ThumbnailPack.for_database(workspace_db_file(self.__db_file, workspace_id))
+        return ThumbnailPack(self.__memory_packs(), str(workspace_id))
+
+    def _cache_pack(self) -> ThumbnailPack:
+        if self.__thumbnail_cache_pack is None:
+            with self.__workspace_dbs_lock:
+                if self.__thumbnail_cache_pack is None:
+                    self.__thumbnail_cache_pack = thumbnail_cache_pack(self.__db_file) \
+                        if self.__memory_id is None else ThumbnailPack(self.__memory_packs(), "cache")
+        return self.__thumbnail_cache_pack
+
+    def __memory_packs(self) -> Path:
+        if self.__memory_packs_dir is None:
+            self.__memory_packs_dir = Path(tempfile.mkdtemp(prefix="picreview-"))
+        return self.__memory_packs_dir
+
+    def _store_thumbnails(
+            self,
+            cur: Cursor,
+            workspace_id: int,
+            thumbnails: List[Optional[bytes]],
+    ) -> List[Optional[bytes]]:
+        """
+        Appends the thumbnails missing from the pack of the workspace, within the write transaction,
+        returns their keys (None for None).
+        """
+        keys = [thumbnail_key(t) if t is not None else None for t in thumbnails]
+        new = {key: thumbnail for key, thumbnail in zip(keys, thumbnails) if key is not None}
+        stored = list(new)
+        for i in range(0, len(stored), _MAX_QUERY_PARAMETERS):
+            chunk = stored[i:i + _MAX_QUERY_PARAMETERS]
+            cur.execute(f"SELECT key FROM ws.thumbnail WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for key, in cur:
+                del new[key]
+        if new:
+            cur.execute("SELECT generation FROM ws.thumbnail_pack")
+            generation = cur.fetchone()[0]
+            # a rolled back transaction leaves them in the pack as dead space, see `compact_thumbnails`
+            offsets = self._thumbnail_pack(workspace_id).append(generation, new.values())
+            cur.executemany(
+                "INSERT INTO ws.thumbnail (key, offset, length) VALUES (?, ?, ?)",
+                ((key, offset, len(thumbnail)) for (key, thumbnail), offset in zip(new.items(), offsets)),
+            )
+        return keys
+
+    def _fetch_images(self, cur: Cursor, workspace_id: int) -> List[ImageData]:
+        """
+        Images of the rows selected by `SQL_SELECT_IMAGES`, with thumbnails copied from the pack.
+        """
+        pack = self._thumbnail_pack(workspace_id)
+        images = []
+        for row in cur:
+            image = ImageData.row_factory(cur, row)
+            offset, length, generation = row[-3:]
+            thumbnail = pack.view(generation, offset, length) if offset is not None else None
+            images.append(replace(image, thumbnail=bytes(thumbnail)) if thumbnail is not None else image)
+        return images
+
+    def _locate(self, workspace_id: int, path: str) -> Tuple[int, bool, str, str]:
+        """
+        Where the image is stored: (workspace id, relative, directory, name), parameters of `_WHERE_IMAGE`.
+        """
+        relative, directory, name = split_path(path, self._workspace_root(workspace_id))
+        return workspace_id, relative, directory, name
+
+    @staticmethod
+    def _ensure_directories(cur: Cursor, locations: Iterable[Tuple[int, bool, str, str]]):
+        cur.executemany(SQL_INSERT_DIRECTORY, {location[:3] for location in locations})
 
-        column_names = ', '.join(workspace_dict.keys())
-        placeholders = ', '.join('?' * len(workspace_dict))
-        query = f"INSERT OR REPLACE INTO {table_name} ({column_names}) VALUES ({placeholders})"
-        return query, tuple(workspace_dict.values())
+    @staticmethod
+    def _rm_empty_directories(cur: Cursor, workspace_id: int):
+        cur.execute(
+            "DELETE FROM ws.directory WHERE workspace_id=?"
+            " AND NOT EXISTS (SELECT 1 FROM ws.image_data WHERE directory_id=directory.id)",
+            (workspace_id,),
+        )
 
     # WORKSPACE #
 
+    @_reading
     def get_all_workspaces(self) -> List[Workspace]:
-        cur = self.__connection.cursor()
+        cur = self._cursor()
         cur.row_factory = Workspace.row_factory
         try:
-            cur.execute("SELECT * FROM workspace ORDER BY last_used_at DESC, name ASC")
+            cur.execute("SELECT * FROM workspace ORDER BY last_used_ns DESC, name ASC")
             return cur.fetchall()
         finally:
             cur.close()
 
+    @_reading
     def get_workspace(self, id_pk: int) -> Optional[Workspace]:
-        cur = self.__connection.cursor()
+        cur = self._cursor()
         cur.row_factory = Workspace.row_factory
         try:
             cur.execute("SELECT * FROM workspace WHERE id=?", (id_pk,))
@@ -69,132 +461,956 @@ class Repository:
         finally:
             cur.close()
 
+    @_writing
     def persist_workspace(self, obj: Workspace) -> Workspace:
-        cur = self.__connection.cursor()
+        """
+        Inserts the workspace or updates it in place, keeping its images. A workspace with the same name
+        is replaced. Changing the path moves the workspace root, images within it follow.
+        """
+        # images of a workspace replaced release their cache entries, read before the transaction, which
+        # attaching the workspace databases can't be done within
+        released = {ws_id: self._workspace_source_keys(ws_id) for ws_id in self._workspace_ids_named(obj.name, obj.id)}
+        cur = self._cursor()
         cur.row_factory = Workspace.row_factory
         try:
-            query, values = self._dataclass_to_upsert_query("workspace", obj)
-            cur.execute(query, values)
-            cur.connection.commit()
+            row = self._workspace_to_row(obj)
+            change_seq = self._next_change_seq()
+            replaced = self._workspace_ids_named(obj.name, obj.id)
+            self._count_cache_references(cur, [], (key for ws_id in replaced for key in released.get(ws_id, [])))
+            updated = False
+            if obj.id is not None:
+                # not `INSERT OR REPLACE`, replacing the row would cascade delete the images;
+                # moving the root changes paths of all the images, other processes have to reload them
+                cur.execute(
+                    "UPDATE OR REPLACE workspace SET name=?, path=?, last_used_ns=?,"
+                    " change_seq=CASE WHEN path=? THEN change_seq ELSE ? END WHERE id=?",
+                    (*row[1:], obj.path, change_seq, obj.id),
+                )
+                updated = cur.rowcount > 0
+            if not updated:
+                cur.execute(SQL_UPSERT_WORKSPACE, (*row, change_seq))
+                if self.__memory_id is None:  # left by a workspace with this id whose removal failed
+                    remove_workspace_db(workspace_db_file(self.__db_file, cur.lastrowid))
+            self._commit()
+            self.__workspace_roots.pop(obj.id, None)
+            for ws_id in replaced:
+                self._drop_workspace_db(ws_id)
             # Retrieve the just inserted record
-            cur.execute("SELECT * FROM workspace WHERE rowid=?", (cur.lastrowid,))
+            cur.execute("SELECT * FROM workspace WHERE id=?", (obj.id if updated else cur.lastrowid,))
             return cur.fetchone()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    def _workspace_source_keys(self, workspace_id: int) -> List[bytes]:
+        """
+        Thumbnail cache keys of all the images of the workspace, one per image. Attaches its database.
+        """
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT source_key FROM ws.image_data WHERE source_key IS NOT NULL")
+            return [key for key, in cur]
+        finally:
+            cur.close()
+
+    def _workspace_ids_named(self, name: str, except_id: Optional[int]) -> List[int]:
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT id FROM workspace WHERE name=? AND id IS NOT ?", (name, except_id))
+            return [ws_id for ws_id, in cur]
         finally:
             cur.close()
 
+    @_writing
     def rm_workspace(self, id_pk: int):
-        cur = self.__connection.cursor()
+        """
+        Removes the workspace from the catalog and its images database.
+        """
+        released = self._workspace_source_keys(id_pk)
+        cur = self._cursor()
         try:
+            self._next_change_seq()
             cur.execute("DELETE FROM workspace WHERE id=?", (id_pk,))
-            cur.connection.commit()
+            if cur.rowcount > 0:
+                self._count_cache_references(cur, [], released)
+            self._commit()
+            self._drop_workspace_db(id_pk)
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    # WORKSPACE STATE #
+
+    @_reading
+    def get_current_image_path(self, workspace_id: int) -> Optional[str]:
+        """
+        Path of the image the workspace was showing last time, if any.
+        """
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT current_image_path FROM workspace_state WHERE workspace_id=?", (workspace_id,))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+        finally:
+            cur.close()
+
+    @_writing
+    def set_current_image_path(self, workspace_id: int, path: Optional[str]):
+        cur = self._cursor()
+        try:
+            cur.execute(
+                "INSERT INTO workspace_state (workspace_id, current_image_path) VALUES (?, ?)"
+                " ON CONFLICT (workspace_id) DO UPDATE SET current_image_path=excluded.current_image_path",
+                (workspace_id, path),
+            )
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    @_reading
+    def get_scan_rules(self, workspace_id: int) -> ScanRules:
+        """
+        Rules the workspace is scanned by, the defaults if none were set.
+        """
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT scan_patterns, image_extensions FROM workspace_state WHERE workspace_id=?",
+                        (workspace_id,))
+            row = cur.fetchone()
+            if row is None:
+                return ScanRules()
+            patterns, extensions = row
+            return ScanRules(
+                patterns=patterns or "",
+                extensions=tuple(extensions.split()) if extensions is not None else DEFAULT_EXTENSIONS,
+            )
+        finally:
+            cur.close()
+
+    @_writing
+    def set_scan_rules(self, workspace_id: int, rules: ScanRules):
+        cur = self._cursor()
+        try:
+            cur.execute(
+                "INSERT INTO workspace_state (workspace_id, scan_patterns, image_extensions) VALUES (?, ?, ?)"
+                " ON CONFLICT (workspace_id) DO UPDATE"
+                " SET scan_patterns=excluded.scan_patterns, image_extensions=excluded.image_extensions",
+                (workspace_id, rules.patterns or None,
+                 " ".join(rules.extensions) if rules.extensions != DEFAULT_EXTENSIONS else None),
+            )
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
         finally:
             cur.close()
 
     # IMAGE DATA #
 
+    @_reading
     def get_all_images_for_workspace(self, workspace_id: int) -> List[ImageData]:
-        cur = self.__connection.cursor()
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
+        try:
+            cur.execute(f"{SQL_SELECT_IMAGES} WHERE d.workspace_id=? ORDER BY path ASC", (workspace_id,))
+            return self._fetch_images(cur, workspace_id)
+        finally:
+            cur.close()
+
+    @_reading
+    def get_image_index(self, workspace_id: int) -> List[ImageData]:
+        """
+        Returns all images of the workspace ordered by path, without thumbnails, see `get_thumbnails`.
+        """
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
         cur.row_factory = ImageData.row_factory
         try:
-            # * performance optimization opportunity: don't load thumbs when not needed
-            query = "SELECT * FROM image_data WHERE workspace_id=? ORDER BY workspace_id ASC, path ASC"
-            cur.execute(query, (workspace_id,))
+            cur.execute(f"{SQL_SELECT_IMAGE_METADATA} WHERE d.workspace_id=? ORDER BY path ASC", (workspace_id,))
             return cur.fetchall()
         finally:
             cur.close()
 
-    def get_image(self, workspace_id: int, path: str) -> Optional[ImageData]:
-        cur = self.__connection.cursor()
+    @_reading
+    def get_directory_image_index(self, workspace_id: int, directory: str) -> List[ImageData]:
+        """
+        Returns images directly in the directory ordered by path, without thumbnails. It's a range scan
+        of the directory's images, the rest of the workspace is not read.
+        """
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
         cur.row_factory = ImageData.row_factory
         try:
-            cur.execute("SELECT * FROM image_data WHERE workspace_id=? AND path=?", (workspace_id, path))
-            return cur.fetchone()
+            location = self._locate(workspace_id, os.path.join(directory, ""))
+            cur.execute(f"{SQL_SELECT_IMAGE_METADATA} WHERE i.directory_id={_DIRECTORY_ID} ORDER BY i.name ASC",
+                        location[:3])
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    @_reading
+    def get_thumbnails(
+            self,
+            workspace_id: int,
+            paths: List[str],
+            previews: bool = False,
+    ) -> Dict[str, Optional[memoryview]]:
+        """
+        Returns thumbnails of the given images keyed by path, unknown paths are left out. Thumbnails are
+        read-only views of the mapped pack file, not copies. With `previews` the previews of the images
+        that have them are returned instead, see `persist_previews`.
+        """
+        if not self._attach(workspace_id):
+            return {}
+        cur = self._cursor()
+        try:
+            pack = self._thumbnail_pack(workspace_id)
+            rows = self._select_by_paths(
+                cur, workspace_id, paths, f"t.offset, t.length, {_PACK_GENERATION}",
+                " LEFT JOIN ws.thumbnail t ON t.key = "
+                + ("IFNULL(i.preview_key, i.thumbnail_key)" if previews else "i.thumbnail_key"),
+            )
+            return {
+                path: pack.view(generation, offset, length) if offset is not None else None
+                for path, offset, length, generation in rows
+            }
+        finally:
+            cur.close()
+
+    def _select_by_paths(
+            self,
+            cur: Cursor,
+            workspace_id: int,
+            paths: Iterable[str],
+            columns: str,
+            joins: str = "",
+    ) -> Iterator[Tuple[Any, ...]]:
+        """
+        Selects the columns of the images (`i`) at the paths, a directory and a chunk of names per query,
+        yields (path, *columns) of the ones that exist.
+        """
+        by_directory: Dict[Tuple[int, bool, str], Dict[str, str]] = {}
+        for path in paths:
+            location = self._locate(workspace_id, path)
+            by_directory.setdefault(location[:3], {})[location[3]] = path
+        for directory, paths_by_name in by_directory.items():
+            names = list(paths_by_name)
+            for i in range(0, len(names), _MAX_QUERY_PARAMETERS):
+                chunk = names[i:i + _MAX_QUERY_PARAMETERS]
+                cur.execute(
+                    f"SELECT i.name, {columns} FROM ws.image_data i{joins}"
+                    f" WHERE i.directory_id={_DIRECTORY_ID} AND i.name IN ({', '.join('?' * len(chunk))})",
+                    (*directory, *chunk),
+                )
+                for name, *values in cur.fetchall():
+                    yield paths_by_name[name], *values
+
+    @_reading
+    def get_image(self, workspace_id: int, path: str) -> Optional[ImageData]:
+        if not self._attach(workspace_id):
+            return None
+        cur = self._cursor()
+        try:
+            location = self._locate(workspace_id, path)
+            cur.execute(f"{SQL_SELECT_IMAGES} WHERE i.directory_id={_DIRECTORY_ID} AND i.name=?", location)
+            return next(iter(self._fetch_images(cur, workspace_id)), None)
         finally:
             cur.close()
 
+    @_reading
     def is_image_outdated(self, workspace_id: int, path: str, last_updated_at: datetime) -> bool:
-        cur = self.__connection.cursor()
-        cur.row_factory = ImageData.row_factory
+        if not self._attach(workspace_id):
+            return True
+        cur = self._cursor()
         try:
-            query = "SELECT * FROM image_data WHERE workspace_id=? AND path=? AND last_updated_at >= ?"
-            cur.execute(query, (workspace_id, path, last_updated_at))
+            location = self._locate(workspace_id, path)
+            query = f"SELECT 1 FROM ws.image_data WHERE {_WHERE_IMAGE} AND last_updated_ns >= ?"
+            cur.execute(query, (*location, datetime_to_ns(last_updated_at)))
             return cur.fetchone() is None
         finally:
             cur.close()
 
+    @_reading
+    def get_image_states(self, workspace_id: int) -> Dict[str, Tuple[int, int]]:
+        """
+        Returns last update time (nanoseconds, with microsecond precision) and rank of every image
+        in the workspace keyed by path, without reading the rest.
+        """
+        if not self._attach(workspace_id):
+            return {}
+        cur = self._cursor()
+        try:
+            cur.execute(
+                f"SELECT {_IMAGE_PATH}, i.last_updated_ns, i.rank FROM {_IMAGES_JOIN} WHERE d.workspace_id=?",
+                (workspace_id,),
+            )
+            return {path: (updated_ns, rank) for path, updated_ns, rank in cur}
+        finally:
+            cur.close()
+
+    @_writing
     def persist_image(self, obj: ImageData) -> ImageData:
-        cur = self.__connection.cursor()
-        cur.row_factory = ImageData.row_factory
+        if not self._attach(obj.workspace_id):
+            raise IntegrityError(f"Workspace {obj.workspace_id} does not exist")
+        cur = self._cursor()
         try:
-            query, values = self._dataclass_to_upsert_query("image_data", obj)
-            cur.execute(query, values)
-            cur.connection.commit()
+            location = self._locate(obj.workspace_id, obj.path)
+            change_seq = self._next_change_seq()
+            key, = self._store_thumbnails(cur, obj.workspace_id, [obj.thumbnail])
+            compact_cache = self._cache_image_thumbnails(cur, [obj])
+            self._ensure_directories(cur, [location])
+            cur.execute(SQL_UPSERT_IMAGE, self._image_to_row(obj, location, change_seq, key))
+            self._commit()
             # Retrieve the just inserted record
-            cur.execute("SELECT * FROM image_data WHERE rowid=?", (cur.lastrowid,))
-            return cur.fetchone()
+            cur.execute(f"{SQL_SELECT_IMAGES} WHERE i.directory_id={_DIRECTORY_ID} AND i.name=?", location)
+            image = self._fetch_images(cur, obj.workspace_id)[0]
+        except Error:
+            self._connection().rollback()
+            raise
         finally:
             cur.close()
+        if compact_cache:
+            self.compact_thumbnail_cache()
+        return image
 
+    @_writing
     def rm_image(self, workspace_id: int, path: str):
-        cur = self.__connection.cursor()
+        self.rm_images(workspace_id, [path])
+
+    def get_images_by_rank(self, workspace_id: int, rank_filter: RankFilter) -> List[ImageData]:
+        """
+        Returns images of the workspace with rank within the filter, without thumbnails.
+        """
+        return list(self.iter_images_by_rank(workspace_id, rank_filter))
+
+    def iter_images_by_rank(self, workspace_id: int, rank_filter: RankFilter) -> Iterator[ImageData]:
+        """
+        Same as `get_images_by_rank`, but fetches rows a page at a time, so memory does not depend on the
+        selection size. No read transaction is held between the pages, however slowly they are consumed, it
+        would keep the WAL from being checkpointed.
+        """
+        after: Optional[str] = None
+        while True:
+            page = self._get_images_by_rank_page(workspace_id, rank_filter, after)
+            yield from page
+            if len(page) < _IMAGES_PAGE_SIZE:
+                return
+            after = page[-1].path
+
+    @_reading
+    def _get_images_by_rank_page(
+            self,
+            workspace_id: int,
+            rank_filter: RankFilter,
+            after: Optional[str],
+    ) -> List[ImageData]:
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
+        cur.row_factory = ImageData.row_factory
+        try:
+            query = f"{SQL_SELECT_IMAGE_METADATA} WHERE d.workspace_id=? AND i.rank >= ? AND i.rank <= ?" \
+                    f" AND {_IMAGE_PATH} > ? ORDER BY path ASC LIMIT ?"
+            min_rank = rank_filter.min_rank if rank_filter.min_rank is not None else -sys.maxsize
+            max_rank = rank_filter.max_rank if rank_filter.max_rank is not None else sys.maxsize
+            cur.execute(query, (workspace_id, min_rank, max_rank, after or "", _IMAGES_PAGE_SIZE))
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    @_writing
+    def persist_images(self, objs: Iterable[ImageData], keep_ranks: bool = False):
+        """
+        Upserts all the images, of a single workspace, in a single transaction. With `keep_ranks` images
+        already in the workspace keep the rank they have, e.g. set by the user while a refresh read the files.
+        """
+        objs = list(objs)
+        workspace_ids = {obj.workspace_id for obj in objs}
+        if not workspace_ids:
+            return
+        if len(workspace_ids) > 1:
+            raise ValueError(f"Images of several workspaces: {workspace_ids}")
+        workspace_id, = workspace_ids
+        if not self._attach(workspace_id):
+            raise IntegrityError(f"Workspace {workspace_id} does not exist")
+        cur = self._cursor()
+        try:
+            locations = [(obj, self._locate(obj.workspace_id, obj.path)) for obj in objs]
+            change_seq = self._next_change_seq()
+            keys = self._store_thumbnails(cur, workspace_id, [obj.thumbnail for obj in objs])
+            compact_cache = self._cache_image_thumbnails(cur, objs)
+            rows = [self._image_to_row(obj, location, change_seq, key)
+                    for (obj, location), key in zip(locations, keys)]
+            self._ensure_directories(cur, (row[:4] for row in rows))
+            cur.executemany(SQL_UPSERT_IMAGE_KEEPING_RANK if keep_ranks else SQL_UPSERT_IMAGE, rows)
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+        if compact_cache:
+            self.compact_thumbnail_cache()
+
+    @_reading
+    def get_images_without_previews(self, workspace_id: int) -> List[ImageData]:
+        """
+        Returns images of the workspace missing a preview or the thumbnail ordered by path, without thumbnails.
+        """
+        if not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
+        cur.row_factory = ImageData.row_factory
+        try:
+            cur.execute(
+                f"{SQL_SELECT_IMAGE_METADATA} WHERE d.workspace_id=?"
+                " AND (i.preview_key IS NULL OR i.thumbnail_key IS NULL) ORDER BY path ASC",
+                (workspace_id,),
+            )
+            return cur.fetchall()
+        finally:
+            cur.close()
+
+    @_writing
+    def persist_previews(self, workspace_id: int, images: List[ImageData], previews: List[bytes]) -> List[str]:
+        """
+        Stores previews of the images, and their thumbnails where they have none, in a single transaction.
+        Images changed since they were read (by `last_updated_at`) are left alone, their previews are outdated.
+        Returns paths of the images updated.
+        """
+        if not images or not self._attach(workspace_id):
+            return []
+        cur = self._cursor()
+        try:
+            change_seq = self._next_change_seq()
+            without_thumbnails = {path for path, key in self._select_by_paths(
+                cur, workspace_id, (i.path for i in images), "i.thumbnail_key") if key is None}
+            thumbnail_keys = self._store_thumbnails(
+                cur, workspace_id, [i.thumbnail if i.path in without_thumbnails else None for i in images])
+            preview_keys = self._store_thumbnails(cur, workspace_id, previews)
+            updated = []
+            for image, thumbnail_key, preview_key in zip(images, thumbnail_keys, preview_keys):
+                cur.execute(
+                    "UPDATE ws.image_data SET thumbnail_key=IFNULL(thumbnail_key, ?), preview_key=?, change_seq=?"
+                    f" WHERE {_WHERE_IMAGE} AND last_updated_ns=?",
+                    (thumbnail_key, preview_key, change_seq, *self._locate(workspace_id, image.path),
+                     datetime_to_ns(image.last_updated_at)),
+                )
+                if cur.rowcount:
+                    updated.append(image.path)
+            self._commit()
+            return updated
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    @_writing
+    def rm_images(self, workspace_id: int, paths: Iterable[str]):
+        """
+        Deletes all the images in a single transaction.
+        """
+        if not self._attach(workspace_id):
+            return
+        cur = self._cursor()
+        try:
+            paths = list(paths)
+            locations = [self._locate(workspace_id, p) for p in paths]
+            change_seq = self._next_change_seq()
+            released = [key for _path, key in self._select_by_paths(cur, workspace_id, paths, "i.source_key")]
+            cur.executemany(f"DELETE FROM ws.image_data WHERE {_WHERE_IMAGE}", locations)
+            self._count_cache_references(cur, [], released)
+            self._record_removals(cur, change_seq, workspace_id, paths)
+            self._rm_empty_directories(cur, workspace_id)
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    @_writing
+    def move_images(self, workspace_id: int, moves: Iterable[Tuple[str, str]]):
+        """
+        Changes paths of the images in a single transaction, moves are (old path, new path) pairs.
+        """
+        if not self._attach(workspace_id):
+            return
+        cur = self._cursor()
+        try:
+            moves = list(moves)
+            locations = [(self._locate(workspace_id, old), self._locate(workspace_id, new)) for old, new in moves]
+            change_seq = self._next_change_seq()
+            sources = {old for old, _new in moves}
+            replaced = self._select_by_paths(
+                cur, workspace_id, (new for _old, new in moves if new not in sources), "i.source_key",
+            )
+            self._count_cache_references(cur, [], [key for _path, key in replaced])  # by `UPDATE OR REPLACE`
+            self._ensure_directories(cur, (new for _old, new in locations))
+            cur.executemany(
+                f"UPDATE OR REPLACE ws.image_data SET directory_id={_DIRECTORY_ID}, name=?, change_seq=?"
+                f" WHERE {_WHERE_IMAGE}",
+                ((*new, change_seq, *old) for old, new in locations),
+            )
+            self._record_removals(cur, change_seq, workspace_id, (old for old, _new in moves))
+            self._rm_empty_directories(cur, workspace_id)
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+
+    @_writing
+    def compact_thumbnails(self, workspace_id: int) -> int:
+        """
+        Drops thumbnails no image refers to any more and rewrites the pack of the workspace without them and
+        without the space left by rolled back writes. Returns the number of bytes reclaimed.
+        """
+        if not self._attach(workspace_id):
+            return 0
+        pack = self._thumbnail_pack(workspace_id)
+        cur = self._cursor()
+        try:
+            cur.execute(f"DELETE FROM ws.thumbnail WHERE key NOT IN ({_USED_THUMBNAIL_KEYS})")
+            cur.execute("SELECT generation FROM ws.thumbnail_pack")
+            generation = cur.fetchone()[0]
+            cur.execute("SELECT SUM(length) FROM ws.thumbnail")
+            size = pack.size(generation)
+            if size == (cur.fetchone()[0] or 0):
+                self._commit()
+                return 0
+            missing = self._rewrite_pack(cur, pack, "ws.thumbnail", generation)
+            if missing:  # their images get no thumbnail, rather than a wrong one
+                _log.warning(f"{len(missing)} thumbnails of workspace {workspace_id} are missing from the pack")
+                cur.executemany("UPDATE ws.image_data SET thumbnail_key=NULL WHERE thumbnail_key=?", missing)
+                cur.executemany("UPDATE ws.image_data SET preview_key=NULL WHERE preview_key=?", missing)
+                cur.executemany("DELETE FROM ws.thumbnail WHERE key=?", missing)
+            cur.execute("UPDATE ws.thumbnail_pack SET generation=?", (generation + 1,))
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+        pack.remove_generations(keep=generation + 1)
+        reclaimed = size - pack.size(generation + 1)
+        _log.info(f"Compacted thumbnails of workspace {workspace_id}, reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    @_writing
+    def compact_thumbnail_cache(self) -> int:
+        """
+        Rewrites the pack of the thumbnail cache without the space of evicted thumbnails. Returns the number
+        of bytes reclaimed.
+        """
+        pack = self._cache_pack()
+        cur = self._cursor()
+        try:
+            cur.execute("UPDATE thumbnail_cache_pack SET generation = generation + 1")  # takes the write lock
+            cur.execute("SELECT generation - 1, size FROM thumbnail_cache_pack")
+            generation, live = cur.fetchone()
+            size = pack.size(generation)
+            if size == live:
+                self._connection().rollback()
+                return 0
+            missing = self._rewrite_pack(cur, pack, "thumbnail_cache", generation)
+            if missing:
+                _log.warning(f"{len(missing)} cached thumbnails are missing from the pack")
+                cur.executemany("DELETE FROM thumbnail_cache WHERE key=?", missing)
+                cur.execute(
+                    "UPDATE thumbnail_cache_pack SET size = (SELECT IFNULL(SUM(length), 0) FROM thumbnail_cache)"
+                )
+            self._commit()
+        except Error:
+            self._connection().rollback()
+            raise
+        finally:
+            cur.close()
+        pack.remove_generations(keep=generation + 1)
+        reclaimed = size - pack.size(generation + 1)
+        _log.info(f"Compacted the thumbnail cache, reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    @staticmethod
+    def _rewrite_pack(cur: Cursor, pack: ThumbnailPack, table: str, generation: int) -> List[Tuple[bytes]]:
+        """
+        Copies the thumbnails in the index table to the next generation of the pack and points the table
+        to the copies. Returns keys of the thumbnails missing from the pack file, as parameters.
+        """
+        cur.execute(f"SELECT key, offset, length FROM {table} ORDER BY offset")
+        live = cur.fetchall()
+        offsets = pack.compact(generation, [(offset, length) for _key, offset, length in live])
+        cur.executemany(
+            f"UPDATE {table} SET offset=? WHERE key=?",
+            ((offset, key) for (key, _offset, _length), offset in zip(live, offsets) if offset is not None),
+        )
+        return [(key,) for (key, _offset, _length), offset in zip(live, offsets) if offset is None]
+
+    @_reading
+    def get_cached_thumbnail(self, source_key: bytes) -> Optional[Tuple[bytes, int, int]]:
+        """
+        Returns the cached thumbnail with the size of the image it was made of, (thumbnail, width, height),
+        by `ImageData.thumbnail_source_key` of the image file. Images persisted with the key and a thumbnail
+        add it to the cache.
+        """
+        cur = self._cursor()
+        try:
+            cur.execute(
+                "SELECT offset, length, width, height, (SELECT generation FROM thumbnail_cache_pack)"
+                " FROM thumbnail_cache WHERE key=?",
+                (source_key,),
+            )
+            row = cur.fetchone()
+        finally:
+            cur.close()
+        if row is None:
+            return None
+        offset, length, width, height, generation = row
+        thumbnail = self._cache_pack().view(generation, offset, length)
+        return (bytes(thumbnail), width, height) if thumbnail is not None else None
+
+    def _cache_thumbnails(self, cur: Cursor, objs: List[ImageData]):
+        """
+        Adds the thumbnails of images with a source key, which are not in the thumbnail cache yet, to it.
+        """
+        new = {obj.source_key: obj for obj in objs if obj.source_key is not None and obj.thumbnail is not None}
+        keys = list(new)
+        for i in range(0, len(keys), _MAX_QUERY_PARAMETERS):
+            chunk = keys[i:i + _MAX_QUERY_PARAMETERS]
+            cur.execute(f"SELECT key FROM thumbnail_cache WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            for key, in cur:
+                del new[key]
+        if not new:
+            return
+        cur.execute("SELECT generation FROM thumbnail_cache_pack")
+        generation = cur.fetchone()[0]
+        offsets = self._cache_pack().append(generation, (obj.thumbnail for obj in new.values()))
+        now_ns = time.time_ns()
+        cur.executemany(
+            "INSERT INTO thumbnail_cache (key, offset, length, width, height, refs, used_ns)"
+            " VALUES (?, ?, ?, ?, ?, 0, ?)",
+            ((key, offset, len(obj.thumbnail), obj.width, obj.height, now_ns)
+             for (key, obj), offset in zip(new.items(), offsets)),
+        )
+        cur.execute("UPDATE thumbnail_cache_pack SET size = size + ?", (sum(len(o.thumbnail) for o in new.values()),))
+
+    @staticmethod
+    def _count_cache_references(cur: Cursor, added: Iterable[Optional[bytes]], released: Iterable[Optional[bytes]]):
+        """
+        Updates counts of the images using cache entries: source keys of images added and of the ones replaced
+        or removed.
+        """
+        counts = Counter(key for key in added if key is not None)
+        counts.subtract(key for key in released if key is not None)
+        changed = [(count, count, time.time_ns(), key) for key, count in counts.items() if count != 0]
+        if changed:
+            cur.executemany(
+                "UPDATE thumbnail_cache SET refs = refs + ?, used_ns = CASE WHEN ? > 0 THEN ? ELSE used_ns END"
+                " WHERE key=?",
+                changed,
+            )
+
+    def _cache_image_thumbnails(self, cur: Cursor, objs: List[ImageData]) -> bool:
+        """
+        Caches thumbnails of the images about to be upserted and updates counts of the images using them.
+        True if the cache pack has got worth compacting, once the transaction is committed.
+        """
+        paths = (obj.path for obj in objs)
+        released = [key for _path, key in self._select_by_paths(cur, objs[0].workspace_id, paths, "i.source_key")]
+        self._cache_thumbnails(cur, objs)
+        self._count_cache_references(cur, (obj.source_key for obj in objs), released)
+        return self._evict_cached_thumbnails(cur)
+
+    def _evict_cached_thumbnails(self, cur: Cursor) -> bool:
+        """
+        Evicts thumbnails from the cache while it's over its size, the ones no image uses first, the least
+        recently used first. True if the cache pack has got worth compacting.
+        """
+        cur.execute("SELECT generation, size FROM thumbnail_cache_pack")
+        generation, size = cur.fetchone()
+        if size > self.__thumbnail_cache_size:
+            target = int(self.__thumbnail_cache_size * _CACHE_EVICTED_TO)
+            evicted = []
+            cur.execute("SELECT key, length FROM thumbnail_cache ORDER BY refs > 0, used_ns")
+            while size > target and (row := cur.fetchone()) is not None:
+                evicted.append(row[:1])
+                size -= row[1]
+            cur.executemany("DELETE FROM thumbnail_cache WHERE key=?", evicted)
+            cur.execute("UPDATE thumbnail_cache_pack SET size=?", (size,))
+            _log.debug(f"Evicted {len(evicted)} thumbnails from the cache")
+        return self._cache_pack().size(generation) > 2 * self.__thumbnail_cache_size
+
+    @_reading
+    def get_change_seq(self) -> int:
+        """
+        Current value of the change counter, cheap to poll for changes made by other processes.
+        """
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT seq FROM change_counter")
+            return cur.fetchone()[0]
+        finally:
+            cur.close()
+
+    @_reading
+    def get_changes_since(self, workspace_id: int, change_seq: int) -> Tuple[int, Optional[WorkspaceChange]]:
+        """
+        Returns the current change counter and what other processes did to the workspace images after
+        `change_seq`: added or updated images (without thumbnails) and paths of removed ones. Changes written
+        by this repository are left out. The change is None if it can't be told and the whole workspace has
+        to be reloaded: it was removed, its root was moved (by anyone), or the removals are already forgotten.
+        """
+        cur = self._cursor()
         try:
-            cur.execute("DELETE FROM image_data WHERE workspace_id=? AND path=?", (workspace_id, path))
-            cur.connection.commit()
+            # the counter first, whatever gets committed after it is reported again by the next call
+            cur.execute("SELECT seq, pruned_seq FROM change_counter")
+            current_seq, pruned_seq = cur.fetchone()
+            if current_seq == change_seq:
+                return current_seq, WorkspaceChange(workspace_id, [], [])
+            cur.execute("SELECT change_seq FROM workspace WHERE id=?", (workspace_id,))
+            row = cur.fetchone()
+            if row is None or row[0] > change_seq or change_seq < pruned_seq:
+                self.__workspace_roots.pop(workspace_id, None)  # may have been changed by another process
+                if row is None:
+                    self.__workspace_dbs.pop(workspace_id, None)
+                return current_seq, None
+            if not self._attach(workspace_id):
+                return current_seq, None
+
+            own = self.__own_change_seqs
+            cur.execute(
+                "SELECT seq, path FROM ws.image_removal WHERE seq > ? AND workspace_id=?", (change_seq, workspace_id),
+            )
+            removed = list(dict.fromkeys(path for seq, path in cur if seq not in own))
+            # `+` keeps the planner on the change index, not scanning the workspace directory by directory
+            cur.execute(
+                f"{SQL_SELECT_CHANGED_IMAGES} WHERE i.change_seq > ? AND +d.workspace_id=? ORDER BY path ASC",
+                (change_seq, workspace_id),
+            )
+            updated, existing = [], set()
+            for row in cur:
+                image = ImageData.row_factory(cur, row)
+                existing.add(image.path)  # removed and added again
+                if row[-1] not in own:
+                    updated.append(image)
+            return current_seq, WorkspaceChange(workspace_id, updated, [p for p in removed if p not in existing])
         finally:
             cur.close()
 
+    @_reading
     def get_image_rank_histogram(self, workspace_id: int) -> Dict[int, int]:
         """
         Returns counts of images in every rank in the workspace (key is rank, value is count).
         """
-        cur = self.__connection.cursor()
+        if not self._attach(workspace_id):
+            return {}
+        cur = self._cursor()
         try:
             cur.execute(
-                "SELECT rank, COUNT(*) as count FROM image_data WHERE workspace_id=? GROUP BY rank ORDER BY rank ASC",
+                "SELECT rank, COUNT(*) as count FROM ws.image_data i JOIN ws.directory d ON d.id = i.directory_id"
+                " WHERE d.workspace_id=? GROUP BY rank ORDER BY rank ASC",
                 (workspace_id,),
             )
             return dict(cur.fetchall())
         finally:
             cur.close()
 
+    # MAINTENANCE #
+
+    def _schema(self, workspace_id: Optional[int]) -> Optional[str]:
+        """
+        Schema of the workspace database, attaching it, of the main database for None. None for unknown workspaces.
+        """
+        if workspace_id is None:
+            return "main"
+        return "ws" if self._attach(workspace_id) else None
+
+    @staticmethod
+    def _pragma(cur: Cursor, schema: str, name: str) -> int:
+        cur.execute(f"PRAGMA {schema}.{name}")
+        return cur.fetchone()[0]
+
+    @_reading
+    def thumbnail_garbage(self, workspace_id: Optional[int] = None) -> int:
+        """
+        Bytes of the thumbnail pack of the workspace, of the thumbnail cache for None, taken by thumbnails
+        nothing uses any more, see `compact_thumbnails` and `compact_thumbnail_cache`.
+        """
+        cur = self._cursor()
+        try:
+            if workspace_id is None:
+                cur.execute("SELECT generation, size FROM thumbnail_cache_pack")
+                generation, live = cur.fetchone()
+                return max(self._cache_pack().size(generation) - live, 0)
+            if not self._attach(workspace_id):
+                return 0
+            cur.execute(
+                f"SELECT {_PACK_GENERATION}, IFNULL(SUM(length), 0) FROM ws.thumbnail"
+                f" WHERE key IN ({_USED_THUMBNAIL_KEYS})"
+            )
+            generation, live = cur.fetchone()
+            return max(self._thumbnail_pack(workspace_id).size(generation) - live, 0)
+        finally:
+            cur.close()
+
+    @_writing
+    def enable_incremental_vacuum(self, workspace_id: Optional[int] = None) -> Optional[int]:
+        """
+        Turns on incremental auto vacuum of a database created before it was on by default. That takes a full
+        VACUUM, rebuilding the database while other writes wait, once. Returns the bytes it reclaimed, None if
+        it was on already.
+        """
+        schema = self._schema(workspace_id)
+        if schema is None:
+            return None
+        cur = self._cursor()
+        try:
+            if self._pragma(cur, schema, "auto_vacuum") == _AUTO_VACUUM_INCREMENTAL:
+                return None
+            size = self._pragma(cur, schema, "page_count") * self._pragma(cur, schema, "page_size")
+            cur.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL")
+            cur.execute(f"VACUUM {schema}")
+            reclaimed = size - self._pragma(cur, schema, "page_count") * self._pragma(cur, schema, "page_size")
+        finally:
+            cur.close()
+        _log.info(f"Enabled incremental vacuum of the {schema} database, reclaimed {reclaimed} bytes")
+        return reclaimed
+
+    @_writing
+    def incremental_vacuum(self, workspace_id: Optional[int] = None, pages: int = VACUUM_STEP_PAGES) -> int:
+        """
+        Gives up to `pages` free pages of the database back to the file system, in a transaction short enough
+        not to keep other writes waiting. Returns the bytes reclaimed, 0 when there are no free pages left or
+        incremental vacuum is off, see `enable_incremental_vacuum`.
+        """
+        schema = self._schema(workspace_id)
+        if schema is None:
+            return 0
+        cur = self._cursor()
+        try:
+            free = self._pragma(cur, schema, "freelist_count")
+            if free == 0 or self._pragma(cur, schema, "auto_vacuum") != _AUTO_VACUUM_INCREMENTAL:
+                return 0
+            # a statement frees one page per step, a script runs it through
+            self._connection().executescript(f"PRAGMA {schema}.incremental_vacuum({pages})")
+            remaining = self._pragma(cur, schema, "freelist_count")
+            if remaining == 0:  # the file is truncated by the checkpoint, readers permitting
+                cur.execute(f"PRAGMA {schema}.wal_checkpoint(PASSIVE)")
+            return (free - remaining) * self._pragma(cur, schema, "page_size")
+        finally:
+            cur.close()
+
+    @_writing
+    def optimize(self, workspace_id: Optional[int] = None) -> bool:
+        """
+        Updates statistics of the query planner the statements run by the writer may benefit from, reading
+        a bounded number of rows of every index. False for unknown workspaces.
+        """
+        schema = self._schema(workspace_id)
+        if schema is None:
+            return False
+        cur = self._cursor()
+        try:
+            cur.execute(f"PRAGMA analysis_limit = {_ANALYSIS_LIMIT}")
+            cur.execute(f"PRAGMA {schema}.optimize")
+            return True
+        finally:
+            cur.close()
+
+    @_writing
+    def remove_orphan_files(self) -> Tuple[int, int]:
+        """
+        Removes databases and thumbnail packs of workspaces no longer in the catalog, and generations of packs
+        older than the current ones, left behind where removing them failed. Returns the number of files removed
+        and their bytes.
+        """
+        if self.__memory_id is not None:  # the packs are removed on close
+            return 0, 0
+        directory = workspace_db_file(self.__db_file, 0).parent
+        # listed before the catalog is read, files of a workspace are created after it's committed
+        by_owner: Dict[str, List[Path]] = {}
+        for file in directory.iterdir() if directory.is_dir() else []:
+            by_owner.setdefault(file.name.split(".", 1)[0], []).append(file)
+        cur = self._cursor()
+        try:
+            cur.execute("SELECT id FROM workspace")
+            workspace_ids = {ws_id for ws_id, in cur}
+            cur.execute("SELECT generation FROM thumbnail_cache_pack")
+            files, size = self._cache_pack().remove_older_generations(cur.fetchone()[0])
+        finally:
+            cur.close()
+        for owner, owned in by_owner.items():
+            if not owner.isdigit():
+                continue
+            ws_id = int(owner)
+            if ws_id not in workspace_ids:
+                _log.info(f"Removing files of workspace {ws_id}, which is no longer in the catalog")
+                sizes = {file: file.stat().st_size for file in owned if file.exists()}
+                self._drop_workspace_db(ws_id)
+                removed = [file for file in sizes if not file.exists()]
+                files, size = files + len(removed), size + sum(sizes[file] for file in removed)
+            elif sum(1 for file in owned if file.suffix == PACK_SUFFIX) > 1 and self._attach(ws_id):
+                cur = self._cursor()
+                try:
+                    cur.execute("SELECT generation FROM ws.thumbnail_pack")
+                    removed_files, removed_size = self._thumbnail_pack(ws_id).remove_older_generations(
+                        cur.fetchone()[0])
+                finally:
+                    cur.close()
+                files, size = files + removed_files, size + removed_size
+        return files, size
+
+
+SQL_UPSERT_WORKSPACE = "INSERT OR REPLACE INTO workspace (id, name, path, last_used_ns, change_seq)" \
+                       " VALUES (?, ?, ?, ?, ?)"
+
+# full path of an image, the inverse of `split_path`
+_IMAGE_PATH = f"CASE d.relative WHEN 1 THEN rtrim(w.path, '{PATH_SEPARATORS}') || '{os.sep}' || d.path" \
+              " ELSE d.path END || i.name"
+# `ws` is the attached workspace database, see `Repository._attach`
+_IMAGES_JOIN = "ws.image_data i JOIN ws.directory d ON d.id = i.directory_id" \
+               " JOIN main.workspace w ON w.id = d.workspace_id"
+_PACK_GENERATION = "(SELECT generation FROM ws.thumbnail_pack)"
+# keys of the thumbnails in the pack that images use, as thumbnails or previews
+_USED_THUMBNAIL_KEYS = "SELECT thumbnail_key FROM ws.image_data WHERE thumbnail_key IS NOT NULL" \
+                       " UNION ALL SELECT preview_key FROM ws.image_data WHERE preview_key IS NOT NULL"
+# columns in the order of `ImageData` fields, thumbnails are read from the pack, see `Repository._fetch_images`
+SQL_SELECT_IMAGE_METADATA = f"SELECT d.workspace_id AS workspace_id, {_IMAGE_PATH} AS path, i.size AS size," \
+                            " i.last_updated_ns AS last_updated_ns, i.width AS width, i.height AS height," \
+                            f" i.rank AS rank, NULL AS thumbnail FROM {_IMAGES_JOIN}"
+SQL_SELECT_IMAGES = SQL_SELECT_IMAGE_METADATA.replace(
+    "NULL AS thumbnail FROM",
+    "NULL AS thumbnail, t.offset AS thumbnail_offset, t.length AS thumbnail_length,"
+    f" {_PACK_GENERATION} AS thumbnail_generation FROM",
+) + " LEFT JOIN ws.thumbnail t ON t.key = i.thumbnail_key"
+SQL_SELECT_CHANGED_IMAGES = SQL_SELECT_IMAGE_METADATA.replace("NULL AS thumbnail",
+                                                              "NULL AS thumbnail, i.change_seq AS change_seq")
 
-SQL_CREATE_WORKSPACE_TABLE = """
-CREATE TABLE IF NOT EXISTS workspace (
-    id              integer PRIMARY KEY AUTOINCREMENT,
-    name            text    NOT NULL,
-    path            text    NOT NULL,
-    last_used_at    text
-);
-
-CREATE UNIQUE INDEX IF NOT EXISTS idx_workspace_name
-ON workspace(name);
-CREATE INDEX IF NOT EXISTS        idx_workspace_last_used_at
-ON workspace(last_used_at);
-"""
-
-SQL_CREATE_IMAGE_TABLE = """
-CREATE TABLE IF NOT EXISTS image_data (
-    workspace_id    integer NOT NULL,
-    path            text    NOT NULL,
-    
-    size            integer NOT NULL,
-    last_updated_at text    NOT NULL,
-    width           integer NOT NULL,
-    height          integer NOT NULL,
-    thumbnail       blob    NULL,
-    rank            integer DEFAULT 0 NOT NULL,
-    
-    PRIMARY KEY     (workspace_id, path),
-    CONSTRAINT      fk_workspace
-        FOREIGN KEY (workspace_id)
-        REFERENCES  workspace(id)
-        ON DELETE CASCADE
-);
-
-CREATE INDEX IF NOT EXISTS        idx_image_data_path
-ON image_data(path);
-CREATE INDEX IF NOT EXISTS        idx_image_data_last_updated_at
-ON image_data(last_updated_at);
-CREATE INDEX IF NOT EXISTS        idx_image_data_rank
-ON image_data(rank);
-"""
+# parameters: workspace id, relative, directory (and name) as returned by `Repository._locate`
+_DIRECTORY_ID = "(SELECT id FROM ws.directory WHERE workspace_id=? AND relative=? AND path=?)"
+_WHERE_IMAGE = f"directory_id={_DIRECTORY_ID} AND name=?"
+SQL_INSERT_DIRECTORY = "INSERT INTO ws.directory (workspace_id, relative, path) VALUES (?, ?, ?)" \
+                       " ON CONFLICT DO NOTHING"
+# the preview of an updated image is of the old file, it's made again in the background
+SQL_UPSERT_IMAGE = "INSERT INTO ws.image_data (directory_id, name, size, last_updated_ns, width, height, rank," \
+                   " thumbnail_key, source_key, change_seq)" \
+                   f" VALUES ({_DIRECTORY_ID}, ?, ?, ?, ?, ?, ?, ?, ?, ?)" \
+                   " ON CONFLICT (directory_id, name) DO UPDATE SET size=excluded.size," \
+                   " last_updated_ns=excluded.last_updated_ns, width=excluded.width, height=excluded.height," \
+                   " rank=excluded.rank, thumbnail_key=excluded.thumbnail_key, source_key=excluded.source_key," \
+                   " preview_key=NULL, change_seq=excluded.change_seq"
+SQL_UPSERT_IMAGE_KEEPING_RANK = SQL_UPSERT_IMAGE.replace(" rank=excluded.rank,", "")
@@ -0,0 +1,76 @@
+"""
+Row factories mapping SQLite rows to model objects.
+"""
+from operator import itemgetter
+from sqlite3 import Cursor
+from typing import Callable, Dict, Generic, Optional, Sequence, Tuple, TypeVar, Any
+
+T = TypeVar("T")
+
+
+class RowMapper(Generic[T]):
+    """
+    Row factory building objects by positional construction. Positions of the columns are resolved
+    once per statement (the cursor description changes with every executed statement), not per row,
+    so it doesn't matter whether the query selects `*` or the columns in some other order.
+
+        mapper = RowMapper(Workspace, ["id", "name", "path", "last_used_ns"], {"last_used_ns": ns_to_datetime})
+        cursor.row_factory = mapper
+    """
+    __factory: Callable[..., T]
+    __columns: Tuple[str, ...]
+    __converters: Dict[str, Callable[[Any], Any]]
+    # (description the positions were resolved for, row -> object), replaced as a whole, so it's thread-safe
+    __resolved: Tuple[Optional[tuple], Optional[Callable[[tuple], T]]] = (None, None)
+
+    def __init__(
+            self,
+            factory: Callable[..., T],
+            columns: Sequence[str],
+            converters: Optional[Dict[str, Callable[[Any], Any]]] = None,
+    ):
+        """
+        `columns` are the columns `factory` takes as positional arguments, in order. Converters are applied
+        to non-NULL values of the respective columns.
+        """
+        self.__factory = factory
+        self.__columns = tuple(columns)
+        self.__converters = dict(converters or {})
+        unknown = set(self.__converters) - set(self.__columns)
+        assert not unknown, f"converters for unknown columns: {unknown}"
+
+    def __call__(self, cursor: Cursor, row: tuple) -> T:
+        description, build = self.__resolved
+        if description is not cursor.description:
+            description, build = self.__resolve(cursor.description)
+        return build(row)
+
+    def __resolve(self, description: tuple) -> Tuple[tuple, Callable[[tuple], T]]:
+        positions = {column[0]: i for i, column in enumerate(description)}
+        missing = [c for c in self.__columns if c not in positions]
+        if missing:
+            raise KeyError(f"columns {missing} are not in the result ({', '.join(positions)})")
+
+        factory = self.__factory
+        indices = [positions[c] for c in self.__columns]
+        if indices == list(range(len(description))):
+            get_values = tuple  # row is already in the constructor order
+        else:
+            getter = itemgetter(*indices)
+            get_values = getter if len(indices) > 1 else lambda row: (getter(row),)
+        conversions = [(i, self.__converters[c]) for i, c in enumerate(self.__columns) if c in self.__converters]
+
+        if not conversions:
+            def build(row: tuple) -> T:
+                return factory(*get_values(row))
+        else:
+            def build(row: tuple) -> T:
+                values = list(get_values(row))
+                for i, convert in conversions:
+                    value = values[i]
+                    if value is not None:
+                        values[i] = convert(value)
+                return factory(*values)
+
+        self.__resolved = description, build
+        return self.__resolved
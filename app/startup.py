@@ -0,0 +1,49 @@
+import logging
+import sys
+import time
+from collections import Counter
+from typing import List, Tuple, Set
+
+_log = logging.getLogger(__name__)
+
+_TOP_PACKAGES = 5
+
+
+class StartupTimer:
+    """
+    Startup time breakdown: for every step the time since the previous one and the modules it imported,
+    a lightweight always-on alternative to `python -X importtime`.
+    """
+    __started_at: float
+    __last_mark_at: float
+    __modules: Set[str]
+    __steps: List[Tuple[str, float, int, List[str]]]  # name, seconds, modules imported, top packages imported
+
+    def __init__(self):
+        self.__started_at = self.__last_mark_at = time.perf_counter()
+        self.__modules = set(sys.modules)
+        self.__steps = []
+
+    def mark(self, step: str):
+        now = time.perf_counter()
+        modules = set(sys.modules)
+        imported = modules - self.__modules
+        packages = [p for p, _ in Counter(m.split(".")[0] for m in imported).most_common(_TOP_PACKAGES)]
+        self.__steps.append((step, now - self.__last_mark_at, len(imported), packages))
+        self.__last_mark_at = now
+        self.__modules = modules
+
+    @property
+    def elapsed(self) -> float:
+        return self.__last_mark_at - self.__started_at
+
+    def summary(self) -> str:
+        lines = [f"Startup took {self.elapsed * 1000:.0f} ms:"]
+        for step, seconds, modules, packages in self.__steps:
+            imported = f"{modules:>4} modules" + (f" ({', '.join(packages)})" if packages else "")
+            lines.append(f"    {step:<16} {seconds * 1000:8.1f} ms {imported}")
+        return "\n".join(lines)
+
+    def log(self, last_step: str):
+        self.mark(last_step)
+        _log.info(self.summary())
@@ -0,0 +1,178 @@
+"""
+Encoded thumbnails of a workspace are kept outside SQLite, in an append-only pack file next to the workspace
+database, and read through `mmap`: loading a screen of thumbnails hands out slices of the mapping, no blob
+is copied from database pages into `bytes`.
+
+The workspace database is the index of the pack: its `thumbnail` table maps the content hash of every
+thumbnail (`thumbnail_key`) to its offset and length in the file, so identical thumbnails are stored once,
+and images refer to thumbnails by the hash.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_log = logging.getLogger(__name__)
+
+PACK_SUFFIX = ".thumbs"
+
+
+def thumbnail_key(thumbnail: bytes) -> bytes:
+    """
+    Content address of an encoded thumbnail.
+    """
+    return hashlib.blake2b(thumbnail, digest_size=16).digest()
+
+
+class ThumbnailPack:
+    """
+    Thumbnails written one after another, without headers, to `<name>.<generation>.thumbs`. A file is only
+    appended to, by a writer holding the write lock of the workspace database, so processes sharing it don't
+    interleave their writes. Thumbnails no image refers to any more are dead space until a compaction copies
+    the live ones to the file of the next generation. Readers get the generation from the database along with
+    the offsets, in the same statement, so they never read offsets of one generation from the file of another.
+
+    Thread-safe. Slices handed out keep their mapping alive, a file grown by other writers is mapped again.
+    """
+    __directory: Path
+    __name: str
+    __views: Dict[int, memoryview]  # of the whole mapped file by generation, replaced when the file grows
+    __lock: threading.Lock
+
+    def __init__(self, directory: Path, name: str):
+        self.__directory = directory
+        self.__name = name
+        self.__views = {}
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def for_database(ws_file: Path) -> 'ThumbnailPack':
+        """
+        Pack of the workspace database file, next to it.
+        """
+        return ThumbnailPack(ws_file.parent, ws_file.stem)
+
+    def file(self, generation: int) -> Path:
+        return self.__directory.joinpath(f"{self.__name}.{generation}{PACK_SUFFIX}")
+
+    def size(self, generation: int) -> int:
+        return self.__size(self.file(generation))
+
+    @staticmethod
+    def __size(file: Path) -> int:
+        try:
+            return file.stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def append(self, generation: int, thumbnails: Iterable[bytes]) -> List[int]:
+        """
+        Appends the thumbnails to the file and returns their offsets. They are on disk before the offsets get
+        committed to the database, which may survive a power loss without them otherwise.
+        """
+        offsets = []
+        self.__directory.mkdir(parents=True, exist_ok=True)
+        with open(self.file(generation), "ab") as f:
+            offset = f.seek(0, os.SEEK_END)
+            for thumbnail in thumbnails:
+                offsets.append(offset)
+                offset += f.write(thumbnail)
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    def view(self, generation: int, offset: int, length: int) -> Optional[memoryview]:
+        """
+        The thumbnail as a slice of the mapped file, None if the file ends before it (lost by a crash).
+        """
+        view = self.__views.get(generation)
+        if view is None or offset + length > len(view):
+            view = self.__map(generation, offset + length)
+            if view is None:
+                return None
+        return view[offset:offset + length]
+
+    def __map(self, generation: int, min_size: int) -> Optional[memoryview]:
+        with self.__lock:
+            view = self.__views.get(generation)
+            if view is not None and min_size <= len(view):
+                return view  # mapped by another thread meanwhile
+            try:
+                with open(self.file(generation), "rb") as f:
+                    size = os.fstat(f.fileno()).st_size
+                    if size < min_size:
+                        _log.warning(f"Thumbnail pack {self.file(generation)} is shorter than its index ({size}"
+                                     f" < {min_size} bytes)")
+                        return None
+                    view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            except OSError as e:  # removed by a compaction in another process
+                _log.warning(f"Couldn't map thumbnail pack: {e}")
+                return None
+            # a newer generation replaces the older ones for good
+            self.__views = {g: v for g, v in self.__views.items() if g > generation}
+            self.__views[generation] = view
+            return view
+
+    def compact(self, generation: int, entries: List[Tuple[int, int]]) -> List[Optional[int]]:
+        """
+        Copies the thumbnails at the (offset, length) entries to a new file of the next generation, returns
+        their offsets there, None for the ones missing from the file.
+        """
+        offsets = []
+        target = self.file(generation + 1)
+        self.__directory.mkdir(parents=True, exist_ok=True)
+        with open(target, "wb") as f:  # overwrites one left by a compaction that failed to commit
+            for offset, length in entries:
+                thumbnail = self.view(generation, offset, length)
+                offsets.append(f.tell() if thumbnail is not None else None)
+                if thumbnail is not None:
+                    f.write(thumbnail)
+            f.flush()
+            os.fsync(f.fileno())
+        return offsets
+
+    def remove_generations(self, keep: Optional[int] = None):
+        """
+        Removes files of all the generations but `keep`, all of them if it's None.
+        """
+        with self.__lock:
+            self.__views = {g: v for g, v in self.__views.items() if g == keep}
+        for generation, file in self.__files():
+            if generation != keep:
+                self.__remove(file)
+
+    def remove_older_generations(self, generation: int) -> Tuple[int, int]:
+        """
+        Removes files of the generations before the given one, left by compactions whose removal failed.
+        Returns the number of files removed and their bytes. Files of later generations may be being written
+        by a compaction.
+        """
+        with self.__lock:
+            self.__views = {g: v for g, v in self.__views.items() if g >= generation}
+        files, removed = 0, 0
+        for older, file in self.__files():
+            if older < generation:
+                size = self.__size(file)
+                if self.__remove(file):
+                    files, removed = files + 1, removed + size
+        return files, removed
+
+    def __files(self) -> List[Tuple[int, Path]]:
+        files = []
+        for file in self.__directory.glob(f"{self.__name}.*{PACK_SUFFIX}"):
+            generation = file.name[len(self.__name) + 1:-len(PACK_SUFFIX)]
+            if generation.isdigit():
+                files.append((int(generation), file))
+        return files
+
+    @staticmethod
+    def __remove(file: Path) -> bool:
+        try:
+            file.unlink()
+            return True
+        except OSError as e:  # still mapped by another process on Windows
+            _log.warning(f"Couldn't remove thumbnail pack {file}: {e}")
+            return False
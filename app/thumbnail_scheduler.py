@@ -0,0 +1,100 @@
+"""
+Order in which a refresh makes thumbnails of new and updated images: the ones the user is looking at first.
+
+The navigator reports its focus, the current image and the first and last visible ones, whenever it changes.
+Pending images on the screen come first, nearest to the current one first, then the others outwards from it,
+on both sides in turn. A jump of the focus re-prioritizes every pending image at once: what was next to the
+old position is left for later, not made before the images at the new one.
+"""
+import bisect
+import threading
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+class ThumbnailScheduler:
+    """
+    Pending images, as scheduled by `schedule`, taken by `next`. Without a focus they are taken in path order.
+
+    Thread-safe: the GUI moves the focus while the refresh takes images.
+    """
+    __paths: List[str]  # sorted, as the navigator orders images
+    __done: bytearray  # by index in `__paths`
+    __remaining: int = 0
+    # the current and the first and last visible paths of the navigator
+    __focus: Optional[Tuple[str, str, str]] = None
+    __left: int = -1  # next index to look at before the focus, going down
+    __right: int = 0  # next index to look at from the focus, going up
+    __lock: threading.Lock
+
+    def __init__(self, focus: Optional[Tuple[str, str, str]] = None):
+        self.__paths = []
+        self.__done = bytearray()
+        self.__focus = focus
+        self.__lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.__remaining
+
+    def schedule(self, paths: List[Path]):
+        """
+        Replaces the pending images.
+        """
+        with self.__lock:
+            self.__paths = sorted(str(p) for p in paths)
+            self.__done = bytearray(len(self.__paths))
+            self.__remaining = len(self.__paths)
+            self.__reset_cursors()
+
+    def focus(self, current: str, first_visible: Optional[str] = None, last_visible: Optional[str] = None):
+        """
+        Moves the focus to the current image, with the range of visible images around it.
+        """
+        focus = (current, first_visible or current, last_visible or current)
+        with self.__lock:
+            if focus != self.__focus:
+                self.__focus = focus
+                self.__reset_cursors()
+
+    def next(self) -> Optional[Path]:
+        """
+        The pending image of the highest priority, None once there are none.
+        """
+        with self.__lock:
+            if self.__remaining == 0:
+                return None
+            paths, done = self.__paths, self.__done
+            while self.__left >= 0 and done[self.__left]:
+                self.__left -= 1
+            while self.__right < len(paths) and done[self.__right]:
+                self.__right += 1
+            i = self.__pick(self.__left, self.__right)
+            if i == self.__left:
+                self.__left -= 1
+            else:
+                self.__right += 1
+            done[i] = 1
+            self.__remaining -= 1
+            return Path(paths[i])
+
+    def __pick(self, left: int, right: int) -> int:
+        if left < 0:
+            return right
+        if right >= len(self.__paths) or self.__focus is None:
+            return left
+        current, first_visible, last_visible = self.__focus
+        left_visible = first_visible <= self.__paths[left] <= last_visible
+        right_visible = first_visible <= self.__paths[right] <= last_visible
+        if left_visible != right_visible:
+            return left if left_visible else right
+        # the one nearer the current image, so the sides take turns; the current one comes first
+        center = bisect.bisect_left(self.__paths, current)
+        return left if center - left <= right - center else right
+
+    def __reset_cursors(self):
+        # the images done are skipped by `next`, the cursors can start anywhere
+        if self.__focus is None:
+            self.__left, self.__right = -1, 0
+        else:
+            self.__right = bisect.bisect_left(self.__paths, self.__focus[0])
+            self.__left = self.__right - 1
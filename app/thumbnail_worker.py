@@ -0,0 +1,167 @@
+"""
+Previews, the larger level of thumbnails, are made in the background for the images of the current workspace,
+along with thumbnails images are missing (e.g. ones restored by a rollback of a bulk operation), so showing
+thumbnails big never waits for images to be decoded. A refresh drops the preview of an updated image, it's
+made again.
+
+The worker starts once the user leaves the application alone for a few seconds and stops between images as
+soon as the user is active again, or anything else runs in the background (see `Maintenance.busy`). It takes
+a share of one CPU core and reads image files at a limited rate, sleeping between images as long as needed.
+"""
+import logging
+import threading
+import time
+import weakref
+from dataclasses import replace
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Set
+
+from app.maintenance import Maintenance
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.repository import Repository
+
+_log = logging.getLogger(__name__)
+
+IDLE_AFTER = 3.0  # seconds without user activity
+CPU_SHARE = 0.25  # of one core
+READ_RATE = 16 * 1024 * 1024  # bytes of image files per second
+_BATCH_SIZE = 16  # images written at once
+_CHECK_INTERVAL = 1.0  # seconds
+
+
+class ThumbnailWorker:
+    """
+    Makes the previews on a thread of its own, see `start`, for the workspace `workspace` returns. Images
+    it's done with are reported to `on_change`.
+    """
+    __repo: Repository
+    __activity: Maintenance  # tells whether the user has been idle long enough
+    __workspace: Callable[[], Optional[Workspace]]
+    __on_change: Callable[[WorkspaceChange], None]
+    __idle_after: float
+    __cpu_share: float
+    __read_rate: float
+    # the DB change counter by workspace when all its images were done, they're looked at again after changes
+    __done_at: Dict[int, int]
+    __failed: Set[str]  # paths of images that couldn't be read, not retried
+    __running: bool = False  # a `run` is in progress
+    __stop: threading.Event
+    __wake: threading.Event  # ends a throttle sleep, set on stop and by the activity
+    __thread: Optional[threading.Thread] = None
+
+    def __init__(
+            self,
+            repo: Repository,
+            activity: Maintenance,
+            workspace: Callable[[], Optional[Workspace]],
+            on_change: Callable[[WorkspaceChange], None],
+            idle_after: float = IDLE_AFTER,
+            cpu_share: float = CPU_SHARE,
+            read_rate: float = READ_RATE,
+    ):
+        self.__repo = repo
+        self.__activity = activity
+        self.__workspace = workspace
+        self.__on_change = on_change
+        self.__idle_after = idle_after
+        self.__cpu_share = cpu_share
+        self.__read_rate = read_rate
+        self.__done_at = {}
+        self.__failed = set()
+        self.__stop = threading.Event()
+        self.__wake = threading.Event()
+        activity.wake_on_activity(self.__wake)
+
+    def __del__(self):
+        self.stop()
+
+    def start(self):
+        if self.__thread is None:
+            # the thread doesn't keep the owner alive, it ends once the owner is collected
+            self.__thread = threading.Thread(
+                target=ThumbnailWorker.__run_when_idle, args=(weakref.ref(self), self.__stop),
+                name="thumbnail-worker", daemon=True,
+            )
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stops the thread after the image in progress, if any.
+        """
+        self.__stop.set()
+        self.__wake.set()
+
+    def is_running(self) -> bool:
+        return self.__running
+
+    def is_idle(self) -> bool:
+        return self.__activity.is_idle(self.__idle_after)
+
+    @staticmethod
+    def __run_when_idle(ref: 'weakref.ref[ThumbnailWorker]', stop: threading.Event):
+        while not stop.wait(_CHECK_INTERVAL):
+            worker = ref()
+            if worker is None:
+                return
+            ws = worker.__workspace()
+            if ws is not None and worker.is_idle():
+                change_seq = worker.__repo.get_change_seq()
+                if worker.__done_at.get(ws.id) != change_seq:
+                    try:
+                        if worker.run(ws.id, cancel=lambda: stop.is_set() or not worker.is_idle()):
+                            worker.__done_at[ws.id] = change_seq
+                    except Exception as e:
+                        _log.error("Making previews failed", exc_info=e)
+            del worker
+
+    def run(self, workspace_id: int, cancel: Callable[[], bool] = lambda: False) -> bool:
+        """
+        Makes the previews of the workspace images missing them, checking `cancel` between images.
+        Returns False if cancelled.
+        """
+        import PIL.Image
+        images = [i for i in self.__repo.get_images_without_previews(workspace_id) if i.path not in self.__failed]
+        batch: List[ImageData] = []
+        previews: List[bytes] = []
+        complete = False
+        self.__running = True
+        try:
+            for image in images:
+                if cancel():
+                    break
+                started = time.perf_counter()
+                try:
+                    thumbnail, preview = ImageData.encode_preview(Path(image.path))
+                except (OSError, PIL.Image.DecompressionBombError) as e:
+                    _log.warning(f"Couldn't make preview of {image.path}: {e}")
+                    self.__failed.add(image.path)
+                    continue
+                batch.append(replace(image, thumbnail=thumbnail))
+                previews.append(preview)
+                if len(batch) >= _BATCH_SIZE:
+                    self.__write(workspace_id, batch, previews)
+                    batch, previews = [], []
+                self.__throttle(time.perf_counter() - started, image.size)
+            else:
+                complete = True
+        finally:
+            self.__running = False
+            self.__write(workspace_id, batch, previews)
+        return complete
+
+    def __write(self, workspace_id: int, images: List[ImageData], previews: List[bytes]):
+        updated = self.__repo.persist_previews(workspace_id, images, previews)
+        if updated:
+            _log.debug(f"Made {len(updated)} previews of workspace {workspace_id}")
+            self.__on_change(WorkspaceChange(workspace_id, [], [], thumbnails=updated))
+
+    def __throttle(self, work: float, bytes_read: int):
+        # sleeps for the CPU share, and for as long as reading the file should have taken at the rate,
+        # the user being back or a stop cuts the sleep short
+        delay = max(work * (1.0 - self.__cpu_share) / self.__cpu_share, bytes_read / self.__read_rate - work)
+        if delay > 0:
+            self.__wake.clear()
+            if not self.__stop.is_set():
+                self.__wake.wait(delay)
@@ -1,31 +1,51 @@
 import datetime
 import logging
 import os
-from dataclasses import dataclass, replace
+import threading
+from dataclasses import dataclass, replace, field
 from datetime import timedelta, datetime
+from io import BytesIO
 from pathlib import Path
-from time import time
-from typing import Optional, List, Set, Dict
+from time import time, perf_counter
+from typing import Optional, List, Dict, Callable
 
-from app.model.image_data import ImageData
+from app.bulk_ops import TRASH_DIR_NAME
+from app.imaging import fit_within
+from app.model.image_data import ImageData, THUMBNAIL_SIZE
+from app.model.scan_rules import ScanMatcher, ScanRules
 from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.refresh_report import RefreshReport, PHASE_WALK, PHASE_STAT, PHASE_DB_DIFF, PHASE_DECODE, \
+    PHASE_THUMBNAIL_ENCODE, PHASE_DB_WRITE, PHASE_THUMBNAIL_CACHE
 from app.repository import Repository
+from app.thumbnail_scheduler import ThumbnailScheduler
+from app.utils import ns_to_datetime
 
 _log = logging.getLogger(__name__)
+# how often a refresh watched through `on_change` writes images, however few, so thumbnails show up early
+_CHANGES_INTERVAL = 0.5  # seconds
+# files up to this size are read once, hashed for the thumbnail cache and decoded from memory; bigger ones are
+# read twice rather than held in memory
+_READ_ONCE_MAX_SIZE = 64 * 1024 * 1024  # bytes
 
 
 class WorkspaceManager:
     # todo: watch workspace path and update on changes
     __current_workspace: Optional[Workspace] = None
     __repository: Repository
+    __reports_dir: Optional[Path]
+    __db_batch_size: int
 
     @dataclass(frozen=True)
     class WorkspaceRescanDelta:
         files_missing: List[Path]
         files_updated: List[Path]
+        ranks: Dict[Path, int] = field(default_factory=dict)  # ranks of the updated images already in the DB
 
-    def __init__(self, repo: Repository):
+    def __init__(self, repo: Repository, reports_dir: Optional[Path] = None, db_batch_size: int = 500):
         self.__repository = repo
+        self.__reports_dir = reports_dir
+        self.__db_batch_size = db_batch_size
         _log.info("PicReview backend initialized")
 
     @property
@@ -60,61 +80,231 @@ class WorkspaceManager:
             self.refresh_current_workspace()
         return ws
 
+    def move_workspace_root(self, ws_id: int, path: Path) -> Optional[Workspace]:
+        """
+        Points the workspace to the directory its files were moved to. Images keep their ranks and thumbnails,
+        their paths are stored relative to the root, so it's a single row update.
+        """
+        ws = self.__repository.get_workspace(ws_id)
+        path = path.absolute()
+        if ws is None or not path.is_dir():
+            logging.warning(f"Can't move workspace {ws_id} to {path}")
+            return None
+        ws = self.__repository.persist_workspace(replace(ws, path=str(path)))
+        if self.__current_workspace is not None and self.__current_workspace.id == ws_id:
+            self.__current_workspace = ws
+        _log.info(f"Workspace {ws.name} moved to {path}")
+        return ws
+
     def rm_workspace(self, ws_id: int):
         if self.__current_workspace is not None and self.__current_workspace.id == ws_id:
             self.__current_workspace = None
         self.__repository.rm_workspace(ws_id)
 
-    def refresh_current_workspace(self):
-        if self.__current_workspace is None:
+    def refresh_current_workspace(
+            self,
+            progress: Optional[Callable[[int, int], None]] = None,
+            on_change: Optional[Callable[[WorkspaceChange], None]] = None,
+            cancel: Optional[threading.Event] = None,
+            scheduler: Optional[ThumbnailScheduler] = None,
+    ) -> Optional[RefreshReport]:
+        """
+        Brings the workspace images in the DB in line with the files, returns timings of the refresh phases.
+        The report is also written to the reports dir, if there is one.
+        `progress` is called with (images processed, images to process) after every updated image,
+        `on_change` with every batch of changes written to the DB. Setting `cancel` stops the refresh
+        after the current image, what has been written so far is kept. The `scheduler` orders the images
+        to read, they are read in path order without one.
+        The workspace which is current at the call is refreshed, even if another one is set meanwhile.
+        """
+        ws = self.__current_workspace
+        if ws is None:
             _log.info("No workspace - do nothing")
-            return
-        ws_id = self.__current_workspace.id
-        delta = self._rescan_current_workspace_and_get_delta()
+            return None
+        ws_id = ws.id
+        report = RefreshReport(ws)
+        delta = self._rescan_current_workspace_and_get_delta(report)
+        if delta is None:
+            return None
         _log.info(f"Scan results: -{len(delta.files_missing)} +{len(delta.files_updated)}")
 
-        for f in delta.files_updated:
-            img_data = ImageData.from_file(workspace_id=ws_id, path=f)
-            existing_image = self.__repository.get_image(ws_id, str(f))
-            if existing_image is not None:  # keep image rank if the image already existed in the workspace
-                img_data = replace(img_data, rank=existing_image.rank)
-            self.__repository.persist_image(img_data)
-        for f in delta.files_missing:
-            self.__repository.rm_image(workspace_id=ws_id, path=str(f))
+        scheduler = scheduler if scheduler is not None else ThumbnailScheduler()
+        scheduler.schedule(delta.files_updated)
+        unreadable: List[Path] = []
+        batch: List[ImageData] = []
+        images_read = 0
+        written_at = perf_counter()
+        for i in range(len(delta.files_updated)):
+            if cancel is not None and cancel.is_set():
+                _log.info(f"Refresh of {ws.name} cancelled")
+                break
+            f = scheduler.next()
+            img_data = self._read_image(ws_id, f, report)
+            if progress is not None:
+                progress(i + 1, len(delta.files_updated))
+            if img_data is None:
+                unreadable.append(f)
+                continue
+            # keep image rank if the image already existed in the workspace
+            batch.append(replace(img_data, rank=delta.ranks.get(f, 0)))
+            images_read += 1
+            if len(batch) >= self.__db_batch_size \
+                    or on_change is not None and perf_counter() - written_at >= _CHANGES_INTERVAL:
+                self._write_images(batch, report, on_change)
+                batch = []
+                written_at = perf_counter()
+        self._write_images(batch, report, on_change)
 
-    def _rescan_current_workspace_and_get_delta(self) -> Optional[WorkspaceRescanDelta]:
-        if self.__current_workspace is None:
+        to_remove = [str(f) for f in delta.files_missing] + [str(f) for f in unreadable if f in delta.ranks]
+        if to_remove:
+            with report.phase(PHASE_DB_WRITE) as phase:
+                self.__repository.rm_images(ws_id, to_remove)
+                phase.items += len(to_remove)
+            if on_change is not None:
+                on_change(WorkspaceChange(workspace_id=ws_id, updated=[], removed=to_remove))
+
+        report.files_updated = images_read
+        report.files_failed = len(unreadable)
+        report.finish()
+        _log.info(report.summary())
+        if self.__reports_dir is not None:
+            try:
+                _log.debug(f"Refresh report written to {report.write(self.__reports_dir)}")
+            except OSError as e:
+                _log.warning(f"Couldn't write refresh report: {e}")
+        return report
+
+    def _read_image(self, ws_id: int, path: Path, report: RefreshReport) -> Optional[ImageData]:
+        """
+        Reads size and thumbnail of the image, from the thumbnail cache if it has the file, which is then
+        not decoded. The file is read once, for both the cache key and the decoding.
+        """
+        import PIL.Image
+        t = perf_counter()
+        img: Optional[PIL.Image.Image] = None
+        try:
+            with report.phase(PHASE_THUMBNAIL_CACHE) as phase:
+                with open(path, "rb") as f:
+                    stats = os.fstat(f.fileno())
+                    data = f.read() if stats.st_size <= _READ_ONCE_MAX_SIZE else None
+                source_key = ImageData.thumbnail_source_key(data if data is not None else path)
+                cached = self.__repository.get_cached_thumbnail(source_key)
+                phase.items += 1
+                phase.bytes += stats.st_size
+            if cached is not None:
+                thumbnail, width, height = cached
+                report.thumbnails_cached += 1
+            else:
+                with report.phase(PHASE_DECODE) as phase:
+                    img = PIL.Image.open(BytesIO(data) if data is not None else path)
+                    width, height = img.size
+                    fit_within(img, (THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                    phase.items += 1
+                    phase.bytes += stats.st_size
+                with report.phase(PHASE_THUMBNAIL_ENCODE) as phase:
+                    thumbnail = ImageData.encode_thumbnail(img)
+                    phase.items += 1
+                    phase.bytes += len(thumbnail)
+        except (OSError, PIL.Image.DecompressionBombError) as e:
+            _log.warning(f"Image found but could not be read: {path}: {e}")
+            return None
+        finally:
+            if img is not None:
+                img.close()
+            report.add_file_time(str(path), perf_counter() - t)
+
+        return ImageData(
+            workspace_id=ws_id,
+            path=str(path),
+            size=stats.st_size,
+            last_updated_at=ns_to_datetime(stats.st_mtime_ns),
+            width=width,
+            height=height,
+            rank=0,
+            thumbnail=thumbnail,
+            source_key=source_key,
+        )
+
+    def _write_images(
+            self,
+            images: List[ImageData],
+            report: RefreshReport,
+            on_change: Optional[Callable[[WorkspaceChange], None]],
+    ):
+        if not images:
+            return
+        with report.phase(PHASE_DB_WRITE) as phase:
+            # the ranks read by the diff may be outdated by now
+            self.__repository.persist_images(images, keep_ranks=True)
+            phase.items += len(images)
+            phase.bytes += sum(len(i.thumbnail) for i in images)
+        if on_change is not None:
+            on_change(WorkspaceChange(workspace_id=images[0].workspace_id, updated=images, removed=[]))
+
+    def _rescan_current_workspace_and_get_delta(
+            self,
+            report: Optional[RefreshReport] = None,
+    ) -> Optional[WorkspaceRescanDelta]:
+        ws = report.workspace if report is not None else self.__current_workspace
+        if ws is None:
             _log.info("No workspace - no delta")
             return
-        ws_id = self.__current_workspace.id
-        image_paths_found: List[Path] = self._scan_current_workspace()
-        image_data_in_db: List[ImageData] = self.__repository.get_all_images_for_workspace(workspace_id=ws_id)
-        unprocessed_paths_in_workspace: Dict[Path, ImageData] = {
-            Path(i.path): i for i in image_data_in_db
-        }
-        updated_image_paths: Set[Path] = set()
-        for img_path in image_paths_found:
-            i = ImageData.from_file(img_path, ws_id, with_thumbnail=False)
-            if i is None:
-                _log.warning(f"Image found but could not be read: {img_path}")
-            elif self.__repository.is_image_outdated(ws_id, str(img_path), i.last_updated_at):
-                _log.info(f"Found updated image: {img_path}")
-                updated_image_paths.add(img_path)
-                unprocessed_paths_in_workspace.pop(img_path, None)
-            else:
-                _log.debug(f"Image {img_path} is up to date")
-                unprocessed_paths_in_workspace.pop(img_path, None)
+        ws_id = ws.id
+        report = report if report is not None else RefreshReport(ws)
 
+        with report.phase(PHASE_WALK) as phase:
+            matcher = self.__repository.get_scan_rules(ws_id).compile()
+            image_paths_found: Optional[List[Path]] = self._scan_workspace(ws, matcher, report)
+            if image_paths_found is None:
+                return None
+            phase.items = len(image_paths_found)
+
+        with report.phase(PHASE_STAT) as phase:
+            modified_at: Dict[Path, int] = {}  # ns, truncated to microseconds as stored in the DB
+            for img_path in image_paths_found:
+                try:
+                    modified_at[img_path] = img_path.stat().st_mtime_ns // 1000 * 1000
+                except OSError as e:
+                    _log.warning(f"Image found but could not be read: {img_path}: {e}")
+            phase.items = len(modified_at)
+
+        with report.phase(PHASE_DB_DIFF) as phase:
+            # path -> (last updated at, rank); what is left after the diff is missing from the workspace
+            unprocessed_images_in_db = self.__repository.get_image_states(workspace_id=ws_id)
+            phase.items = len(unprocessed_images_in_db)
+            updated_image_paths: List[Path] = []
+            ranks: Dict[Path, int] = {}
+            for img_path, mtime_ns in modified_at.items():
+                state = unprocessed_images_in_db.pop(str(img_path), None)
+                if state is None:
+                    _log.debug(f"Found new image: {img_path}")
+                    updated_image_paths.append(img_path)
+                elif state[0] < mtime_ns:
+                    _log.debug(f"Found updated image: {img_path}")
+                    updated_image_paths.append(img_path)
+                    ranks[img_path] = state[1]
+
+        report.files_found = len(image_paths_found)
+        report.files_missing = len(unprocessed_images_in_db)
         return WorkspaceManager.WorkspaceRescanDelta(
-            files_missing=sorted(Path(p) for p in unprocessed_paths_in_workspace.keys()),
-            files_updated=sorted(Path(p) for p in updated_image_paths),
+            files_missing=sorted(Path(p) for p in unprocessed_images_in_db.keys()),
+            files_updated=sorted(updated_image_paths),
+            ranks=ranks,
         )
 
     def _scan_current_workspace(self) -> Optional[List[Path]]:
         if self.__current_workspace is None:
             _log.debug("No workspace - no scan")
             return
-        ws_path = Path(self.__current_workspace.path)
+        return self._scan_workspace(self.__current_workspace)
+
+    @staticmethod
+    def _scan_workspace(
+            ws: Workspace,
+            matcher: Optional[ScanMatcher] = None,
+            report: Optional[RefreshReport] = None,
+    ) -> Optional[List[Path]]:
+        ws_path = Path(ws.path)
         if ws_path is None:
             _log.warning("No current workspace set")
             return
@@ -127,18 +317,36 @@ class WorkspaceManager:
 
         _log.info(f"Scanning workspace...")
         t = time()
-        image_files: List[Path] = sorted(Path(p) for p in set(WorkspaceManager._find_images(ws_path)))
+        matcher = matcher if matcher is not None else ScanRules().compile()
+        image_files: List[Path] = sorted(
+            Path(p) for p in set(WorkspaceManager._find_images(ws_path, matcher, report=report))
+        )
         _log.info(f"{len(image_files)} images found in workspace in {timedelta(seconds=time() - t)}")
         return image_files
 
     @staticmethod
-    def _find_images(scan_path: Path):
-        image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff')
-        for entry in os.scandir(scan_path):
-            try:
-                if entry.is_dir():
-                    yield from WorkspaceManager._find_images(entry.path)
-                elif entry.is_file() and entry.name.lower().endswith(image_extensions):
-                    yield entry.path
-            except PermissionError:
-                _log.debug(f"No permission to read {entry} - skipping")
+    def _find_images(scan_path: Path, matcher: ScanMatcher, prefix: str = "", report: Optional[RefreshReport] = None):
+        """
+        Paths of the images under the directory, `prefix` is its path relative to the workspace root with a
+        trailing /. Directories the rules exclude are not listed.
+        """
+        with os.scandir(scan_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if entry.name == TRASH_DIR_NAME:
+                            continue
+                        relative = f"{prefix}{entry.name}"
+                        if matcher.excludes(relative, is_dir=True):
+                            if report is not None:
+                                report.dirs_pruned += 1
+                            continue
+                        yield from WorkspaceManager._find_images(entry.path, matcher, f"{relative}/", report)
+                    elif matcher.is_image(entry.name) and entry.is_file():
+                        if matcher.excludes(f"{prefix}{entry.name}", is_dir=False):
+                            if report is not None:
+                                report.files_pruned += 1
+                            continue
+                        yield entry.path
+                except PermissionError:
+                    _log.debug(f"No permission to read {entry} - skipping")
@@ -0,0 +1,94 @@
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Dict, Any, List, Optional
+
+
+@dataclass(frozen=True)
+class BenchmarkResult:
+    name: str
+    items: int
+    runs: List[float]  # seconds
+
+    @property
+    def best(self) -> float:
+        return min(self.runs)
+
+    @property
+    def median(self) -> float:
+        return statistics.median(self.runs)
+
+    @property
+    def items_per_sec(self) -> float:
+        return self.items / self.best if self.best > 0 else 0.0
+
+    def to_json(self) -> Dict[str, Any]:
+        return {**asdict(self), "best": self.best, "median": self.median, "items_per_sec": self.items_per_sec}
+
+
+def measure(name: str, fn: Callable[[], int], repeat: int = 3, setup: Callable[[], None] = lambda: None) -> BenchmarkResult:
+    """
+    Runs `fn` `repeat` times, `fn` returns the number of items it processed. `setup` runs before
+    every run and is not measured.
+    """
+    runs, items = [], 0
+    for _ in range(repeat):
+        setup()
+        t = time.perf_counter()
+        items = fn()
+        runs.append(time.perf_counter() - t)
+    result = BenchmarkResult(name=name, items=items, runs=runs)
+    print(f"{name:<32} {result.best * 1000:10.1f} ms {result.items_per_sec:14.1f} items/s", file=sys.stderr)
+    return result
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=Path(__file__).parent,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(
+        path: Path,
+        suite: str,
+        params: Dict[str, Any],
+        results: List[BenchmarkResult],
+        extra: Optional[Dict[str, Any]] = None,
+):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    document = {
+        "suite": suite,
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": params,
+        "results": {r.name: r.to_json() for r in results},
+        **(extra or {}),
+    }
+    path.write_text(json.dumps(document, indent=2))
+
+
+def compare_results(baseline_path: Path, results: List[BenchmarkResult]):
+    """
+    Prints best times against a baseline results file, ratio > 1 means slower than the baseline.
+    """
+    baseline = json.loads(baseline_path.read_text())
+    print(f"Compared to {baseline.get('commit')} ({baseline_path}):", file=sys.stderr)
+    for r in results:
+        base = baseline["results"].get(r.name)
+        if base is None:
+            print(f"{r.name:<32} {'(new)':>10}", file=sys.stderr)
+            continue
+        ratio = r.best / base["best"] if base["best"] > 0 else float("inf")
+        print(f"{r.name:<32} {base['best'] * 1000:10.1f} ms -> {r.best * 1000:10.1f} ms  x{ratio:.2f}", file=sys.stderr)
@@ -0,0 +1,103 @@
+"""
+Row decoding benchmark: rows/sec of mapping image_data rows to objects, on an in-memory database.
+
+    python -m benchmark.rows --count 100000 --output userdata/benchmarks/rows.json
+"""
+import argparse
+import sqlite3
+import time
+from collections import namedtuple
+from pathlib import Path
+from sqlite3 import Cursor
+from typing import List, Optional
+
+from app.migrations import migrate, init_workspace_db
+from app.model.image_data import ImageData
+from app.repository import SQL_SELECT_IMAGE_METADATA
+from app.utils import ns_to_datetime
+from benchmark.results import measure, write_results, compare_results, BenchmarkResult
+
+_INDEX_QUERY = f"{SQL_SELECT_IMAGE_METADATA} WHERE d.workspace_id=? ORDER BY path ASC"
+_WORKSPACE_DB = "file:benchmark-rows?mode=memory&cache=shared"
+
+
+def _namedtuple_row_factory(cursor: Cursor, row: tuple) -> ImageData:
+    # how rows were mapped before `RowMapper`: a new namedtuple class for every row
+    column_names = [column[0] for column in cursor.description]
+    tpl = namedtuple("Row", column_names)(*row)
+    return ImageData(
+        workspace_id=tpl.workspace_id,
+        path=tpl.path,
+
+        size=tpl.size,
+        last_updated_at=ns_to_datetime(tpl.last_updated_ns),
+        width=tpl.width,
+        height=tpl.height,
+
+        rank=tpl.rank,
+        thumbnail=tpl.thumbnail,
+    )
+
+
+def _populate(connection: sqlite3.Connection, workspace_db: sqlite3.Connection, count: int):
+    migrate(connection)
+    connection.execute("INSERT INTO workspace (name, path, last_used_ns) VALUES ('benchmark', '/benchmark', NULL)")
+    connection.commit()
+    init_workspace_db(workspace_db)
+    now_ns = time.time_ns() // 1000 * 1000
+    workspace_db.executemany(
+        "INSERT INTO directory (id, workspace_id, relative, path) VALUES (?, 1, 1, ?)",
+        ((d, f"{d:03}/") for d in range(count // 1000 + 1)),
+    )
+    workspace_db.executemany(
+        "INSERT INTO image_data (directory_id, name, size, last_updated_ns, width, height, rank, thumbnail_key)"
+        " VALUES (?, ?, ?, ?, 1024, 768, ?, NULL)",
+        ((i // 1000, f"{i:06}.png", 100_000 + i, now_ns - i * 1000, i % 5) for i in range(count)),
+    )
+    workspace_db.commit()
+    connection.execute("ATTACH DATABASE ? AS ws", (_WORKSPACE_DB,))
+
+
+def run_suite(connection: sqlite3.Connection, repeat: int) -> List[BenchmarkResult]:
+    def fetch(row_factory) -> int:
+        cur = connection.cursor()
+        cur.row_factory = row_factory
+        try:
+            cur.execute(_INDEX_QUERY, (1,))
+            return len(cur.fetchall())
+        finally:
+            cur.close()
+
+    return [
+        measure("rows_tuples", lambda: fetch(None), repeat),
+        measure("rows_namedtuple_per_row", lambda: fetch(_namedtuple_row_factory), repeat),
+        measure("rows_row_mapper", lambda: fetch(ImageData.row_factory), repeat),
+    ]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.rows", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100_000, help="number of rows")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="write machine-readable results (json) to this file")
+    parser.add_argument("--compare", type=Path, help="results file to compare with")
+    args = parser.parse_args(argv)
+
+    connection = sqlite3.connect(":memory:", uri=True)
+    workspace_db = sqlite3.connect(_WORKSPACE_DB, uri=True)  # attached to the main one as `ws`
+    try:
+        _populate(connection, workspace_db, args.count)
+        results = run_suite(connection, args.repeat)
+    finally:
+        connection.close()
+        workspace_db.close()
+
+    if args.output:
+        write_results(args.output, "rows", {"count": args.count, "repeat": args.repeat}, results)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
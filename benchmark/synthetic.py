@@ -0,0 +1,66 @@
+import hashlib
+import json
+import logging
+import random
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Tuple, List
+
+from PIL import Image, ImageDraw
+
+_log = logging.getLogger(__name__)
+
+_MANIFEST_NAME = ".synthetic.json"
+_PIL_FORMATS = {"png": "PNG", "jpg": "JPEG", "jpeg": "JPEG", "gif": "GIF", "bmp": "BMP", "tiff": "TIFF"}
+
+
+@dataclass(frozen=True)
+class SyntheticWorkspaceSpec:
+    count: int = 1000
+    sizes: Tuple[Tuple[int, int], ...] = ((256, 256),)
+    formats: Tuple[str, ...] = ("png", "jpg")
+    depth: int = 2
+    fanout: int = 4  # subdirectories per directory level
+    seed: int = 42
+
+    def fingerprint(self) -> str:
+        return hashlib.sha1(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()[:10]
+
+    def directories(self) -> List[Path]:
+        dirs = [Path()]
+        level = [Path()]
+        for _ in range(self.depth):
+            level = [d.joinpath(f"d{i}") for d in level for i in range(self.fanout)]
+            dirs.extend(level)
+        return dirs
+
+
+def generate_workspace(root: Path, spec: SyntheticWorkspaceSpec) -> Path:
+    """
+    Fills `root` with `spec.count` images spread over a directory tree. Generation is deterministic
+    for a spec and is skipped when `root` already holds a workspace generated with the same spec.
+    """
+    manifest = root.joinpath(_MANIFEST_NAME)
+    spec_json = json.dumps(asdict(spec), sort_keys=True)
+    if manifest.exists() and manifest.read_text() == spec_json:
+        _log.info(f"Reusing synthetic workspace at {root}")
+        return root
+
+    _log.info(f"Generating {spec.count} images at {root}")
+    rnd = random.Random(spec.seed)
+    dirs = spec.directories()
+    for d in dirs:
+        root.joinpath(d).mkdir(parents=True, exist_ok=True)
+    bases = {size: Image.effect_noise(size, 64).convert("RGB") for size in spec.sizes}
+    for i in range(spec.count):
+        size = spec.sizes[i % len(spec.sizes)]
+        fmt = spec.formats[i % len(spec.formats)]
+        img = bases[size].copy()
+        # every image is different, so content-based caches don't see duplicates
+        x, y = rnd.randrange(size[0]), rnd.randrange(size[1])
+        color = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+        ImageDraw.Draw(img).rectangle((x // 2, y // 2, x, y), fill=color)
+        path = root.joinpath(dirs[i % len(dirs)], f"img_{i:06d}.{fmt}")
+        img.save(path, _PIL_FORMATS[fmt])
+    manifest.write_text(spec_json)
+    return root
@@ -0,0 +1,105 @@
+"""
+Texture upload benchmark: uploads/sec of decoded images into textures, through the path textures were loaded
+by before the pixel loader (converting every image to RGB and copying it with `tobytes`), through `Texture`
+from a Pillow image and from a numpy array, and of updates of an existing texture in place. Needs a display,
+the OpenGL context is of a hidden window.
+
+    python -m benchmark.textures --count 500 --size 512 --output userdata/benchmarks/textures.json
+"""
+import argparse
+from pathlib import Path
+from typing import List, Optional
+
+import OpenGL.GL as GL
+import glfw
+import numpy
+import PIL.Image
+
+from app.gui.components.texture import Texture
+from benchmark.results import measure, write_results, compare_results, BenchmarkResult
+
+
+def _legacy_upload(image: PIL.Image.Image) -> int:
+    # how `Texture` loaded images before the pixel loader
+    image = image.convert("RGB")
+    width, height = image.size
+    image_data: bytes = image.tobytes()
+    texture_id = GL.glGenTextures(1)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, texture_id)
+    GL.glTexImage2D(GL.GL_TEXTURE_2D, 0, GL.GL_RGB, width, height, 0, GL.GL_RGB, GL.GL_UNSIGNED_BYTE, image_data)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MIN_FILTER, GL.GL_LINEAR)
+    GL.glTexParameteri(GL.GL_TEXTURE_2D, GL.GL_TEXTURE_MAG_FILTER, GL.GL_LINEAR)
+    GL.glBindTexture(GL.GL_TEXTURE_2D, 0)
+    return texture_id
+
+
+def run_suite(count: int, size: int, repeat: int) -> List[BenchmarkResult]:
+    # a few distinct images, so the driver can't skip uploads of the same memory
+    arrays = [numpy.random.randint(0, 256, (size, size, 3), dtype=numpy.uint8) for _ in range(4)]
+    images = [PIL.Image.fromarray(a) for a in arrays]
+
+    def legacy() -> int:
+        ids = [_legacy_upload(images[i % len(images)]) for i in range(count)]
+        GL.glFinish()
+        GL.glDeleteTextures(ids)
+        return count
+
+    def upload(sources: list) -> int:
+        textures = [Texture.create_form(sources[i % len(sources)]) for i in range(count)]
+        GL.glFinish()
+        for texture in textures:
+            texture.release()
+        return count
+
+    def update() -> int:
+        texture = Texture.create_form(arrays[0])
+        for i in range(count):
+            texture.update(arrays[i % len(arrays)])
+        GL.glFinish()
+        texture.release()
+        return count
+
+    return [
+        measure("textures_legacy_convert_tobytes", legacy, repeat),
+        measure("textures_pil_image", lambda: upload(images), repeat),
+        measure("textures_numpy_array", lambda: upload(arrays), repeat),
+        measure("textures_update_in_place", update, repeat),
+    ]
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.textures", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=500, help="number of uploads")
+    parser.add_argument("--size", type=int, default=512, help="edge of the square images, in pixels")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="write machine-readable results (json) to this file")
+    parser.add_argument("--compare", type=Path, help="results file to compare with")
+    args = parser.parse_args(argv)
+
+    if not glfw.init():
+        raise SystemExit("Couldn't initialize GLFW, a display is needed")
+    try:
+        # the context the application uses, see `MainWindow`
+        glfw.window_hint(glfw.VISIBLE, glfw.FALSE)
+        glfw.window_hint(glfw.CONTEXT_VERSION_MAJOR, 3)
+        glfw.window_hint(glfw.CONTEXT_VERSION_MINOR, 3)
+        glfw.window_hint(glfw.OPENGL_PROFILE, glfw.OPENGL_CORE_PROFILE)
+        glfw.window_hint(glfw.OPENGL_FORWARD_COMPAT, GL.GL_TRUE)
+        window = glfw.create_window(64, 64, "benchmark", None, None)
+        if not window:
+            raise SystemExit("Couldn't create an OpenGL 3.3 context")
+        glfw.make_context_current(window)
+        results = run_suite(args.count, args.size, args.repeat)
+    finally:
+        glfw.terminate()
+
+    if args.output:
+        write_results(args.output, "textures", {"count": args.count, "size": args.size, "repeat": args.repeat},
+                      results)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
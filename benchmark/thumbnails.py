@@ -0,0 +1,139 @@
+"""
+Thumbnail load benchmark: thumbnails/sec of loading a workspace screen by screen, as the navigator does,
+from the thumbnail pack versus from a blob column of the image table, which is how thumbnails were stored
+before the pack. Both are read with a plain query of a screen of names, `thumbnails_repository` is the whole
+`Repository.get_thumbnails`. Thumbnails are random bytes of the typical size, they are not decoded.
+Compaction rewrites the pack after a quarter of the thumbnails were replaced, its items are bytes reclaimed.
+
+    python -m benchmark.thumbnails --count 20000 --output userdata/benchmarks/thumbnails.json
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import sqlite3
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+from app.migrations import workspace_db_file
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.thumbnail_pack import ThumbnailPack
+from benchmark.results import measure, write_results, compare_results, BenchmarkResult
+
+_SCREEN = 100  # thumbnails requested at once
+_THUMBNAIL_SIZES = (2_000, 8_000)  # bytes, of 64x64 palette PNGs
+
+
+def _thumbnail() -> bytes:
+    return os.urandom(random.randint(*_THUMBNAIL_SIZES))
+
+
+def _populate_blobs(blob_db: sqlite3.Connection, paths: List[str], thumbnails: List[bytes]):
+    blob_db.execute("PRAGMA journal_mode = WAL")
+    blob_db.execute(
+        "CREATE TABLE image_data (directory_id integer NOT NULL, name text NOT NULL, rank integer NOT NULL,"
+        " thumbnail blob NULL, PRIMARY KEY (directory_id, name))"
+    )
+    blob_db.executemany(
+        "INSERT INTO image_data (directory_id, name, rank, thumbnail) VALUES (1, ?, 0, ?)",
+        zip((os.path.basename(p) for p in paths), thumbnails),
+    )
+    blob_db.commit()
+
+
+def run_suite(
+        repo: Repository,
+        ws_id: int,
+        ws_file: Path,
+        blob_db: sqlite3.Connection,
+        paths: List[str],
+        repeat: int,
+) -> List[BenchmarkResult]:
+    screens = [paths[i:i + _SCREEN] for i in range(0, len(paths), _SCREEN)]
+    name_screens = [[os.path.basename(p) for p in screen] for screen in screens]
+    ws_db = sqlite3.connect(f"{ws_file.absolute().as_uri()}?mode=ro", uri=True)
+    pack = ThumbnailPack.for_database(ws_file)
+
+    def load_blob_column() -> int:
+        count = 0
+        for names in name_screens:
+            cur = blob_db.execute(
+                "SELECT name, thumbnail FROM image_data"
+                f" WHERE directory_id=1 AND name IN ({', '.join('?' * len(names))})",
+                names,
+            )
+            count += sum(1 for _name, thumbnail in cur if thumbnail)
+        return count
+
+    def load_pack_file() -> int:
+        count = 0
+        for names in name_screens:
+            cur = ws_db.execute(
+                "SELECT i.name, t.offset, t.length, (SELECT generation FROM thumbnail_pack) FROM image_data i"
+                " JOIN thumbnail t ON t.key = i.thumbnail_key"
+                f" WHERE i.directory_id=1 AND i.name IN ({', '.join('?' * len(names))})",
+                names,
+            )
+            count += sum(1 for _name, offset, length, generation in cur if pack.view(generation, offset, length))
+        return count
+
+    def load_repository() -> int:
+        return sum(sum(1 for t in repo.get_thumbnails(ws_id, screen).values() if t) for screen in screens)
+
+    def replace_quarter():
+        repo.persist_images(
+            ImageData(ws_id, path, 1, datetime.datetime.now(), 64, 64, rank=0, thumbnail=_thumbnail())
+            for path in random.sample(paths, len(paths) // 4)
+        )
+
+    try:
+        return [
+            measure("thumbnails_blob_column", load_blob_column, repeat),
+            measure("thumbnails_pack", load_pack_file, repeat),
+            measure("thumbnails_repository", load_repository, repeat),
+            measure("thumbnails_pack_compact", lambda: repo.compact_thumbnails(ws_id), repeat, setup=replace_quarter),
+        ]
+    finally:
+        ws_db.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.thumbnails", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=20_000, help="number of thumbnails")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", type=Path, help="write machine-readable results (json) to this file")
+    parser.add_argument("--compare", type=Path, help="results file to compare with")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory(prefix="picreview_bench_") as tmp:
+        db_file = Path(tmp).joinpath("bench.sqlite3")
+        repo = Repository(db_file)
+        blob_db = sqlite3.connect(Path(tmp).joinpath("blobs.sqlite3"))
+        try:
+            ws = repo.persist_workspace(Workspace(None, "benchmark", "/benchmark", datetime.datetime.now()))
+            paths = [f"/benchmark/{i:06}.png" for i in range(args.count)]
+            thumbnails = [_thumbnail() for _ in paths]
+            repo.persist_images(
+                ImageData(ws.id, path, 1, datetime.datetime.now(), 64, 64, rank=0, thumbnail=thumbnail)
+                for path, thumbnail in zip(paths, thumbnails)
+            )
+            _populate_blobs(blob_db, paths, thumbnails)
+            results = run_suite(repo, ws.id, workspace_db_file(db_file, ws.id), blob_db, paths, args.repeat)
+        finally:
+            blob_db.close()
+            repo.close()
+
+    if args.output:
+        write_results(args.output, "thumbnails", {"count": args.count, "repeat": args.repeat}, results)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""
+Scan, refresh and load benchmarks on a synthetic workspace.
+
+    python -m benchmark.workspace --count 10000 --output userdata/benchmarks/ws.json
+    python -m benchmark.workspace --count 10000 --compare userdata/benchmarks/ws.json
+"""
+import argparse
+import logging
+import tempfile
+from dataclasses import asdict
+from io import BytesIO
+from pathlib import Path
+from typing import List, Optional, Dict, Any
+
+from PIL import Image
+
+from app.repository import Repository
+from app.workspace_mgr import WorkspaceManager
+from benchmark.results import measure, write_results, compare_results, BenchmarkResult
+from benchmark.synthetic import SyntheticWorkspaceSpec, generate_workspace
+
+_FIRST_SCREEN_THUMBNAILS = 20  # what the navigator shows right after opening a workspace
+
+
+class _Context:
+    db_file: Path
+    ws_dir: Path
+    repo: Optional[Repository] = None
+    mgr: Optional[WorkspaceManager] = None
+    db_stats: bool
+    # query stats of every database the suite used, by benchmark name
+    query_stats: Dict[str, Any]
+
+    def __init__(self, db_file: Path, ws_dir: Path, db_stats: bool = False):
+        self.db_file = db_file
+        self.ws_dir = ws_dir
+        self.db_stats = db_stats
+        self.query_stats = {}
+
+    def collect_query_stats(self, name: str):
+        snapshot = self.repo.query_stats() if self.repo is not None else None
+        if snapshot is not None:
+            self.query_stats[name] = asdict(snapshot)
+            # fresh stats for the next benchmark
+            self.repo.disable_instrumentation()
+            self.repo.enable_instrumentation()
+
+    def fresh_db(self):
+        self.repo = None
+        self.mgr = None
+        self.db_file.unlink(missing_ok=True)
+        self.repo = Repository(self.db_file)
+        self.mgr = WorkspaceManager(self.repo)
+        ws = self.mgr.create_new_workspace(self.ws_dir, "benchmark", set_current=False)
+        self.mgr.set_workspace_as_current(ws.id)
+        if self.db_stats:
+            self.repo.enable_instrumentation()
+
+
+def run_suite(ctx: _Context, repeat: int) -> List[BenchmarkResult]:
+    results = []
+
+    def add(result: BenchmarkResult):
+        results.append(result)
+        ctx.collect_query_stats(result.name)
+
+    ctx.fresh_db()
+    add(measure("scan", lambda: len(ctx.mgr._scan_current_workspace()), repeat))
+
+    def refresh() -> int:
+        ctx.mgr.refresh_current_workspace()
+        return sum(ctx.repo.get_image_rank_histogram(ctx.mgr.current_workspace.id).values())
+    add(measure("refresh_initial", refresh, repeat, setup=ctx.fresh_db))
+    add(measure("refresh_noop", refresh, repeat))
+
+    ws_id = ctx.mgr.current_workspace.id
+    add(measure("load_all_images", lambda: len(ctx.repo.get_all_images_for_workspace(ws_id)), repeat))
+
+    def reopen_first_screen() -> int:
+        index = ctx.repo.get_image_index(ws_id)
+        ctx.repo.get_thumbnails(ws_id, [i.path for i in index[:_FIRST_SCREEN_THUMBNAILS]])
+        return len(index)
+    add(measure("reopen_first_screen", reopen_first_screen, repeat))
+
+    thumbnails = [i.thumbnail for i in ctx.repo.get_all_images_for_workspace(ws_id) if i.thumbnail]
+
+    def decode_thumbnails() -> int:
+        for t in thumbnails:
+            with Image.open(BytesIO(t)) as img:
+                img.convert("RGB")
+        return len(thumbnails)
+    add(measure("thumbnail_decode", decode_thumbnails, repeat))
+    return results
+
+
+def _parse_size(s: str):
+    w, h = s.lower().split("x")
+    return int(w), int(h)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m benchmark.workspace", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=1000, help="number of images, 1k to 100k")
+    parser.add_argument("--sizes", type=lambda s: tuple(_parse_size(x) for x in s.split(",")), default=((256, 256),),
+                        help="comma separated WxH list, e.g. 512x512,1024x768")
+    parser.add_argument("--formats", type=lambda s: tuple(s.split(",")), default=("png", "jpg"))
+    parser.add_argument("--depth", type=int, default=2, help="directory tree depth")
+    parser.add_argument("--fanout", type=int, default=4, help="subdirectories per directory")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--work-dir", type=Path, help="keeps generated workspaces between runs if set")
+    parser.add_argument("--output", type=Path, help="write machine-readable results (json) to this file")
+    parser.add_argument("--compare", type=Path, help="results file to compare with")
+    parser.add_argument("--db-stats", action="store_true", help="add per statement query stats to the results")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    spec = SyntheticWorkspaceSpec(
+        count=args.count, sizes=args.sizes, formats=args.formats, depth=args.depth, fanout=args.fanout,
+    )
+    with tempfile.TemporaryDirectory(prefix="picreview_bench_") as tmp:
+        work_dir = args.work_dir or Path(tmp)
+        ws_dir = generate_workspace(work_dir.joinpath(f"ws-{spec.fingerprint()}"), spec)
+        ctx = _Context(db_file=Path(tmp).joinpath("bench.sqlite3"), ws_dir=ws_dir.absolute(), db_stats=args.db_stats)
+        results = run_suite(ctx, args.repeat)
+        ctx.repo = None  # close the database before the temp dir is removed
+
+    params = {**asdict(spec), "repeat": args.repeat}
+    if args.output:
+        extra = {"query_stats": ctx.query_stats} if args.db_stats else None
+        write_results(args.output, "workspace", params, results, extra)
+    if args.compare:
+        compare_results(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,41 @@
 #!python3
+from app.startup import StartupTimer
+
+startup = StartupTimer()  # created before the rest of the imports, so they are accounted for
 
 import logging.config
+import sys
 from pathlib import Path
 
 import yaml
 
 import app
-from app.gui.main_window import MainWindow
 from app.pic_review import PicReview
 
 USERDATA_PATH = Path("./userdata")
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1:  # headless command, see app/cli.py
+        from app import cli
+        sys.exit(cli.main(sys.argv[1:]))
+    startup.mark("imports")
+
     with open('logging_cfg.yaml', 'r') as f:
         logging.config.dictConfig(yaml.safe_load(f))
     log = logging.getLogger(__name__)
     log.info("Starting application...")
+    startup.mark("logging config")
     backend = PicReview(USERDATA_PATH.joinpath("database.sqlite3"))
+    startup.mark("backend")
+
+    # the GUI stack (imgui, glfw, OpenGL) is only imported when it is going to be shown
+    from app.gui.main_window import MainWindow
+    startup.mark("gui imports")
+
     main_window = MainWindow(
         window_title=f"PicReview v{app.__version__}",
         backend=backend,
         imgui_ini_file_location=USERDATA_PATH.joinpath("imgui.ini"),
     )
-    main_window.show()
+    main_window.show(on_first_frame=lambda: startup.log("first frame"))
     log.info("Done.\n")
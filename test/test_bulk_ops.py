@@ -0,0 +1,158 @@
+import shutil
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+from app import bulk_ops
+from app.bulk_ops import BulkOpsEngine, BulkOperation, TRASH_DIR_NAME
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.workspace_mgr import WorkspaceManager
+
+
+# It is integration test - uses real repo and fs
+class BulkOpsEngineIntegrationTests(unittest.TestCase):
+    test_dir: Path
+    ws_dir: Path
+    out_dir: Path
+    repo: Repository
+    ws: Workspace
+
+    engine: BulkOpsEngine
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.ws_dir = self.test_dir.joinpath("ws")
+        self.out_dir = self.test_dir.joinpath("out")
+        self.ws_dir.joinpath("sub").mkdir(parents=True)
+        for name, rank in [("a.png", 1), ("b.png", 3), ("sub/c.png", 5), ("sub/d.png", 0)]:
+            Image.new('RGB', (8, 8), color='white').save(self.ws_dir.joinpath(name))
+        self.repo = Repository(db_file=Path(":memory:"))
+        mgr = WorkspaceManager(repo=self.repo)
+        self.ws = mgr.create_new_workspace(path=self.ws_dir, name="bulk ops", set_current=True)
+        for img in self.repo.get_all_images_for_workspace(self.ws.id):
+            rank = {"a.png": 1, "b.png": 3, "c.png": 5, "d.png": 0}[Path(img.path).name]
+            self.repo.persist_image(replace(img, rank=rank))
+        self.engine = BulkOpsEngine(self.repo, journal_dir=self.test_dir.joinpath("journal"), max_workers=2)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def db_paths(self):
+        return {Path(i.path) for i in self.repo.get_all_images_for_workspace(self.ws.id)}
+
+    def test_dry_run_reports_files_and_bytes_and_touches_nothing(self):
+        report = self.engine.run(self.ws, BulkOperation.DELETE, RankFilter(min_rank=3), dry_run=True)
+
+        expected_bytes = sum(self.ws_dir.joinpath(p).stat().st_size for p in ["b.png", "sub/c.png"])
+        self.assertTrue(report.dry_run)
+        self.assertEqual(2, report.files_total)
+        self.assertEqual(expected_bytes, report.bytes_total)
+        self.assertEqual(0, report.files_done)
+        self.assertEqual(4, len(self.db_paths()))
+        self.assertTrue(self.ws_dir.joinpath("b.png").exists())
+        self.assertEqual([], self.engine.interrupted_runs())
+
+    def test_move_out_of_workspace_keeps_structure_and_removes_rows(self):
+        report = self.engine.run(self.ws, BulkOperation.MOVE, RankFilter(min_rank=3), destination=self.out_dir)
+
+        self.assertEqual(2, report.files_done)
+        self.assertIsNone(report.journal)
+        self.assertTrue(self.out_dir.joinpath("b.png").exists())
+        self.assertTrue(self.out_dir.joinpath("sub", "c.png").exists())
+        self.assertFalse(self.ws_dir.joinpath("b.png").exists())
+        self.assertSetEqual({self.ws_dir.joinpath("a.png"), self.ws_dir.joinpath("sub", "d.png")}, self.db_paths())
+        self.assertEqual([], self.engine.interrupted_runs())
+
+    def test_move_within_workspace_keeps_rank(self):
+        destination = self.ws_dir.joinpath("best")
+        self.engine.run(self.ws, BulkOperation.MOVE, RankFilter(min_rank=5), destination=destination)
+
+        moved = self.repo.get_image(self.ws.id, str(destination.joinpath("sub", "c.png")))
+        self.assertIsNotNone(moved)
+        self.assertEqual(5, moved.rank)
+        self.assertIsNone(self.repo.get_image(self.ws.id, str(self.ws_dir.joinpath("sub", "c.png"))))
+
+    def test_copy_and_hardlink_leave_sources_and_rows(self):
+        self.engine.run(self.ws, BulkOperation.COPY, RankFilter(max_rank=1), destination=self.out_dir.joinpath("cp"))
+        self.engine.run(self.ws, BulkOperation.HARDLINK, RankFilter(max_rank=1), destination=self.out_dir.joinpath("ln"))
+
+        for p in ["a.png", "sub/d.png"]:
+            self.assertTrue(self.ws_dir.joinpath(p).exists())
+            self.assertTrue(self.out_dir.joinpath("cp", p).exists())
+            self.assertTrue(self.ws_dir.joinpath(p).samefile(self.out_dir.joinpath("ln", p)))
+        self.assertEqual(4, len(self.db_paths()))
+
+    def test_delete_removes_files_rows_and_trash(self):
+        report = self.engine.run(self.ws, BulkOperation.DELETE, RankFilter(max_rank=0))
+
+        self.assertEqual(1, report.files_done)
+        self.assertFalse(self.ws_dir.joinpath("sub", "d.png").exists())
+        self.assertEqual(3, len(self.db_paths()))
+        self.assertEqual([], list(self.ws_dir.joinpath(TRASH_DIR_NAME).glob("*")))
+
+    def test_failed_items_keep_the_journal(self):
+        self.out_dir.mkdir()
+        Image.new('RGB', (8, 8), color='black').save(self.out_dir.joinpath("a.png"))
+
+        report = self.engine.run(self.ws, BulkOperation.COPY, RankFilter(max_rank=1), destination=self.out_dir)
+
+        self.assertEqual(1, report.files_done)
+        self.assertEqual(1, report.files_failed)
+        self.assertEqual([report.journal], self.engine.interrupted_runs())
+
+    def test_interrupted_run_can_be_resumed(self):
+        original_move = bulk_ops._move_file
+        calls = []
+
+        def crash_on_second_file(src: Path, dst: Path):
+            calls.append(src)
+            if len(calls) == 2:
+                raise KeyboardInterrupt()
+            original_move(src, dst)
+
+        with mock.patch.dict(bulk_ops._FILE_OPS, {BulkOperation.MOVE: crash_on_second_file}):
+            with self.assertRaises(KeyboardInterrupt):
+                BulkOpsEngine(self.repo, journal_dir=self.test_dir.joinpath("journal"), max_workers=1) \
+                    .run(self.ws, BulkOperation.MOVE, RankFilter(min_rank=1), destination=self.out_dir)
+
+        journals = self.engine.interrupted_runs()
+        self.assertEqual(1, len(journals))
+
+        report = self.engine.resume(journals[0])
+
+        self.assertEqual(3, report.files_done)
+        self.assertEqual(0, report.files_failed)
+        for p in ["a.png", "b.png", "sub/c.png"]:
+            self.assertTrue(self.out_dir.joinpath(p).exists())
+        self.assertSetEqual({self.ws_dir.joinpath("sub", "d.png")}, self.db_paths())
+        self.assertEqual([], self.engine.interrupted_runs())
+
+    def test_interrupted_delete_can_be_rolled_back_with_ranks(self):
+        journal = self.engine.prepare(self.ws, BulkOperation.DELETE, RankFilter(min_rank=3))
+        with mock.patch.object(BulkOpsEngine, "_cleanup"):  # simulate a crash right before the cleanup
+            self.engine.resume(journal)
+        self.assertFalse(self.ws_dir.joinpath("b.png").exists())
+        self.assertEqual(2, len(self.db_paths()))
+
+        report = self.engine.rollback(journal)
+
+        self.assertEqual(2, report.files_done)
+        self.assertTrue(self.ws_dir.joinpath("b.png").exists())
+        self.assertTrue(self.ws_dir.joinpath("sub", "c.png").exists())
+        self.assertEqual(3, self.repo.get_image(self.ws.id, str(self.ws_dir.joinpath("b.png"))).rank)
+        self.assertEqual(5, self.repo.get_image(self.ws.id, str(self.ws_dir.joinpath("sub", "c.png"))).rank)
+        self.assertEqual([], self.engine.interrupted_runs())
+
+    def test_destination_is_required(self):
+        self.assertRaises(ValueError, self.engine.run, self.ws, BulkOperation.COPY, RankFilter())
+        self.assertRaises(ValueError, self.engine.run, self.ws, BulkOperation.MOVE, RankFilter(), self.ws_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import io
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import List, Tuple
+
+from PIL import Image
+
+from app import cli
+
+_REPO_ROOT = Path(__file__).parent.parent
+
+
+# It is integration test - uses real repo and fs
+class CliIntegrationTests(unittest.TestCase):
+    test_dir: Path
+    ws_dir: Path
+    userdata: Path
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.ws_dir = self.test_dir.joinpath("ws")
+        self.userdata = self.test_dir.joinpath("userdata")
+        self.ws_dir.joinpath("sub").mkdir(parents=True)
+        for name in ["a.png", "b.png", "sub/c.png"]:
+            Image.new('RGB', (8, 8), color='white').save(self.ws_dir.joinpath(name))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def run_cli(self, *args: str) -> Tuple[int, List[str]]:
+        out = io.StringIO()
+        with redirect_stdout(out):
+            code = cli.main(["--userdata", str(self.userdata), *args])
+        return code, out.getvalue().splitlines()
+
+    def test_workspace_is_created_indexed_and_listed(self):
+        code, out = self.run_cli("create", str(self.ws_dir), "cli")
+        self.assertEqual(0, code)
+        self.assertEqual("Created workspace 1: cli", out[0])
+        self.assertIn("(+3 -0 !0)", out[1])
+
+        code, out = self.run_cli("workspaces")
+        self.assertEqual(0, code)
+        self.assertEqual(1, len(out))
+        self.assertIn("cli", out[0])
+        self.assertIn(str(self.ws_dir), out[0])
+
+        self.ws_dir.joinpath("b.png").unlink()
+        code, out = self.run_cli("refresh", "cli")
+        self.assertEqual(0, code)
+        self.assertIn("(+0 -1 !0)", out[0])
+
+        code, out = self.run_cli("histogram", "1")
+        self.assertEqual(0, code)
+        self.assertEqual(["    0        2 " + "#" * 40, "total        2"], out)
+
+    def test_unknown_workspace_is_an_error(self):
+        code, _out = self.run_cli("refresh", "nope")
+        self.assertEqual(1, code)
+
+    def test_maintenance_pass_is_run_and_reported(self):
+        self.run_cli("create", str(self.ws_dir), "cli")
+
+        code, out = self.run_cli("maintenance")
+
+        self.assertEqual(0, code)
+        self.assertTrue(out[0].startswith("Maintenance complete"))
+        self.assertIn("databases optimized: 2", out[0])
+
+    def test_bulk_operation_is_run_on_rank_range(self):
+        self.run_cli("create", str(self.ws_dir), "cli")
+        destination = self.test_dir.joinpath("copies")
+
+        code, out = self.run_cli("bulk", "cli", "copy", str(destination), "--dry-run")
+        self.assertEqual(0, code)
+        self.assertTrue(out[0].startswith("[dry run] copy: 3 files"))
+        self.assertFalse(destination.exists())
+
+        code, out = self.run_cli("bulk", "cli", "copy", str(destination), "--min-rank", "0")
+        self.assertEqual(0, code)
+        self.assertTrue(destination.joinpath("sub", "c.png").is_file())
+
+        code, _out = self.run_cli("bulk", "cli", "move")
+        self.assertEqual(1, code)  # destination is required
+
+    def test_scan_rules_are_set_and_applied_on_refresh(self):
+        self.run_cli("create", str(self.ws_dir), "cli")
+        patterns = self.test_dir.joinpath("patterns")
+        patterns.write_text("sub/\n", encoding="utf-8")
+
+        code, out = self.run_cli("rules", "cli", "--patterns", str(patterns), "--extensions", "png", "webp")
+        self.assertEqual(0, code)
+        self.assertEqual(["extensions: .png .webp", "sub/"], out)
+
+        code, out = self.run_cli("refresh", "cli")
+        self.assertEqual(0, code)
+        self.assertIn("(+0 -1 !0)", out[0])
+
+        code, out = self.run_cli("rules", "cli", "--reset")
+        self.assertEqual(0, code)
+        self.assertEqual(["extensions: .jpg .jpeg .png .gif .bmp .tiff"], out)
+
+    def test_gui_modules_are_not_imported(self):
+        script = "import sys; from app import cli; cli.main(sys.argv[1:]); " \
+                 "print(sorted(m for m in sys.modules if m.split('.')[0] in ('imgui', 'glfw', 'OpenGL', 'app.gui')" \
+                 " or m.startswith('app.gui')))"
+        result = subprocess.run(
+            [sys.executable, "-c", script, "--userdata", str(self.userdata), "create", str(self.ws_dir), "cli"],
+            cwd=_REPO_ROOT, capture_output=True, text=True, check=True,
+        )
+        self.assertEqual("[]", result.stdout.splitlines()[-1])
+
+    def test_image_and_archive_modules_are_imported_on_first_use(self):
+        self.run_cli("create", str(self.ws_dir), "cli", "--no-refresh")
+        script = "import sys; from app import cli; cli.main(sys.argv[1:]); " \
+                 "print(sorted(m for m in sys.modules if m.split('.')[0] in ('PIL', 'multiprocessing', 'zstandard')))"
+        result = subprocess.run(
+            [sys.executable, "-c", script, "--userdata", str(self.userdata), "workspaces"],
+            cwd=_REPO_ROOT, capture_output=True, text=True, check=True,
+        )
+        self.assertEqual("[]", result.stdout.splitlines()[-1])
+
+
+if __name__ == "__main__":
+    unittest.main()
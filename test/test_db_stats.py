@@ -0,0 +1,95 @@
+import datetime
+import unittest
+from pathlib import Path
+
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.repository import Repository, SQL_SELECT_IMAGES
+
+
+class RepositoryInstrumentationTests(unittest.TestCase):
+    repo: Repository
+
+    def setUp(self) -> None:
+        self.repo = Repository(Path(":memory:"))
+        ws = self.repo.persist_workspace(Workspace(
+            id=None,
+            name="stats",
+            path="foo/bar",
+            last_used_at=datetime.datetime.now(),
+        ))
+        self.ws_id = ws.id
+        for i in range(10):
+            self.repo.persist_image(ImageData(
+                workspace_id=ws.id,
+                path=f"{i}.png",
+                size=100,
+                last_updated_at=datetime.datetime.now(),
+                width=640,
+                height=480,
+                rank=i % 3,
+            ))
+
+    def test_instrumentation_is_disabled_by_default(self):
+        self.assertIsNone(self.repo.query_stats())
+        self.assertEqual(0.0, self.repo.query_time_total)
+        self.assertGreater(self.repo.statements_executed, 0)
+
+    def test_statements_are_timed_and_rows_counted(self):
+        self.repo.enable_instrumentation()
+
+        for _ in range(3):
+            self.repo.get_all_images_for_workspace(self.ws_id)
+        self.repo.get_image_rank_histogram(self.ws_id)
+        self.repo.rm_image(self.ws_id, "0.png")
+
+        stats = self.repo.query_stats()
+        by_sql = {s.sql: s for s in stats.statements}
+        select_all = by_sql[f"{SQL_SELECT_IMAGES} WHERE d.workspace_id=? ORDER BY path ASC"]
+        self.assertEqual(3, select_all.count)
+        self.assertEqual(30, select_all.rows)
+        self.assertGreater(select_all.total_time, 0.0)
+        self.assertGreaterEqual(select_all.max_time, select_all.p95_time)
+        histogram = next(s for sql, s in by_sql.items() if "GROUP BY rank" in sql)
+        self.assertEqual(3, histogram.rows)
+        self.assertEqual(1, stats.commits)
+        # removal also bumps the change counter, reads the thumbnail cache keys, records the removed path
+        # and drops directories left empty
+        self.assertEqual(10, stats.query_count)
+        self.assertAlmostEqual(stats.total_time, self.repo.query_time_total)
+
+    def test_slow_queries_are_logged_with_query_plan(self):
+        self.repo.enable_instrumentation(slow_query_threshold=0.0)
+
+        with self.assertLogs("app.db_stats", level="WARNING") as logs:
+            self.repo.get_image_rank_histogram(self.ws_id)
+
+        self.assertEqual(1, self.repo.query_stats().slow_queries)
+        self.assertIn("GROUP BY rank", logs.output[0])
+        self.assertIn("image_data", logs.output[0].split("query plan:")[1])
+
+    def test_instrumentation_can_be_disabled(self):
+        self.repo.enable_instrumentation()
+        self.repo.disable_instrumentation()
+
+        self.repo.get_all_images_for_workspace(self.ws_id)
+
+        self.assertIsNone(self.repo.query_stats())
+
+    def test_query_time_total_never_decreases(self):
+        self.repo.enable_instrumentation()
+        self.repo.get_all_images_for_workspace(self.ws_id)
+        first = self.repo.query_time_total
+        self.assertGreater(first, 0.0)
+
+        self.repo.disable_instrumentation()
+        self.repo.get_all_images_for_workspace(self.ws_id)
+        self.assertEqual(first, self.repo.query_time_total)
+
+        self.repo.enable_instrumentation()
+        self.repo.get_all_images_for_workspace(self.ws_id)
+        self.assertGreater(self.repo.query_time_total, first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,160 @@
+import io
+import shutil
+import tarfile
+import tempfile
+import unittest
+import zipfile
+from dataclasses import replace
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+from parameterized import parameterized
+
+from app import export
+from app.export import ArchiveExporter, ArchiveFormat
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.workspace_mgr import WorkspaceManager
+
+
+# It is integration test - uses real repo and fs
+class ArchiveExporterIntegrationTests(unittest.TestCase):
+    test_dir: Path
+    ws_dir: Path
+    repo: Repository
+    ws: Workspace
+
+    exporter: ArchiveExporter
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.ws_dir = self.test_dir.joinpath("ws")
+        self.ws_dir.joinpath("sub").mkdir(parents=True)
+        for name in ["a.png", "b.png", "sub/c.png"]:
+            Image.new('RGB', (16, 8), color='white').save(self.ws_dir.joinpath(name))
+        self.repo = Repository(db_file=Path(":memory:"))
+        self.ws = WorkspaceManager(repo=self.repo).create_new_workspace(self.ws_dir, "export", set_current=True)
+        for img in self.repo.get_all_images_for_workspace(self.ws.id):
+            self.repo.persist_image(replace(img, rank=0 if Path(img.path).name == "a.png" else 4))
+        self.exporter = ArchiveExporter(self.repo, workers=2)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def expected_contents(self):
+        return {p: self.ws_dir.joinpath(p).read_bytes() for p in ["b.png", "sub/c.png"]}
+
+    def test_zip_export_contains_selected_images(self):
+        output = self.test_dir.joinpath("out.zip")
+
+        report = self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        self.assertEqual(2, report.files)
+        self.assertEqual(0, report.files_failed)
+        self.assertEqual(sum(len(b) for b in self.expected_contents().values()), report.bytes_read)
+        self.assertEqual(output.stat().st_size, report.bytes_written)
+        with zipfile.ZipFile(output) as zf:
+            self.assertDictEqual(self.expected_contents(), {n: zf.read(n) for n in zf.namelist()})
+        self.assertFalse(output.with_name("out.zip.part").exists())
+
+    @parameterized.expand([
+        ("out.tar",),
+        ("out.tar.gz",),
+        ("out.tgz",),
+    ])
+    def test_tar_export_contains_selected_images(self, file_name: str):
+        output = self.test_dir.joinpath(file_name)
+
+        report = self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        self.assertEqual(2, report.files)
+        with tarfile.open(output) as tf:
+            self.assertDictEqual(self.expected_contents(), {m.name: tf.extractfile(m).read() for m in tf.getmembers()})
+
+    @unittest.skipIf(export.zstandard_module() is None, "zstandard is not installed")
+    def test_zstd_tar_export_contains_selected_images(self):
+        output = self.test_dir.joinpath("out.tar.zst")
+
+        self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        with open(output, "rb") as f:
+            with export.zstandard_module().ZstdDecompressor().stream_reader(f) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tf:
+                    contents = {m.name: tf.extractfile(m).read() for m in tf}
+        self.assertDictEqual(self.expected_contents(), contents)
+
+    def test_big_files_are_streamed_instead_of_read_ahead(self):
+        output = self.test_dir.joinpath("out.zip")
+
+        with mock.patch.object(export, "_READ_AHEAD_MAX_FILE_SIZE", 0):
+            self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        with zipfile.ZipFile(output) as zf:
+            self.assertDictEqual(self.expected_contents(), {n: zf.read(n) for n in zf.namelist()})
+
+    @mock.patch.object(export, "_READ_AHEAD_MAX_FILE_SIZE", 0)
+    def test_streamed_files_gone_meanwhile_are_skipped(self):
+        output = self.test_dir.joinpath("out.tar")
+        read_ahead = export._read_ahead
+
+        def removing_b(img):
+            payload = read_ahead(img)
+            if img.path.endswith("b.png"):
+                Path(img.path).unlink()
+            return payload
+
+        with mock.patch.object(export, "_read_ahead", side_effect=removing_b):
+            report = self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        self.assertEqual((1, 1), (report.files, report.files_failed))
+        with tarfile.open(output) as tf:
+            self.assertEqual(["sub/c.png"], tf.getnames())
+
+    @mock.patch.object(export, "_READ_AHEAD_MAX_FILE_SIZE", 0)
+    def test_export_is_aborted_when_a_streamed_file_is_truncated(self):
+        output = self.test_dir.joinpath("out.tar")
+        read_ahead = export._read_ahead
+
+        def truncating_b(img):
+            payload = read_ahead(img)
+            if img.path.endswith("b.png"):
+                Path(img.path).write_bytes(b"short")
+            return payload
+
+        with mock.patch.object(export, "_read_ahead", side_effect=truncating_b), \
+                self.assertRaisesRegex(OSError, "archive is incomplete"):
+            self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        self.assertFalse(output.exists())
+        self.assertFalse(output.with_name("out.tar.part").exists())
+
+    def test_export_to_stdout(self):
+        stdout = io.TextIOWrapper(io.BytesIO())
+
+        with mock.patch("sys.stdout", stdout):
+            report = self.exporter.export(self.ws, RankFilter(min_rank=1), "-", ArchiveFormat.TAR)
+
+        with tarfile.open(fileobj=io.BytesIO(stdout.buffer.getvalue())) as tf:
+            self.assertEqual(set(self.expected_contents()), set(tf.getnames()))
+        self.assertEqual(len(stdout.buffer.getvalue()), report.bytes_written)
+
+    def test_missing_files_are_skipped(self):
+        self.ws_dir.joinpath("b.png").unlink()
+        output = self.test_dir.joinpath("out.zip")
+
+        report = self.exporter.export(self.ws, RankFilter(min_rank=1), output)
+
+        self.assertEqual(1, report.files)
+        self.assertEqual(1, report.files_failed)
+        with zipfile.ZipFile(output) as zf:
+            self.assertEqual(["sub/c.png"], zf.namelist())
+
+    def test_unknown_format_is_rejected(self):
+        self.assertRaises(ValueError, self.exporter.export, self.ws, RankFilter(), self.test_dir.joinpath("out.rar"))
+        self.assertRaises(ValueError, self.exporter.export, self.ws, RankFilter(), "-")
+
+
+if __name__ == "__main__":
+    unittest.main()
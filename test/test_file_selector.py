@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import List, Optional
+from unittest import mock
+
+from app.gui.file_selector import FileSelector, _list_directory
+
+
+# only the listings, rendering needs an imgui context
+class FileSelectorListingTests(unittest.TestCase):
+    test_dir: Path
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        for name in ["b", "A"]:
+            self.test_dir.joinpath(name).mkdir()
+        self.test_dir.joinpath("a.png").touch()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    @staticmethod
+    def wait_for_entries(selector: FileSelector, directory: Path) -> Optional[List[str]]:
+        deadline = time.monotonic() + 10
+        while (entries := selector._entries(directory)) is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return [e.name for e in entries] if entries is not None else None
+
+    def test_directories_are_listed_first_with_their_types(self):
+        listing = _list_directory(self.test_dir, lambda _: True)
+
+        self.assertEqual(["A", "b", "a.png"], [e.name for e in listing.entries])
+        self.assertEqual([True, True, False], [e.is_dir for e in listing.entries])
+        self.assertIsNone(_list_directory(self.test_dir, lambda _: True, listing.mtime_ns))  # unchanged
+        self.assertEqual(["A", "b"], [e.name for e in _list_directory(self.test_dir, os.DirEntry.is_dir).entries])
+        missing = _list_directory(self.test_dir.joinpath("missing"), lambda _: True)
+        self.assertEqual(([], None), (missing.entries, missing.mtime_ns))
+
+    @mock.patch("app.gui.file_selector._REVALIDATE_INTERVAL", 0.0)
+    def test_directory_is_listed_in_background_and_again_once_changed(self):
+        selector = FileSelector(selected=self.test_dir)
+        with mock.patch("app.gui.file_selector._list_directory", side_effect=lambda *_: time.sleep(0.5)):
+            self.assertIsNone(selector._entries(self.test_dir))  # doesn't wait for a slow listing
+        selector._pending.clear()
+
+        self.assertEqual(["A", "b", "a.png"], self.wait_for_entries(selector, self.test_dir))
+
+        self.test_dir.joinpath("b").rmdir()
+        os.utime(self.test_dir, ns=(0, 0))  # the mtime changes, even on file systems with a coarse one
+        deadline = time.monotonic() + 10
+        while self.wait_for_entries(selector, self.test_dir) != ["A", "a.png"] and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(["A", "a.png"], self.wait_for_entries(selector, self.test_dir))
+
+    @mock.patch("app.gui.file_selector._STALE_AFTER", 0.0)
+    def test_listings_of_directories_no_longer_shown_are_dropped(self):
+        selector = FileSelector(selected=self.test_dir)
+
+        self.assertIsNone(selector._entries(self.test_dir))
+        future = selector._pending[self.test_dir]
+        deadline = time.monotonic() + 10
+        while not future.done() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertTrue(future.cancelled())
+        self.assertIsNone(selector._entries(self.test_dir))  # requested again once shown
+
+    def test_failed_listing_is_logged_and_shown_empty(self):
+        selector = FileSelector(selected=self.test_dir)
+        with mock.patch("app.gui.file_selector._list_directory", side_effect=RuntimeError("boom")), \
+                self.assertLogs("app.gui.file_selector", "ERROR"):
+            self.assertEqual([], self.wait_for_entries(selector, self.test_dir))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,149 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from app.maintenance import Maintenance
+from app.migrations import workspace_db_file
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.repository import Repository
+from app.thumbnail_pack import ThumbnailPack
+
+
+class MaintenanceTests(unittest.TestCase):
+    test_dir: Path
+    db_file: Path
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.db_file = self.test_dir.joinpath("database.sqlite3")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def mk_workspace(self, repo: Repository, name: str, count: int) -> Workspace:
+        ws = repo.persist_workspace(Workspace(None, name, f"/{name}", datetime.datetime.now()))
+        now = datetime.datetime.now()
+        repo.persist_images(
+            ImageData(ws.id, f"/{name}/{i:04}.png", 1, now, 64, 64, rank=0, thumbnail=os.urandom(4000))
+            for i in range(count)
+        )
+        return ws
+
+    def pragma(self, ws_id: int, name: str) -> int:
+        connection = sqlite3.connect(workspace_db_file(self.db_file, ws_id))
+        try:
+            return connection.execute(f"PRAGMA {name}").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_pass_reclaims_space_of_removed_images(self):
+        repo = Repository(self.db_file)
+        ws = self.mk_workspace(repo, "ws", 300)
+        repo.rm_images(ws.id, (f"/ws/{i:04}.png" for i in range(200)))
+        self.assertGreater(self.pragma(ws.id, "freelist_count"), 0)
+
+        report = Maintenance(repo, compaction_threshold=1).run()
+
+        self.assertTrue(report.complete)
+        self.assertEqual(1, report.packs_compacted)
+        self.assertEqual(200 * 4000, report.thumbnail_bytes)
+        self.assertGreater(report.vacuum_bytes, 0)
+        self.assertEqual(0, report.databases_rebuilt)  # new databases have incremental vacuum on
+        self.assertEqual(2, report.databases_optimized)
+        self.assertEqual(0, self.pragma(ws.id, "freelist_count"))
+        thumbnails = repo.get_thumbnails(ws.id, [f"/ws/{i:04}.png" for i in range(200, 300)])
+        self.assertTrue(all(len(t) == 4000 for t in thumbnails.values()))
+        self.assertEqual(report.reclaimed_bytes, report.thumbnail_bytes + report.vacuum_bytes)
+        repo.close()
+
+    def test_files_left_by_failed_removals_are_removed(self):
+        repo = Repository(self.db_file)
+        removed = self.mk_workspace(repo, "removed", 10)
+        kept = self.mk_workspace(repo, "kept", 10)
+        # as if removing them failed, e.g. held open by another process on Windows
+        repo.close()
+        connection = sqlite3.connect(self.db_file)
+        connection.execute("DELETE FROM workspace WHERE id=?", (removed.id,))
+        connection.commit()
+        connection.close()
+        kept_pack = ThumbnailPack.for_database(workspace_db_file(self.db_file, kept.id))
+        kept_pack.file(0).write_bytes(b"old generation")
+        repo = Repository(self.db_file)
+
+        report = Maintenance(repo).run()
+
+        self.assertTrue(report.complete)
+        self.assertFalse(workspace_db_file(self.db_file, removed.id).exists())
+        self.assertFalse(kept_pack.file(0).exists())
+        self.assertTrue(kept_pack.file(1).exists())
+        self.assertEqual(3, report.orphan_files)  # the database and pack of the removed one, the old generation
+        self.assertGreater(report.orphan_bytes, 10 * 4000)
+        self.assertEqual(10, len(repo.get_image_index(kept.id)))
+        repo.close()
+
+    def test_database_created_without_incremental_vacuum_is_rebuilt_once(self):
+        connection = sqlite3.connect(self.db_file)
+        connection.execute("PRAGMA journal_mode = WAL")  # anything written first leaves auto vacuum off
+        connection.close()
+        repo = Repository(self.db_file)
+        self.mk_workspace(repo, "ws", 1)
+        maintenance = Maintenance(repo)
+
+        first, second = maintenance.run(), maintenance.run()
+
+        self.assertEqual(1, first.databases_rebuilt)  # the main one
+        self.assertEqual(0, second.databases_rebuilt)
+        self.assertIs(second, maintenance.last_report)
+        with repo._connections.read() as reader:
+            self.assertEqual(2, reader.execute("PRAGMA auto_vacuum").fetchone()[0])
+        repo.close()
+
+    def test_pass_stops_between_steps_once_not_idle(self):
+        repo = Repository(self.db_file)
+        maintenance = Maintenance(repo, idle_after=0)
+        self.assertTrue(maintenance.is_idle())
+
+        with maintenance.busy():
+            self.assertFalse(maintenance.is_idle())
+            report = maintenance.run(cancel=lambda: not maintenance.is_idle())
+
+        self.assertFalse(report.complete)
+        self.assertEqual(0, report.databases_optimized)
+        self.assertTrue(maintenance.is_idle())
+        repo.close()
+
+    def test_passes_never_overlap(self):
+        repo = Repository(self.db_file)
+        maintenance = Maintenance(repo)
+        in_pass, release = threading.Event(), threading.Event()
+
+        def first_cancel() -> bool:
+            in_pass.set()
+            release.wait(5)
+            return False
+
+        first = threading.Thread(target=maintenance.run, args=(first_cancel,))
+        first.start()
+        in_pass.wait(5)
+        self.assertTrue(maintenance.is_running())
+        second = threading.Thread(target=maintenance.run)
+        second.start()
+        second.join(0.1)
+        self.assertTrue(second.is_alive())  # waits for the first one
+
+        release.set()
+        first.join(5)
+        second.join(5)
+        self.assertFalse(maintenance.is_running())
+        self.assertTrue(maintenance.last_report.complete)
+        repo.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
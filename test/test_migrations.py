@@ -0,0 +1,211 @@
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+
+from app.migrations import migrate, get_version, MIGRATIONS, SCHEMA_VERSION, Migration, workspace_db_file, \
+    WORKSPACE_MIGRATIONS
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.model.image_data import ImageData
+from app.repository import Repository
+
+# schema as it was created before it was versioned (user_version 0)
+LEGACY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS workspace (
+    id              integer PRIMARY KEY AUTOINCREMENT,
+    name            text    NOT NULL,
+    path            text    NOT NULL,
+    last_used_at    text
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_workspace_name
+ON workspace(name);
+CREATE INDEX IF NOT EXISTS        idx_workspace_last_used_at
+ON workspace(last_used_at);
+
+CREATE TABLE IF NOT EXISTS image_data (
+    workspace_id    integer NOT NULL,
+    path            text    NOT NULL,
+
+    size            integer NOT NULL,
+    last_updated_at text    NOT NULL,
+    width           integer NOT NULL,
+    height          integer NOT NULL,
+    thumbnail       blob    NULL,
+    rank            integer DEFAULT 0 NOT NULL,
+
+    PRIMARY KEY     (workspace_id, path),
+    CONSTRAINT      fk_workspace
+        FOREIGN KEY (workspace_id)
+        REFERENCES  workspace(id)
+        ON DELETE CASCADE
+);
+
+CREATE INDEX IF NOT EXISTS        idx_image_data_path
+ON image_data(path);
+CREATE INDEX IF NOT EXISTS        idx_image_data_last_updated_at
+ON image_data(last_updated_at);
+CREATE INDEX IF NOT EXISTS        idx_image_data_rank
+ON image_data(rank);
+"""
+
+
+class MigrationTests(unittest.TestCase):
+    test_dir: Path
+    db_file: Path
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.db_file = self.test_dir.joinpath("database.sqlite3")
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def mk_legacy_db(self):
+        # values as the sqlite3 default datetime adapter wrote them: ISO format with a space separator
+        with sqlite3.connect(self.db_file) as conn:
+            conn.executescript(LEGACY_SCHEMA)
+            conn.executemany("INSERT INTO workspace (id, name, path, last_used_at) VALUES (?, ?, ?, ?)", [
+                (1, "one", "/ws/one", "2023-11-14 22:13:20.123456"),
+                (2, "two", "/ws/two", "2023-11-15 08:00:00"),
+                (3, "deleted", "/ws/deleted", "2023-11-15 09:00:00"),
+            ])
+            conn.execute("DELETE FROM workspace WHERE id=3")
+            conn.executemany("INSERT INTO image_data VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+                (1, "/ws/one/a.png", 100, "2023-11-14 20:00:00.000001", 8, 8, b"thumb-a", 5),
+                (1, "/ws/one/b.png", 200, "2023-11-14 20:00:01", 16, 8, None, 0),
+                (2, "/ws/two/a.png", 300, "2023-11-14 20:00:02.5", 8, 16, b"thumb-c", 2),
+            ])
+        conn.close()
+
+    def test_legacy_database_is_migrated_in_place_keeping_data(self):
+        self.mk_legacy_db()
+
+        repo = Repository(self.db_file)
+
+        workspaces = {ws.id: ws for ws in repo.get_all_workspaces()}
+        self.assertEqual({1, 2}, set(workspaces))
+        self.assertEqual(datetime(2023, 11, 14, 22, 13, 20, 123456), workspaces[1].last_used_at)
+        self.assertEqual(datetime(2023, 11, 15, 8, 0, 0), workspaces[2].last_used_at)
+        images = {i.path: i for i in repo.get_all_images_for_workspace(1)}
+        self.assertEqual(datetime(2023, 11, 14, 20, 0, 0, 1), images["/ws/one/a.png"].last_updated_at)
+        self.assertEqual(5, images["/ws/one/a.png"].rank)
+        self.assertEqual(b"thumb-a", images["/ws/one/a.png"].thumbnail)
+        self.assertEqual((16, 8), images["/ws/one/b.png"].dimensions)
+        self.assertEqual({2: 1}, repo.get_image_rank_histogram(2))
+        self.assertFalse(repo.is_image_outdated(2, "/ws/two/a.png", datetime(2023, 11, 14, 20, 0, 2, 500000)))
+        self.assertTrue(repo.is_image_outdated(2, "/ws/two/a.png", datetime(2023, 11, 14, 20, 0, 2, 500001)))
+        # ids of deleted workspaces are not reused
+        new_ws = repo.persist_workspace(workspaces[1].__class__(None, "new", "/ws/new", datetime.now()))
+        self.assertEqual(4, new_ws.id)
+        # images are removed with the workspace
+        repo.rm_workspace(1)
+        self.assertEqual([], repo.get_all_images_for_workspace(1))
+        self.assertFalse(workspace_db_file(self.db_file, 1).exists())
+        del repo
+
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual(SCHEMA_VERSION, get_version(conn))
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            self.assertNotIn("image_data", tables)
+            self.assertNotIn("directory", tables)
+        conn.close()
+        # images of every workspace are moved to a database of its own
+        with sqlite3.connect(workspace_db_file(self.db_file, 2)) as conn:
+            self.assertEqual(WORKSPACE_MIGRATIONS[-1].version, get_version(conn))
+            self.assertEqual("wal", conn.execute("PRAGMA journal_mode").fetchone()[0])
+            column_types = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(image_data)")}
+            self.assertEqual("INTEGER", column_types["last_updated_ns"].upper())
+            self.assertEqual(["a.png"], [row[0] for row in conn.execute("SELECT name FROM image_data")])
+            self.assertNotIn("last_updated_at", column_types)
+            self.assertNotIn("path", column_types)
+            # the workspace has all its images in the root directory
+            self.assertEqual([(2, 1, "")], conn.execute("SELECT workspace_id, relative, path FROM directory").fetchall())
+            # thumbnails are moved to the pack file
+            self.assertNotIn("thumbnail", column_types)
+            offset, length = conn.execute(
+                "SELECT offset, length FROM thumbnail t JOIN image_data i ON i.thumbnail_key = t.key"
+            ).fetchone()
+        conn.close()
+        pack = workspace_db_file(self.db_file, 2).with_name("2.1.thumbs").read_bytes()
+        self.assertEqual(b"thumb-c", pack[offset:offset + length])
+
+    def test_workspace_state_is_kept_when_migrating_from_version_2(self):
+        with sqlite3.connect(self.db_file) as conn:
+            migrate(conn, MIGRATIONS[:2])
+            conn.execute("INSERT INTO workspace (name, path, last_used_at) VALUES ('ws', '/ws', NULL)")
+            conn.execute("INSERT INTO workspace_state VALUES (1, '/ws/b.png')")
+        conn.close()
+
+        repo = Repository(self.db_file)
+
+        self.assertEqual("/ws/b.png", repo.get_current_image_path(1))
+        self.assertIsNone(repo.get_workspace(1).last_used_at)
+
+    def test_failed_migration_is_rolled_back(self):
+        def broken(connection: sqlite3.Connection):
+            connection.execute("CREATE TABLE half_done (id integer)")
+            raise RuntimeError("boom")
+
+        with sqlite3.connect(self.db_file) as conn:
+            with self.assertRaises(RuntimeError):
+                migrate(conn, MIGRATIONS[:1] + [Migration(2, "broken", broken)])
+
+            self.assertEqual(1, get_version(conn))
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+            self.assertIn("image_data", tables)
+            self.assertNotIn("half_done", tables)
+            self.assertEqual(0, conn.execute("PRAGMA foreign_keys").fetchone()[0], "setting is restored")
+        conn.close()
+
+    def test_newer_database_is_refused(self):
+        with sqlite3.connect(self.db_file) as conn:
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+            with self.assertRaises(sqlite3.DatabaseError):
+                migrate(conn)
+        conn.close()
+
+    def test_queries_are_served_by_covering_indexes(self):
+        repo = Repository(self.db_file)
+        ws = repo.persist_workspace(Workspace(None, "ws", "/ws", datetime.now()))
+        repo.get_image_index(ws.id)  # attaches the workspace database
+        repo.enable_instrumentation(slow_query_threshold=0.0)
+
+        with self.assertLogs("app.db_stats", level="WARNING") as logs:
+            repo.get_image_index(ws.id)
+            repo.get_image_states(ws.id)
+            repo.get_image_rank_histogram(ws.id)
+            repo.get_images_by_rank(ws.id, RankFilter(min_rank=1))
+
+        self.assertEqual(4, len(logs.output))
+        for output in logs.output:
+            self.assertIn("SEARCH d USING COVERING INDEX idx_directory_path", output)
+            self.assertIn("SEARCH i USING COVERING INDEX idx_image_data_metadata", output)
+
+    def test_workspace_databases_are_created_on_first_use(self):
+        repo = Repository(self.db_file)
+        ws1 = repo.persist_workspace(Workspace(None, "one", "/one", datetime.now()))
+        ws2 = repo.persist_workspace(Workspace(None, "two", "/two", datetime.now()))
+        self.assertFalse(workspace_db_file(self.db_file, ws1.id).exists())
+
+        repo.persist_images([ImageData(ws1.id, "/one/a.png", 1, datetime.now(), 1, 1, rank=0)])
+        repo.persist_images([ImageData(ws2.id, "/two/b.png", 1, datetime.now(), 1, 1, rank=2)])
+
+        self.assertEqual(["/one/a.png"], [i.path for i in repo.get_image_index(ws1.id)])
+        self.assertEqual({2: 1}, repo.get_image_rank_histogram(ws2.id))
+        self.assertTrue(workspace_db_file(self.db_file, ws1.id).exists())
+        with sqlite3.connect(workspace_db_file(self.db_file, ws2.id)) as conn:
+            self.assertEqual([("b.png",)], conn.execute("SELECT name FROM image_data").fetchall())
+        conn.close()
+        # a workspace replaced by another one with the same name takes its images along
+        replacing = repo.persist_workspace(Workspace(None, "one", "/elsewhere", datetime.now()))
+        self.assertFalse(workspace_db_file(self.db_file, ws1.id).exists())
+        self.assertEqual([], repo.get_image_index(replacing.id))
+        repo.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import sys
+import time
+import types
+import unittest
+
+from parameterized import parameterized
+
+from app.perf import PerfMonitor, percentile
+from app.startup import StartupTimer
+
+
+class TestPercentile(unittest.TestCase):
+
+    @parameterized.expand([
+        ([], 50, 0.0),
+        ([5.0], 95, 5.0),
+        ([1.0, 2.0, 3.0, 4.0], 50, 2.0),
+        ([1.0, 2.0, 3.0, 4.0], 100, 4.0),
+        ([float(i) for i in range(1, 101)], 95, 95.0),
+        ([float(i) for i in range(1, 101)], 0, 1.0),
+    ])
+    def test_percentile(self, values, p, expected):
+        self.assertEqual(expected, percentile(values, p))
+
+
+class TestPerfMonitor(unittest.TestCase):
+
+    def test_sections_and_counters_are_collected_per_frame(self):
+        total = [0]
+        perf = PerfMonitor(window=10)
+        perf.register_counter("queries", lambda: total[0])
+        perf.register_gauge("queue", lambda: 7)
+
+        perf.begin_frame()
+        with perf.section("render"):
+            time.sleep(0.01)
+        total[0] += 3
+        perf.begin_frame()
+        total[0] += 1
+        perf.begin_frame()
+
+        self.assertEqual(2, len(perf.frame_times))
+        self.assertGreaterEqual(perf.frame_time_percentiles()[100], 0.01)
+        sections = perf.section_times()
+        self.assertEqual(0.0, sections["render"]["last"])
+        self.assertGreaterEqual(sections["render"]["max"], 0.01)
+        self.assertDictEqual({"last": 1, "avg": 2.0, "max": 3}, perf.counter_deltas()["queries"])
+        self.assertDictEqual({"queue": 7}, perf.gauges())
+
+    def test_only_the_last_frames_are_kept(self):
+        perf = PerfMonitor(window=3)
+        for _ in range(10):
+            perf.begin_frame()
+        self.assertEqual(3, len(perf.frame_times))
+
+
+class TestStartupTimer(unittest.TestCase):
+
+    def test_steps_are_timed_with_modules_they_imported(self):
+        timer = StartupTimer()
+        time.sleep(0.01)
+        timer.mark("nothing imported")
+        for name in ["picreview_fake", "picreview_fake.a", "picreview_fake.b"]:
+            sys.modules[name] = types.ModuleType(name)
+        try:
+            timer.mark("fake imports")
+        finally:
+            for name in ["picreview_fake", "picreview_fake.a", "picreview_fake.b"]:
+                del sys.modules[name]
+
+        lines = timer.summary().splitlines()
+        self.assertGreaterEqual(timer.elapsed, 0.01)
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[1].strip().startswith("nothing imported"))
+        self.assertTrue(lines[1].endswith("0 modules"))
+        self.assertTrue(lines[2].endswith("3 modules (picreview_fake)"))
+
+
+if __name__ == "__main__":
+    unittest.main()
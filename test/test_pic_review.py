@@ -0,0 +1,137 @@
+import shutil
+import tempfile
+import time
+import unittest
+from dataclasses import replace
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+from app.pic_review import PicReview
+from app.repository import Repository
+from app.workspace_mgr import WorkspaceManager
+
+
+# It is integration test - uses real repo and fs
+class PicReviewReopenIntegrationTests(unittest.TestCase):
+    test_dir: Path
+    ws_dir: Path
+    db_file: Path
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.ws_dir = self.test_dir.joinpath("ws")
+        self.ws_dir.mkdir()
+        self.db_file = self.test_dir.joinpath("database.sqlite3")
+        for name in ["a.png", "b.png", "c.png"]:
+            self.mk_img_file(name)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def mk_img_file(self, name: str):
+        Image.new('RGB', (8, 8), color='white').save(self.ws_dir.joinpath(name))
+
+    def test_new_workspace_is_indexed_in_background(self):
+        backend = PicReview(self.db_file)
+
+        ws = backend.create_new_workspace(self.ws_dir, "ws", set_current=True)
+
+        self.assertEqual(ws, backend.get_current_workspace())
+        self.assertTrue(backend.wait_for_reconciliation(timeout=10))
+        changes = backend.poll_workspace_changes()
+        self.assertEqual(
+            [str(self.ws_dir.joinpath(n)) for n in ["a.png", "b.png", "c.png"]],
+            [i.path for c in changes for i in c.updated],
+        )
+        self.assertTrue(all(i.thumbnail for c in changes for i in c.updated))
+        self.assertEqual([], backend.poll_workspace_changes())
+        self.assertEqual((0, 0), (backend.get_background_jobs(), backend.get_thumbnails_pending()))
+
+    def test_workspace_is_reopened_at_last_image_and_reconciled_in_background(self):
+        backend = PicReview(self.db_file)
+        ws = backend.create_new_workspace(self.ws_dir, "ws", set_current=True)
+        backend.wait_for_reconciliation(timeout=10)
+        backend.set_current_image_path(str(self.ws_dir.joinpath("b.png")))
+        del backend
+
+        self.ws_dir.joinpath("a.png").unlink()
+        self.mk_img_file("d.png")
+        reopened = PicReview(self.db_file)
+        reopened.set_workspace_as_current(ws.id, refresh=True)
+
+        # the last known state is available right away
+        self.assertEqual(str(self.ws_dir.joinpath("b.png")), reopened.get_current_image_path())
+        index = reopened.get_current_workspace_image_index()
+        self.assertTrue(all(i.thumbnail is None for i in index))
+        thumbnails = reopened.get_thumbnails([i.path for i in index])
+        self.assertTrue(all(thumbnails.values()))
+
+        self.assertTrue(reopened.wait_for_reconciliation(timeout=10))
+        self.assertFalse(reopened.is_reconciling())
+        changes = reopened.poll_workspace_changes()
+        self.assertEqual([str(self.ws_dir.joinpath("d.png"))], [i.path for c in changes for i in c.updated])
+        self.assertEqual([str(self.ws_dir.joinpath("a.png"))], [p for c in changes for p in c.removed])
+        self.assertEqual(
+            [str(self.ws_dir.joinpath(n)) for n in ["b.png", "c.png", "d.png"]],
+            [i.path for i in reopened.get_current_workspace_image_index()],
+        )
+
+    @mock.patch("app.pic_review._DB_CHANGES_POLL_INTERVAL", 0.0)
+    def test_changes_made_by_another_process_are_polled(self):
+        backend = PicReview(self.db_file)
+        ws = backend.create_new_workspace(self.ws_dir, "ws", set_current=True)
+        backend.wait_for_reconciliation(timeout=10)
+        backend.poll_workspace_changes()
+        other = Repository(self.db_file)  # another review station
+        try:
+            a, b, _c = other.get_all_images_for_workspace(ws.id)
+            other.persist_image(replace(a, rank=2))
+            other.rm_image(ws.id, b.path)
+
+            changes = backend.poll_workspace_changes()
+            self.assertEqual([(a.path, 2)], [(i.path, i.rank) for c in changes for i in c.updated])
+            self.assertEqual([b.path], [p for c in changes for p in c.removed])
+            self.assertEqual([], backend.poll_workspace_changes())
+
+            moved_dir = self.test_dir.joinpath("moved")
+            self.ws_dir.rename(moved_dir)
+            other.persist_workspace(replace(ws, path=str(moved_dir)))
+
+            self.assertEqual([True], [c.reload for c in backend.poll_workspace_changes()])
+            self.assertEqual(moved_dir, backend.get_workspace_dir())
+        finally:
+            other.close()
+
+    def test_switching_workspaces_waits_for_the_cancelled_reconciliation(self):
+        backend = PicReview(self.db_file, background=False)
+        self.test_dir.joinpath("other").mkdir()
+        other = backend.create_new_workspace(self.test_dir.joinpath("other"), "other", set_current=False)
+        read_image = WorkspaceManager._read_image
+
+        def slow_read(mgr, *args):
+            time.sleep(0.2)
+            return read_image(mgr, *args)
+
+        with mock.patch.object(WorkspaceManager, "_read_image", autospec=True, side_effect=slow_read) as reads:
+            ws = backend.create_new_workspace(self.ws_dir, "ws", set_current=True)
+            while reads.call_count == 0:
+                time.sleep(0.01)
+            backend.set_workspace_as_current(other.id, refresh=False)
+            repo = Repository(self.db_file)
+            try:
+                # the image in progress is written before the switch, nothing after it
+                written_when_switched = len(repo.get_all_images_for_workspace(ws.id))
+                time.sleep(0.3)
+                self.assertEqual(written_when_switched, len(repo.get_all_images_for_workspace(ws.id)))
+            finally:
+                repo.close()
+
+        self.assertEqual(1, written_when_switched)
+        self.assertEqual(1, reads.call_count)
+        self.assertEqual(other, backend.get_current_workspace())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+from dataclasses import replace
+from pathlib import Path
+from unittest import mock
+
+from PIL import Image
+
+from app.model.rank_filter import RankFilter
+from app.model.workspace import Workspace
+from app.publish import Publisher, PublishSettings, PublishFormat, _publish_one, _Status
+from app.repository import Repository
+from app.workspace_mgr import WorkspaceManager
+
+
+# It is integration test - uses real repo and fs
+class PublisherIntegrationTests(unittest.TestCase):
+    test_dir: Path
+    ws_dir: Path
+    out_dir: Path
+    repo: Repository
+    ws: Workspace
+
+    publisher: Publisher
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.ws_dir = self.test_dir.joinpath("ws")
+        self.out_dir = self.test_dir.joinpath("out")
+        self.ws_dir.joinpath("sub").mkdir(parents=True)
+        Image.new('RGB', (400, 200), color='red').save(self.ws_dir.joinpath("a.png"))
+        Image.new('RGBA', (100, 300), color='blue').save(self.ws_dir.joinpath("sub", "b.png"))
+        Image.new('RGB', (100, 100), color='green').save(self.ws_dir.joinpath("low.png"))
+        self.repo = Repository(db_file=Path(":memory:"))
+        self.ws = WorkspaceManager(repo=self.repo).create_new_workspace(self.ws_dir, "publish", set_current=True)
+        for img in self.repo.get_all_images_for_workspace(self.ws.id):
+            self.repo.persist_image(replace(img, rank=0 if Path(img.path).name == "low.png" else 2))
+        self.publisher = Publisher(self.repo, workers=2)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def test_images_are_resized_and_converted(self):
+        settings = PublishSettings(format=PublishFormat.JPEG, max_edge=50, quality=80)
+
+        report = self.publisher.publish(self.ws, RankFilter(min_rank=1), self.out_dir, settings)
+
+        self.assertEqual(2, report.images)
+        self.assertEqual(0, report.failed)
+        self.assertEqual(report.bytes_in - report.bytes_out, report.bytes_saved)
+        with Image.open(self.out_dir.joinpath("a.jpg")) as img:
+            self.assertEqual("JPEG", img.format)
+            self.assertEqual((50, 25), img.size)
+        with Image.open(self.out_dir.joinpath("sub", "b.jpg")) as img:
+            self.assertEqual((17, 50), img.size)
+        self.assertFalse(self.out_dir.joinpath("low.jpg").exists())
+        self.assertEqual([], list(self.out_dir.rglob("*.part")))
+
+    def test_up_to_date_outputs_are_skipped(self):
+        settings = PublishSettings(format=PublishFormat.WEBP, max_edge=64)
+        self.publisher.publish(self.ws, RankFilter(min_rank=1), self.out_dir, settings)
+
+        report = self.publisher.publish(self.ws, RankFilter(min_rank=1), self.out_dir, settings)
+        self.assertEqual(0, report.images)
+        self.assertEqual(2, report.skipped)
+
+        output_mtime = self.out_dir.joinpath("a.webp").stat().st_mtime_ns
+        os.utime(self.ws_dir.joinpath("a.png"), ns=(output_mtime + 10 ** 9, output_mtime + 10 ** 9))
+        report = self.publisher.publish(self.ws, RankFilter(min_rank=1), self.out_dir, settings)
+        self.assertEqual(1, report.images)
+        self.assertEqual(1, report.skipped)
+
+    def test_unreadable_images_are_reported_as_failed(self):
+        self.ws_dir.joinpath("a.png").write_text("not an image")
+
+        report = self.publisher.publish(self.ws, RankFilter(min_rank=1), self.out_dir, PublishSettings(PublishFormat.PNG))
+
+        self.assertEqual(1, report.images)
+        self.assertEqual(1, report.failed)
+
+    def test_images_differing_by_extension_only_keep_it_in_the_output_name(self):
+        Image.new('RGB', (50, 50), color='white').save(self.ws_dir.joinpath("a.jpg"))
+        mgr = WorkspaceManager(repo=self.repo)
+        mgr.set_workspace_as_current(self.ws.id)
+        mgr.refresh_current_workspace()
+
+        report = self.publisher.publish(self.ws, RankFilter(), self.out_dir, PublishSettings(PublishFormat.JPEG))
+
+        self.assertEqual(4, report.images)
+        self.assertEqual(
+            {"a.png.jpg", "a.jpg.jpg", "low.jpg", "sub/b.jpg"},
+            {p.relative_to(self.out_dir).as_posix() for p in self.out_dir.rglob("*.jpg")},
+        )
+
+    def test_destination_within_the_workspace_is_rejected(self):
+        settings = PublishSettings(PublishFormat.JPEG)
+        for destination in [self.ws_dir, self.ws_dir.joinpath("published")]:
+            with self.assertRaises(ValueError):
+                self.publisher.publish(self.ws, RankFilter(), destination, settings)
+        self.assertFalse(self.ws_dir.joinpath("published").exists())
+
+    def test_images_pillow_refuses_are_reported_as_failed(self):
+        src, dst = self.ws_dir.joinpath("a.png"), self.out_dir.joinpath("a.jpg")
+        settings = PublishSettings(PublishFormat.JPEG)
+
+        with mock.patch("PIL.Image.MAX_IMAGE_PIXELS", 10):  # a decompression bomb
+            self.assertEqual((_Status.FAILED, 0, 0), _publish_one((str(src), str(dst), settings)))
+        with mock.patch("PIL.Image.Image.save", side_effect=ValueError("bad palette")):
+            self.assertEqual((_Status.FAILED, 0, 0), _publish_one((str(src), str(dst), settings)))
+        self.assertFalse(dst.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,19 @@
 import dataclasses
 import datetime
+import shutil
+import sqlite3
+import tempfile
 import unittest
 from collections import defaultdict
 from pathlib import Path
 from sqlite3 import IntegrityError
 from typing import Dict
+from unittest import mock
 
 from app.model.image_data import ImageData
+from app.model.rank_filter import RankFilter
 from app.model.workspace import Workspace
-from app.repository import Repository
+from app.repository import Repository, SCHEMA_VERSION
 
 
 class RepositoryTests(unittest.TestCase):
@@ -442,6 +447,206 @@ class RepositoryTests(unittest.TestCase):
     def test_image_rank_histogram_can_be_generated_for_non_existing_workspace_and_is_empty(self):
         self.assertDictEqual({}, self.repo.get_image_rank_histogram(2128506))
 
+    # WORKSPACE STATE
+
+    def test_current_image_path_is_kept_per_workspace_and_deleted_with_it(self):
+        ws1 = self.repo.persist_workspace(Workspace(None, "ws1", "foo", datetime.datetime.now()))
+        ws2 = self.repo.persist_workspace(Workspace(None, "ws2", "bar", datetime.datetime.now()))
+        self.assertIsNone(self.repo.get_current_image_path(ws1.id))
+
+        self.repo.set_current_image_path(ws1.id, "foo/a.png")
+        self.repo.set_current_image_path(ws1.id, "foo/b.png")
+        self.repo.set_current_image_path(ws2.id, "bar/c.png")
+
+        self.assertEqual("foo/b.png", self.repo.get_current_image_path(ws1.id))
+        self.assertEqual("bar/c.png", self.repo.get_current_image_path(ws2.id))
+        self.repo.rm_workspace(ws1.id)
+        self.assertIsNone(self.repo.get_current_image_path(ws1.id))
+
+    def test_thumbnails_are_fetched_for_requested_images_only(self):
+        ws = self.repo.persist_workspace(Workspace(None, "ws", "foo", datetime.datetime.now()))
+        now = datetime.datetime.now()
+        self.repo.persist_images(
+            ImageData(ws.id, f"foo/{i:04}.png", 1, now, 1, 1, rank=0, thumbnail=bytes([i % 256]))
+            for i in range(1200)
+        )
+        paths = [f"foo/{i:04}.png" for i in range(0, 1200, 2)] + ["foo/unknown.png"]
+
+        thumbnails = self.repo.get_thumbnails(ws.id, paths)
+
+        self.assertEqual(600, len(thumbnails))
+        self.assertEqual(bytes([10]), thumbnails["foo/0010.png"])
+        self.assertTrue(all(i.thumbnail is None for i in self.repo.get_image_index(ws.id)))
+        self.assertEqual(1200, len(self.repo.get_image_index(ws.id)))
+
+    def test_identical_thumbnails_are_stored_once_and_compacted_when_unused(self):
+        test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        repo = Repository(test_dir.joinpath("db.sqlite3"))
+        try:
+            ws = repo.persist_workspace(Workspace(None, "ws", "/ws", datetime.datetime.now()))
+            now = datetime.datetime.now()
+            repo.persist_images([
+                ImageData(ws.id, "/ws/a.png", 1, now, 1, 1, rank=0, thumbnail=b"same"),
+                ImageData(ws.id, "/ws/b.png", 1, now, 1, 1, rank=0, thumbnail=b"same"),
+                ImageData(ws.id, "/ws/c.png", 1, now, 1, 1, rank=0, thumbnail=b"old-c"),
+            ])
+            pack_files = lambda: sorted(f.name for f in test_dir.joinpath("db.workspaces").glob("*.thumbs"))
+            self.assertEqual(["1.1.thumbs"], pack_files())
+            self.assertEqual(9, test_dir.joinpath("db.workspaces", "1.1.thumbs").stat().st_size)
+
+            repo.persist_image(ImageData(ws.id, "/ws/c.png", 1, now, 1, 1, rank=0, thumbnail=b"new-c"))
+            repo.rm_image(ws.id, "/ws/b.png")
+            thumbnails = repo.get_thumbnails(ws.id, ["/ws/a.png", "/ws/c.png"])
+            self.assertIsInstance(thumbnails["/ws/a.png"], memoryview)
+
+            self.assertEqual(5, repo.compact_thumbnails(ws.id))
+            self.assertEqual(0, repo.compact_thumbnails(ws.id))
+
+            self.assertEqual(["1.2.thumbs"], pack_files())
+            self.assertEqual(b"same", thumbnails["/ws/a.png"])  # views handed out before stay valid
+            self.assertEqual({"/ws/a.png": b"same", "/ws/c.png": b"new-c"},
+                             {p: bytes(t) for p, t in repo.get_thumbnails(ws.id, ["/ws/a.png", "/ws/c.png"]).items()})
+            self.assertEqual(b"new-c", repo.get_image(ws.id, "/ws/c.png").thumbnail)
+
+            repo.rm_workspace(ws.id)
+            self.assertEqual([], pack_files())
+        finally:
+            repo.close()
+            shutil.rmtree(test_dir)
+
+    def test_thumbnail_cache_counts_images_and_evicts_unused_first(self):
+        repo = Repository(Path(":memory:"), thumbnail_cache_size=20)
+        ws = repo.persist_workspace(Workspace(None, "ws", "/ws", datetime.datetime.now()))
+        now = datetime.datetime.now()
+
+        def mk_image(name: str, source: bytes, thumbnail: bytes = b"0123456789") -> ImageData:
+            return ImageData(ws.id, f"/ws/{name}", 1, now, 3, 2, rank=0, thumbnail=thumbnail, source_key=source)
+
+        def refs() -> Dict[bytes, int]:
+            with repo._connections.read() as connection:
+                return dict(connection.execute("SELECT key, refs FROM thumbnail_cache"))
+
+        repo.persist_images([mk_image("a.png", b"A"), mk_image("b.png", b"A"), mk_image("c.png", b"C")])
+        self.assertEqual({b"A": 2, b"C": 1}, refs())
+        self.assertEqual((b"0123456789", 3, 2), repo.get_cached_thumbnail(b"A"))
+
+        repo.rm_image(ws.id, "/ws/c.png")
+        repo.move_images(ws.id, [("/ws/a.png", "/ws/b.png")])
+        self.assertEqual({b"A": 1, b"C": 0}, refs())
+
+        # over the size: unused C goes, then the least recently used A to get to 90% of it
+        repo.persist_image(mk_image("d.png", b"D", b"abcdefghij"))
+        self.assertEqual({b"D": 1}, refs())
+        self.assertIsNone(repo.get_cached_thumbnail(b"C"))
+        self.assertEqual(b"0123456789", repo.get_image(ws.id, "/ws/b.png").thumbnail)  # the workspace keeps it
+
+        repo.persist_image(mk_image("e.png", b"E", b"klmnopqrst"))
+        repo.persist_image(mk_image("f.png", b"F", b"uvwxyz0123"))  # evicts D and E, the pack is compacted
+        self.assertEqual((b"uvwxyz0123", 3, 2), repo.get_cached_thumbnail(b"F"))
+        self.assertEqual(0, repo.compact_thumbnail_cache())
+
+        repo.rm_workspace(ws.id)
+        self.assertEqual({b"F": 0}, refs())
+        repo.close()
+
+    # DIRECTORIES
+
+    def mk_images_in_tree(self) -> Workspace:
+        ws = self.repo.persist_workspace(Workspace(None, "tree", "/ws/root", datetime.datetime.now()))
+        now = datetime.datetime.now()
+        paths = ["/ws/root/b.png", "/ws/root/a.png", "/ws/root/sub/c.png", "/ws/root/sub dir/d.png", "/outside/e.png"]
+        self.repo.persist_images(ImageData(ws.id, p, 1, now, 1, 1, rank=i) for i, p in enumerate(paths))
+        return ws
+
+    def test_images_follow_the_moved_workspace_root(self):
+        ws = self.mk_images_in_tree()
+        ranks_before = {Path(i.path).name: i.rank for i in self.repo.get_all_images_for_workspace(ws.id)}
+        statements_before = self.repo.statements_executed
+
+        moved = self.repo.persist_workspace(dataclasses.replace(ws, path="/moved/root"))
+
+        # workspaces of the same name (before and within the transaction), begin, change counter increment
+        # and read, update, commit, read back
+        self.assertEqual(8, self.repo.statements_executed - statements_before)
+        self.assertEqual(ws.id, moved.id)
+        images = self.repo.get_all_images_for_workspace(ws.id)
+        self.assertEqual(
+            ["/moved/root/a.png", "/moved/root/b.png", "/moved/root/sub dir/d.png", "/moved/root/sub/c.png",
+             "/outside/e.png"],
+            [i.path for i in images],
+        )
+        self.assertEqual(ranks_before, {Path(i.path).name: i.rank for i in images})
+        self.assertEqual(2, self.repo.get_image(ws.id, "/moved/root/sub/c.png").rank)
+        self.assertIsNone(self.repo.get_image(ws.id, "/ws/root/sub/c.png"))
+
+    def test_images_are_ordered_by_full_path(self):
+        ws = self.mk_images_in_tree()
+
+        paths = [i.path for i in self.repo.get_image_index(ws.id)]
+
+        # "sub dir/" goes before "sub/", even though the directory "sub" sorts before "sub dir"
+        self.assertEqual(sorted(paths), paths)
+
+    @mock.patch("app.repository._IMAGES_PAGE_SIZE", 2)
+    def test_images_by_rank_are_read_in_pages_without_holding_a_snapshot(self):
+        test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.addCleanup(shutil.rmtree, test_dir)
+        self.repo = Repository(test_dir.joinpath("database.sqlite3"))
+        self.addCleanup(self.repo.close)
+        ws = self.mk_images_in_tree()
+
+        images = self.repo.iter_images_by_rank(ws.id, RankFilter(min_rank=1))
+        first_page = [next(images), next(images)]
+        d = self.repo.get_image(ws.id, "/ws/root/sub dir/d.png")
+        self.repo.persist_image(dataclasses.replace(d, rank=7))  # between the pages
+        rest = list(images)
+
+        self.assertEqual(["/outside/e.png", "/ws/root/a.png"], [i.path for i in first_page])
+        self.assertEqual([("/ws/root/sub dir/d.png", 7), ("/ws/root/sub/c.png", 2)], [(i.path, i.rank) for i in rest])
+
+    def test_directory_images_are_listed_without_subdirectories(self):
+        ws = self.mk_images_in_tree()
+
+        self.assertEqual(
+            ["/ws/root/a.png", "/ws/root/b.png"],
+            [i.path for i in self.repo.get_directory_image_index(ws.id, "/ws/root")],
+        )
+        self.assertEqual(
+            ["/ws/root/sub/c.png"],
+            [i.path for i in self.repo.get_directory_image_index(ws.id, "/ws/root/sub/")],
+        )
+        self.assertEqual([], self.repo.get_directory_image_index(ws.id, "/ws/root/missing"))
+
+    def test_images_can_be_moved_between_directories(self):
+        ws = self.mk_images_in_tree()
+
+        self.repo.move_images(ws.id, [("/ws/root/sub/c.png", "/ws/root/new/c.png")])
+
+        self.assertEqual(2, self.repo.get_image(ws.id, "/ws/root/new/c.png").rank)
+        self.assertEqual([], self.repo.get_directory_image_index(ws.id, "/ws/root/sub"))
+        self.assertEqual(5, len(self.repo.get_image_states(ws.id)))
+
+    # SCHEMA
+
+    def test_schema_setup_is_skipped_when_version_matches(self):
+        test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        try:
+            db_file = test_dir.joinpath("db.sqlite3")
+            first = Repository(db_file)
+            statements_on_create = first.statements_executed
+            ws = first.persist_workspace(Workspace(id=None, name="ws", path="foo", last_used_at=datetime.datetime.now()))
+            del first
+
+            with sqlite3.connect(db_file) as conn:
+                self.assertEqual(SCHEMA_VERSION, conn.execute("PRAGMA user_version").fetchone()[0])
+            reopened = Repository(db_file)
+            self.assertLess(reopened.statements_executed, statements_on_create)
+            self.assertEqual(1, reopened.statements_executed)  # the version check, connection pragmas are not traced
+            self.assertEqual([ws], reopened.get_all_workspaces())
+            del reopened
+        finally:
+            shutil.rmtree(test_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,240 @@
+import dataclasses
+import datetime
+import multiprocessing
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from typing import Iterator
+from unittest import mock
+
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.repository import Repository
+
+
+def _writer_threads() -> int:
+    return sum(1 for t in threading.enumerate() if t.name == "db-writer")
+
+
+def _write_in_process(db_file: Path, ws_id: int, process: int):
+    repo = Repository(db_file)
+    try:
+        for batch in range(10):
+            repo.persist_images(
+                ImageData(ws_id, f"/ws/p{process}-{batch}-{i}.png", 1, datetime.datetime.now(), 1, 1, rank=process)
+                for i in range(5)
+            )
+    finally:
+        repo.close()
+
+
+class RepositoryConcurrencyTests(unittest.TestCase):
+    test_dir: Path
+    db_file: Path
+    repo: Repository
+    ws: Workspace
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.db_file = self.test_dir.joinpath("database.sqlite3")
+        self.repo = Repository(self.db_file)
+        self.ws = self.repo.persist_workspace(Workspace(None, "ws", "/ws", datetime.datetime.now()))
+
+    def tearDown(self) -> None:
+        self.repo.close()
+        shutil.rmtree(self.test_dir)
+
+    def mk_image(self, name: str, rank: int = 0) -> ImageData:
+        return ImageData(self.ws.id, f"/ws/{name}", 1, datetime.datetime.now(), 1, 1, rank=rank)
+
+    def test_database_file_uses_wal_and_closing_stops_the_writer(self):
+        with sqlite3.connect(self.db_file) as conn:
+            self.assertEqual("wal", conn.execute("PRAGMA journal_mode").fetchone()[0])
+        conn.close()
+        writers = _writer_threads()
+
+        self.repo.close()
+
+        self.assertEqual(writers - 1, _writer_threads())
+        with self.assertRaises(sqlite3.ProgrammingError):
+            self.repo.persist_image(self.mk_image("a.png"))
+
+    def test_reads_do_not_wait_for_the_writer(self):
+        self.repo.persist_image(self.mk_image("before.png"))
+        writing = threading.Event()
+        release = threading.Event()
+
+        def slow_images() -> Iterator[ImageData]:
+            writing.set()
+            release.wait(10)
+            yield self.mk_image("after.png")
+
+        writer = threading.Thread(target=self.repo.persist_images, args=(slow_images(),))
+        writer.start()
+        try:
+            self.assertTrue(writing.wait(10))
+            # the writer thread is busy, reads go to the reader connections
+            self.assertEqual(["/ws/before.png"], [i.path for i in self.repo.get_image_index(self.ws.id)])
+            self.assertEqual({0: 1}, self.repo.get_image_rank_histogram(self.ws.id))
+        finally:
+            release.set()
+            writer.join(10)
+
+        self.assertEqual(2, len(self.repo.get_image_index(self.ws.id)))
+
+    def test_reads_see_committed_state_while_another_process_writes(self):
+        other = sqlite3.connect(self.db_file)
+        try:
+            other.execute("BEGIN IMMEDIATE")
+            other.execute("INSERT INTO workspace (name, path) VALUES ('uncommitted', '/elsewhere')")
+
+            self.assertEqual(["ws"], [ws.name for ws in self.repo.get_all_workspaces()])
+
+            other.commit()
+            self.assertEqual({"ws", "uncommitted"}, {ws.name for ws in self.repo.get_all_workspaces()})
+        finally:
+            other.close()
+
+    def test_concurrent_writers_and_readers(self):
+        errors = []
+
+        def write(thread: int):
+            try:
+                for batch in range(10):
+                    self.repo.persist_images(self.mk_image(f"{thread}-{batch}-{i}.png", rank=thread) for i in range(5))
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for _ in range(50):
+                    self.repo.get_image_rank_histogram(self.ws.id)
+                    self.repo.get_image_index(self.ws.id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(t,)) for t in range(4)]
+        threads += [threading.Thread(target=read) for _ in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+
+        self.assertEqual([], errors)
+        self.assertEqual({0: 50, 1: 50, 2: 50, 3: 50}, self.repo.get_image_rank_histogram(self.ws.id))
+
+
+    def test_processes_write_concurrently(self):
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=_write_in_process, args=(self.db_file, self.ws.id, p)) for p in range(3)]
+        for p in processes:
+            p.start()
+        self.repo.persist_images(self.mk_image(f"main-{i}.png", rank=9) for i in range(5))
+        for p in processes:
+            p.join(60)
+
+        self.assertEqual([0, 0, 0], [p.exitcode for p in processes])
+        self.assertEqual({0: 50, 1: 50, 2: 50, 9: 5}, self.repo.get_image_rank_histogram(self.ws.id))
+
+    def test_writes_are_retried_while_another_process_holds_the_lock(self):
+        repo = Repository(self.db_file, busy_timeout=0.01)
+        other = sqlite3.connect(self.db_file, check_same_thread=False)
+        try:
+            other.execute("BEGIN IMMEDIATE")
+            release = threading.Timer(0.3, other.commit)
+            release.start()
+
+            with self.assertLogs("app.db_connections", level="WARNING") as logs:
+                repo.persist_image(self.mk_image("a.png"))
+
+            release.join()
+            self.assertIn("retry 1/", logs.output[0])
+            self.assertEqual(["/ws/a.png"], [i.path for i in self.repo.get_image_index(self.ws.id)])
+        finally:
+            other.close()
+            repo.close()
+
+
+class RepositoryChangeTrackingTests(unittest.TestCase):
+    test_dir: Path
+    db_file: Path
+    repo: Repository
+    other: Repository  # another process sharing the database
+    ws: Workspace
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.db_file = self.test_dir.joinpath("database.sqlite3")
+        self.repo = Repository(self.db_file)
+        self.other = Repository(self.db_file)
+        self.ws = self.repo.persist_workspace(Workspace(None, "ws", "/ws", datetime.datetime.now()))
+
+    def tearDown(self) -> None:
+        self.repo.close()
+        self.other.close()
+        shutil.rmtree(self.test_dir)
+
+    def mk_image(self, name: str, rank: int = 0) -> ImageData:
+        return ImageData(self.ws.id, f"/ws/{name}", 1, datetime.datetime.now(), 1, 1, rank=rank, thumbnail=b"t")
+
+    def test_changes_made_by_another_process_are_polled(self):
+        self.other.persist_images([self.mk_image("a.png"), self.mk_image("b.png"), self.mk_image("gone.png")])
+        seq = self.repo.get_change_seq()
+
+        self.other.persist_image(self.mk_image("a.png", rank=3))
+        self.other.rm_images(self.ws.id, ["/ws/b.png"])
+        self.other.persist_image(self.mk_image("c.png"))
+        self.other.move_images(self.ws.id, [("/ws/gone.png", "/ws/sub/moved.png")])
+        self.repo.persist_image(self.mk_image("own.png"))
+
+        seq, change = self.repo.get_changes_since(self.ws.id, seq)
+        self.assertEqual(["/ws/a.png", "/ws/c.png", "/ws/sub/moved.png"], [i.path for i in change.updated])
+        self.assertEqual(3, change.updated[0].rank)
+        self.assertTrue(all(i.thumbnail is None for i in change.updated))
+        self.assertEqual(["/ws/b.png", "/ws/gone.png"], change.removed)
+        self.assertEqual(self.repo.get_change_seq(), seq)
+
+        self.assertEqual((seq, WorkspaceChange(self.ws.id, [], [])), self.repo.get_changes_since(self.ws.id, seq))
+        _, change = self.other.get_changes_since(self.ws.id, seq - 1)
+        self.assertEqual(["/ws/own.png"], [i.path for i in change.updated])
+
+    def test_removed_and_added_again_is_an_update(self):
+        self.other.persist_image(self.mk_image("a.png"))
+        seq = self.repo.get_change_seq()
+
+        self.other.rm_image(self.ws.id, "/ws/a.png")
+        self.other.persist_image(self.mk_image("a.png", rank=1))
+
+        _, change = self.repo.get_changes_since(self.ws.id, seq)
+        self.assertEqual(["/ws/a.png"], [i.path for i in change.updated])
+        self.assertEqual([], change.removed)
+
+    def test_workspace_is_reloaded_if_the_changes_cant_be_told(self):
+        self.other.persist_image(self.mk_image("a.png"))
+        seq = self.repo.get_change_seq()
+        self.assertEqual("/ws/a.png", self.repo.get_image(self.ws.id, "/ws/a.png").path)  # the root is cached
+
+        self.other.persist_workspace(dataclasses.replace(self.ws, last_used_at=datetime.datetime.now()))
+        seq, change = self.repo.get_changes_since(self.ws.id, seq)
+        self.assertIsNotNone(change)
+        self.other.persist_workspace(dataclasses.replace(self.ws, path="/moved"))
+        seq, change = self.repo.get_changes_since(self.ws.id, seq)
+        self.assertIsNone(change)
+        self.assertEqual("/moved/a.png", self.repo.get_image(self.ws.id, "/moved/a.png").path)
+
+        with mock.patch("app.repository._REMOVALS_KEPT", 1):
+            self.other.persist_image(dataclasses.replace(self.mk_image("b.png"), path="/moved/b.png"))
+            self.other.rm_image(self.ws.id, "/moved/a.png")
+            self.other.rm_image(self.ws.id, "/moved/b.png")  # forgets removal of a.png
+            self.assertIsNone(self.repo.get_changes_since(self.ws.id, seq)[1])
+
+        self.other.rm_workspace(self.ws.id)
+        self.assertIsNone(self.repo.get_changes_since(self.ws.id, self.repo.get_change_seq() - 1)[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
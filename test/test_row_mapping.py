@@ -0,0 +1,68 @@
+import sqlite3
+import unittest
+from datetime import datetime
+
+from app.model.image_data import ImageData
+from app.model.workspace import Workspace
+from app.row_mapping import RowMapper
+from app.utils import datetime_to_ns
+
+
+class RowMapperTests(unittest.TestCase):
+    connection: sqlite3.Connection
+
+    def setUp(self) -> None:
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("CREATE TABLE workspace (id integer, name text, path text, last_used_ns integer)")
+        self.connection.execute("INSERT INTO workspace VALUES (1, 'one', '/one', ?)",
+                                (datetime_to_ns(datetime(2024, 1, 2, 3, 4, 5, 6)),))
+        self.connection.execute("INSERT INTO workspace VALUES (2, 'two', '/two', NULL)")
+
+    def tearDown(self) -> None:
+        self.connection.close()
+
+    def test_columns_are_matched_by_name_in_any_order(self):
+        cur = self.connection.cursor()
+        cur.row_factory = Workspace.row_factory
+        expected = [
+            Workspace(1, "one", "/one", datetime(2024, 1, 2, 3, 4, 5, 6)),
+            Workspace(2, "two", "/two", None),  # NULL is not converted
+        ]
+
+        # the same cursor, positions are resolved for every statement
+        self.assertEqual(expected, cur.execute("SELECT * FROM workspace ORDER BY id").fetchall())
+        self.assertEqual(
+            expected,
+            cur.execute("SELECT path, last_used_ns, 42 AS extra, name, id FROM workspace ORDER BY id").fetchall(),
+        )
+
+    def test_missing_column_is_reported(self):
+        cur = self.connection.cursor()
+        cur.row_factory = Workspace.row_factory
+
+        with self.assertRaises(KeyError):
+            cur.execute("SELECT id, name FROM workspace").fetchall()
+
+    def test_single_column(self):
+        cur = self.connection.cursor()
+        cur.row_factory = RowMapper(str.upper, ["name"])
+
+        self.assertEqual(["ONE", "TWO"], cur.execute("SELECT id, name FROM workspace ORDER BY id").fetchall())
+
+    def test_image_data_rows(self):
+        self.connection.execute("CREATE TABLE image_data (workspace_id integer, path text, size integer,"
+                                " last_updated_ns integer, width integer, height integer, thumbnail blob, rank integer)")
+        self.connection.execute("INSERT INTO image_data VALUES (1, '/one/a.png', 10, 1700000000123456000, 4, 3, x'00', 2)")
+        cur = self.connection.cursor()
+        cur.row_factory = ImageData.row_factory
+
+        img = cur.execute("SELECT * FROM image_data").fetchone()
+
+        self.assertEqual((4, 3), img.dimensions)
+        self.assertEqual(2, img.rank)
+        self.assertEqual(b"\x00", img.thumbnail)
+        self.assertEqual(1700000000123456000, datetime_to_ns(img.last_updated_at))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+
+from app.model.scan_rules import ScanRules, DEFAULT_EXTENSIONS
+
+
+class ScanRulesTests(unittest.TestCase):
+
+    def test_names_match_at_any_depth_and_slashes_anchor_to_the_root(self):
+        matcher = ScanRules(patterns="*.tmp.png\n/latents\nout/old\n").compile()
+
+        self.assertTrue(matcher.excludes("a.tmp.png", is_dir=False))
+        self.assertTrue(matcher.excludes("x/y/a.tmp.png", is_dir=False))
+        self.assertFalse(matcher.excludes("x/a.tmp.png/b.png", is_dir=False))
+        self.assertTrue(matcher.excludes("latents", is_dir=True))
+        self.assertFalse(matcher.excludes("x/latents", is_dir=True))
+        self.assertTrue(matcher.excludes("out/old", is_dir=True))
+        self.assertFalse(matcher.excludes("x/out/old", is_dir=True))
+        self.assertFalse(matcher.excludes("a.png", is_dir=False))
+
+    def test_double_stars_match_any_directories(self):
+        matcher = ScanRules(patterns="**/venv/\nruns/**/*.webp.png\ncache/**\n").compile()
+
+        self.assertTrue(matcher.excludes("venv", is_dir=True))
+        self.assertTrue(matcher.excludes("a/b/venv", is_dir=True))
+        self.assertTrue(matcher.excludes("runs/x.webp.png", is_dir=False))
+        self.assertTrue(matcher.excludes("runs/1/2/x.webp.png", is_dir=False))
+        self.assertTrue(matcher.excludes("cache/a/b.png", is_dir=False))
+        self.assertFalse(matcher.excludes("cache", is_dir=True))  # only what's inside
+
+    def test_trailing_slash_matches_directories_only(self):
+        matcher = ScanRules(patterns="# caches\n.cache/\n").compile()
+
+        self.assertTrue(matcher.excludes(".cache", is_dir=True))
+        self.assertTrue(matcher.excludes("a/.cache", is_dir=True))
+        self.assertFalse(matcher.excludes(".cache", is_dir=False))
+
+    def test_last_matching_pattern_wins(self):
+        matcher = ScanRules(patterns="grid_*.png\n!grid_final.png\n\\!literal.png\n[ab]?.png\n").compile()
+
+        self.assertTrue(matcher.excludes("grid_01.png", is_dir=False))
+        self.assertFalse(matcher.excludes("x/grid_final.png", is_dir=False))
+        self.assertTrue(matcher.excludes("!literal.png", is_dir=False))
+        self.assertTrue(matcher.excludes("b1.png", is_dir=False))
+        self.assertFalse(matcher.excludes("c1.png", is_dir=False))
+        self.assertFalse(ScanRules().compile().excludes("anything", is_dir=True))
+
+    def test_extensions_are_configurable(self):
+        self.assertEqual((".jpg", ".png", ".webp"), ScanRules.parse_extensions("JPG, .png webp jpg"))
+        matcher = ScanRules(extensions=(".webp",)).compile()
+
+        self.assertTrue(matcher.is_image("a.WEBP"))
+        self.assertFalse(matcher.is_image("a.png"))
+        self.assertTrue(ScanRules().compile().is_image("a.tiff"))
+        self.assertIn(".jpeg", DEFAULT_EXTENSIONS)
+
+
+if __name__ == "__main__":
+    unittest.main()
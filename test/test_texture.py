@@ -0,0 +1,51 @@
+import unittest
+
+import numpy
+
+from app.gui.components.texture import PixelFormat, _fit, _pixel_array, _unpack_alignment
+from app.gui.navigator_window import upload_edge
+
+
+# only the pixel layout, uploads need an OpenGL context
+class TexturePixelsTests(unittest.TestCase):
+
+    def test_arrays_are_uploaded_from_views_without_copies(self):
+        pixels = numpy.zeros((50, 61, 3), dtype=numpy.uint8)
+        crop = pixels[5:25, 3:40]
+
+        array = _pixel_array(crop, 37, 20, None)
+
+        self.assertTrue(numpy.shares_memory(array, pixels))
+        self.assertEqual((61 * 3, 3, 1), array.strides)  # rows of the whole array, see `GL_UNPACK_ROW_LENGTH`
+        gray = _pixel_array(numpy.zeros((4, 5), dtype=numpy.uint8), 5, 4, None)
+        self.assertEqual((4, 5, 1), gray.shape)
+        self.assertIs(PixelFormat.L, PixelFormat.of_channels(gray.shape[2]))
+
+    def test_buffers_are_packed_rows_of_the_given_format(self):
+        buffer = bytearray(range(2 * 3 * 3))
+
+        array = _pixel_array(memoryview(buffer), 3, 2, PixelFormat.RGB)
+
+        self.assertEqual((2, 3, 3), array.shape)
+        self.assertTrue(numpy.shares_memory(array, numpy.frombuffer(buffer, dtype=numpy.uint8)))
+        self.assertEqual(4, _pixel_array(bytes(16), 2, 2, None).shape[2])  # RGBA by default
+        with self.assertRaises(ValueError):
+            _pixel_array(bytes(16), 2, 2, PixelFormat.RGB)
+        with self.assertRaises(ValueError):
+            _pixel_array(numpy.zeros((2, 2, 3), dtype=numpy.float32), 2, 2, None)
+
+    def test_unpack_alignment_matches_the_rows(self):
+        self.assertEqual(8, _unpack_alignment(64 * 4))
+        self.assertEqual(4, _unpack_alignment(4 * 3))
+        self.assertEqual(2, _unpack_alignment(2 * 3))
+        self.assertEqual(1, _unpack_alignment(37 * 3))
+
+    def test_uploads_are_scaled_to_the_largest_size_drawn(self):
+        self.assertEqual(256, upload_edge(256.0))
+        self.assertEqual(512, upload_edge(256.0 * 1.25))  # a scaled display
+        self.assertEqual((256, 144), _fit((1920, 1080), 256))
+        self.assertEqual((1, 256), _fit((10, 4000), 256))
+
+
+if __name__ == "__main__":
+    unittest.main()
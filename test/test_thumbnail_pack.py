@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+from app.thumbnail_pack import ThumbnailPack, thumbnail_key
+
+
+class ThumbnailPackTests(unittest.TestCase):
+    test_dir: Path
+    pack: ThumbnailPack
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.pack = ThumbnailPack.for_database(self.test_dir.joinpath("7.sqlite3"))
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.test_dir)
+
+    def test_appended_thumbnails_are_read_as_views_of_the_file(self):
+        offsets = self.pack.append(1, [b"first", b"second"])
+
+        self.assertEqual([0, 5], offsets)
+        self.assertEqual(self.test_dir.joinpath("7.1.thumbs"), self.pack.file(1))
+        view = self.pack.view(1, 5, 6)
+        self.assertIsInstance(view, memoryview)
+        self.assertEqual(b"second", view)
+        self.assertEqual(16, len(thumbnail_key(b"second")))
+
+    def test_file_grown_by_another_writer_is_mapped_again(self):
+        self.pack.append(1, [b"first"])
+        first = self.pack.view(1, 0, 5)
+
+        offset, = ThumbnailPack(self.test_dir, "7").append(1, [b"second"])
+
+        self.assertEqual(b"second", self.pack.view(1, offset, 6))
+        self.assertEqual(b"first", first)
+        self.assertIsNone(self.pack.view(1, offset, 7))  # past the end, e.g. lost by a crash
+        self.assertIsNone(self.pack.view(2, 0, 1))
+
+    def test_compaction_copies_live_thumbnails_to_the_next_generation(self):
+        self.pack.append(1, [b"dead", b"live", b"also-live"])
+
+        offsets = self.pack.compact(1, [(4, 4), (8, 9), (100, 1)])
+        self.pack.remove_generations(keep=2)
+
+        self.assertEqual([0, 4, None], offsets)
+        self.assertEqual(b"also-live", self.pack.view(2, 4, 9))
+        self.assertEqual(13, self.pack.size(2))
+        self.assertFalse(self.pack.file(1).exists())
+        self.pack.remove_generations()
+        self.assertEqual([], list(self.test_dir.iterdir()))
+
+
+if __name__ == "__main__":
+    unittest.main()
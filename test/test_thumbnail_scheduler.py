@@ -0,0 +1,44 @@
+import unittest
+from pathlib import Path
+from typing import List
+
+from app.thumbnail_scheduler import ThumbnailScheduler
+
+
+class ThumbnailSchedulerTests(unittest.TestCase):
+
+    @staticmethod
+    def take(scheduler: ThumbnailScheduler, count: int) -> List[str]:
+        return [scheduler.next().name for _ in range(count)]
+
+    def test_images_are_taken_in_path_order_without_focus(self):
+        scheduler = ThumbnailScheduler()
+        scheduler.schedule([Path(f"/ws/{n}.png") for n in "cab"])
+
+        self.assertEqual(["a.png", "b.png", "c.png"], self.take(scheduler, 3))
+        self.assertIsNone(scheduler.next())
+        self.assertEqual(0, len(scheduler))
+
+    def test_visible_images_come_first_nearest_to_the_current_one(self):
+        scheduler = ThumbnailScheduler(focus=("/ws/e.png", "/ws/c.png", "/ws/h.png"))
+        scheduler.schedule([Path(f"/ws/{n}.png") for n in "abcdefghij"])
+
+        self.assertEqual(["e", "d", "f", "c", "g", "h", "b", "a", "i", "j"],
+                         [p[0] for p in self.take(scheduler, 10)])
+
+    def test_jump_reprioritizes_the_pending_images(self):
+        scheduler = ThumbnailScheduler()
+        scheduler.schedule([Path(f"/ws/{i:02}.png") for i in range(20)])
+        scheduler.focus("/ws/02.png", "/ws/01.png", "/ws/03.png")
+        self.assertEqual(["02.png", "01.png", "03.png"], self.take(scheduler, 3))
+
+        scheduler.focus("/ws/15.png", "/ws/14.png", "/ws/16.png")  # the slider moved
+        self.assertEqual(["15.png", "14.png", "16.png", "13.png"], self.take(scheduler, 4))
+
+        scheduler.focus("/ws/02.png", "/ws/00.png", "/ws/04.png")  # and back, the ones done are skipped
+        self.assertEqual(["00.png", "04.png", "05.png"], self.take(scheduler, 3))
+        self.assertEqual(10, len(scheduler))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import datetime
+import io
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from dataclasses import replace
+from pathlib import Path
+from typing import List
+
+from PIL import Image
+
+from app.maintenance import Maintenance
+from app.model.image_data import ImageData, PREVIEW_SIZE, THUMBNAIL_SIZE
+from app.model.workspace import Workspace
+from app.model.workspace_change import WorkspaceChange
+from app.repository import Repository
+from app.thumbnail_worker import ThumbnailWorker
+from app.utils import ns_to_datetime
+
+
+class ThumbnailWorkerTests(unittest.TestCase):
+    test_dir: Path
+    repo: Repository
+    ws: Workspace
+    changes: List[WorkspaceChange]
+
+    def setUp(self) -> None:
+        self.test_dir = Path(tempfile.mkdtemp(prefix="picreview_test_"))
+        self.repo = Repository(self.test_dir.joinpath("database.sqlite3"))
+        self.ws = self.repo.persist_workspace(Workspace(None, "ws", str(self.test_dir), datetime.datetime.now()))
+        self.changes = []
+
+    def tearDown(self) -> None:
+        self.repo.close()
+        shutil.rmtree(self.test_dir)
+
+    def mk_image(self, name: str, with_thumbnail: bool = True) -> ImageData:
+        path = self.test_dir.joinpath(name)
+        Image.new('RGB', (1024, 512), color='white').save(path)
+        image = ImageData.from_file(path, self.ws.id, with_thumbnail=with_thumbnail)
+        self.repo.persist_images([image])
+        return image
+
+    def worker(self) -> ThumbnailWorker:
+        return ThumbnailWorker(self.repo, Maintenance(self.repo), lambda: self.ws, self.changes.append,
+                               idle_after=0, cpu_share=1.0, read_rate=float("inf"))
+
+    def test_previews_and_missing_thumbnails_are_made(self):
+        with_thumbnail = self.mk_image("a.png")
+        without_thumbnail = self.mk_image("b.png", with_thumbnail=False)  # e.g. restored by a rollback
+        thumbnail = bytes(self.repo.get_thumbnails(self.ws.id, [with_thumbnail.path])[with_thumbnail.path])
+
+        self.assertTrue(self.worker().run(self.ws.id))
+
+        self.assertEqual([], self.repo.get_images_without_previews(self.ws.id))
+        self.assertEqual([[with_thumbnail.path, without_thumbnail.path]], [c.thumbnails for c in self.changes])
+        thumbnails = self.repo.get_thumbnails(self.ws.id, [with_thumbnail.path, without_thumbnail.path])
+        self.assertEqual(thumbnail, bytes(thumbnails[with_thumbnail.path]))  # kept
+        with Image.open(io.BytesIO(thumbnails[without_thumbnail.path])) as img:
+            self.assertEqual((THUMBNAIL_SIZE, THUMBNAIL_SIZE // 2), img.size)
+        previews = self.repo.get_thumbnails(self.ws.id, [with_thumbnail.path], previews=True)
+        with Image.open(io.BytesIO(previews[with_thumbnail.path])) as img:
+            self.assertEqual((PREVIEW_SIZE, PREVIEW_SIZE // 2), img.size)
+        # previews are not garbage to compactions
+        self.assertEqual(0, self.repo.thumbnail_garbage(self.ws.id))
+
+    def test_previews_of_updated_images_are_made_again(self):
+        image = self.mk_image("a.png")
+        self.worker().run(self.ws.id)
+
+        updated = replace(image, last_updated_at=ns_to_datetime(10 ** 18))
+        self.repo.persist_images([updated])  # as a refresh does
+
+        self.assertEqual([image.path], [i.path for i in self.repo.get_images_without_previews(self.ws.id)])
+        # previews made of the image as it was before are left out
+        self.assertEqual([], self.repo.persist_previews(self.ws.id, [image], [image.thumbnail]))
+        self.assertEqual([image.path], self.repo.persist_previews(self.ws.id, [updated], [image.thumbnail]))
+
+    def test_run_stops_between_images_once_cancelled(self):
+        for name in ["a.png", "b.png", "c.png"]:
+            self.mk_image(name)
+        checks = []
+
+        complete = self.worker().run(self.ws.id, cancel=lambda: checks.append(1) or len(checks) > 1)
+
+        self.assertFalse(complete)
+        self.assertEqual([[str(self.test_dir.joinpath("a.png"))]], [c.thumbnails for c in self.changes])
+        self.assertEqual(2, len(self.repo.get_images_without_previews(self.ws.id)))
+
+    def test_user_activity_cuts_the_throttle_sleep_short(self):
+        for name in ["a.png", "b.png"]:
+            self.mk_image(name)
+        activity = Maintenance(self.repo)
+        # reading a file takes hours at that rate
+        worker = ThumbnailWorker(self.repo, activity, lambda: self.ws, self.changes.append,
+                                 idle_after=0, cpu_share=1.0, read_rate=1.0)
+        cancelled = threading.Event()
+        result = []
+        thread = threading.Thread(target=lambda: result.append(worker.run(self.ws.id, cancel=cancelled.is_set)),
+                                  daemon=True)
+        thread.start()
+        time.sleep(0.5)  # the first preview is made, the worker sleeps
+        cancelled.set()
+
+        started = time.monotonic()
+        activity.touch()
+        thread.join(timeout=5.0)
+
+        self.assertFalse(thread.is_alive())
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual([False], result)
+        self.assertEqual([[str(self.test_dir.joinpath("a.png"))]], [c.thumbnails for c in self.changes])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,7 +2,7 @@ import unittest
 
 from parameterized import parameterized
 
-from app.utils import sizeof_fmt
+from app.utils import sizeof_fmt, ns_to_datetime, datetime_to_ns, split_path
 
 
 class TestSizeofFmt(unittest.TestCase):
@@ -33,5 +33,43 @@ class TestSizeofFmt(unittest.TestCase):
         self.assertEqual(expected_output, result)
 
 
+class TestTimestampConversion(unittest.TestCase):
+
+    @parameterized.expand([
+        (0,),
+        (1_700_000_000_123_456_789,),
+        (1_700_000_000_999_999_999,),
+        (1_700_000_000_000_000_001,),
+        (1_711_846_799_500_000_000,),
+        (7_258_118_399_999_999_999,),  # 2199-12-31 23:59:59.999999 UTC
+        (-1_234_567_890,),
+    ])
+    def test_ns_round_trip_is_exact_to_microseconds(self, ns):
+        dt = ns_to_datetime(ns)
+        self.assertEqual(ns // 1000 * 1000, datetime_to_ns(dt))
+        self.assertEqual(dt, ns_to_datetime(datetime_to_ns(dt)))
+        self.assertEqual((ns // 1000) % 10 ** 6, dt.microsecond)
+
+
+class TestSplitPath(unittest.TestCase):
+
+    @parameterized.expand([
+        ("/ws/a.png", "/ws", (True, "", "a.png")),
+        ("/ws/sub/deeper/a.png", "/ws", (True, "sub/deeper/", "a.png")),
+        ("/ws/a.png", "/ws/", (True, "", "a.png")),
+        ("/a.png", "/", (True, "", "a.png")),
+        ("/wsx/a.png", "/ws", (False, "/wsx/", "a.png")),
+        ("/other/a.png", "/ws", (False, "/other/", "a.png")),
+        ("a.png", "/ws", (False, "", "a.png")),
+        ("/ws/a.png", None, (False, "/ws/", "a.png")),
+    ])
+    def test_split_path(self, path, root, expected):
+        relative, directory, name = split_path(path, root)
+
+        self.assertEqual(expected, (relative, directory, name))
+        rebuilt = root.rstrip("/") + "/" + directory + name if relative else directory + name
+        self.assertEqual(path, rebuilt)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,3 +1,5 @@
+import json
+import os
 import shutil
 import tempfile
 import time
@@ -5,9 +7,13 @@ import unittest
 from dataclasses import replace
 from datetime import datetime, timedelta
 from pathlib import Path
+from unittest import mock
 
 from PIL import Image
 
+from app.model.scan_rules import ScanRules
+from app.refresh_report import PHASE_WALK, PHASE_STAT, PHASE_DB_DIFF, PHASE_DECODE, PHASE_THUMBNAIL_ENCODE, \
+    PHASE_DB_WRITE, PHASE_THUMBNAIL_CACHE
 from app.repository import Repository
 from app.workspace_mgr import WorkspaceManager
 
@@ -166,6 +172,120 @@ class WorkspaceManagerIntegrationTests(unittest.TestCase):
         )
         self.assertEqual(5, db_image_after_refresh.rank)
 
+    def test_new_images_are_read_once_for_the_cache_key_and_decoding(self):
+        image_path = self.test_dir.joinpath("img.png")
+        self.mk_img_file(image_path)
+        real_open = open
+
+        with mock.patch("builtins.open", side_effect=real_open) as opened:
+            ws = self.mgr.create_new_workspace(path=self.test_dir, name="test", set_current=True)
+
+        self.assertEqual(1, sum(1 for c in opened.call_args_list if c.args and str(c.args[0]) == str(image_path)))
+        image = self.repo.get_all_images_for_workspace(ws.id)[0]
+        self.assertEqual((8, 8), image.dimensions)
+        self.assertTrue(image.thumbnail)
+
+    def test_rank_set_while_refreshing_is_kept(self):
+        image_path = self.test_dir.joinpath("img.png")
+        self.mk_img_file(image_path)
+        ws = self.mgr.create_new_workspace(path=self.test_dir, name="test", set_current=True)
+        self.wait()
+        self.mk_img_file(image_path)  # update the file
+        read_image = WorkspaceManager._read_image
+
+        def rank_while_reading(mgr, *args):
+            # after the diff read the rank, before the image is written
+            self.repo.persist_image(replace(self.repo.get_image(ws.id, str(image_path)), rank=3))
+            return read_image(mgr, *args)
+
+        with mock.patch.object(WorkspaceManager, "_read_image", autospec=True, side_effect=rank_while_reading):
+            report = self.mgr.refresh_current_workspace()
+
+        self.assertEqual(1, report.files_updated)
+        self.assertEqual(3, self.repo.get_image(ws.id, str(image_path)).rank)
+
+    def test_refresh_report_is_written_with_phase_timings(self):
+        ws_dir = self.test_dir.joinpath("ws")
+        ws_dir.mkdir()
+        for name in ["a.png", "b.png", "c.png"]:
+            self.mk_img_file(ws_dir.joinpath(name))
+        image_bytes = sum(p.stat().st_size for p in ws_dir.iterdir())
+        ws_dir.joinpath("broken.png").write_text("not an image")
+        reports_dir = self.test_dir.joinpath("reports")
+        self.mgr = WorkspaceManager(repo=self.repo, reports_dir=reports_dir, db_batch_size=2)
+        self.mgr.create_new_workspace(path=ws_dir, name="report", set_current=True)
+
+        ws_dir.joinpath("c.png").unlink()
+        report = self.mgr.refresh_current_workspace()
+
+        self.assertEqual(3, report.files_found)
+        self.assertEqual(0, report.files_updated)
+        self.assertEqual(1, report.files_missing)
+        self.assertEqual(1, report.files_failed)  # broken.png is retried on every refresh
+        reports = sorted(reports_dir.glob("refresh-*.json"))
+        self.assertEqual(2, len(reports))
+        first = json.loads(reports[0].read_text(encoding="utf8"))
+        # the files are the same, c.png has the thumbnail written with the first batch in the cache
+        self.assertEqual({"found": 4, "updated": 3, "missing": 0, "failed": 1, "thumbnails_cached": 1},
+                         first["files"])
+        self.assertEqual(
+            [PHASE_WALK, PHASE_STAT, PHASE_DB_DIFF, PHASE_THUMBNAIL_CACHE, PHASE_DECODE, PHASE_THUMBNAIL_ENCODE,
+             PHASE_DB_WRITE],
+            list(first["phases"]),
+        )
+        self.assertEqual(4, first["phases"][PHASE_THUMBNAIL_CACHE]["items"])
+        self.assertEqual(2, first["phases"][PHASE_THUMBNAIL_ENCODE]["items"])
+        self.assertEqual(3, first["phases"][PHASE_DB_WRITE]["items"])
+        self.assertEqual(image_bytes * 2 // 3, first["phases"][PHASE_DECODE]["bytes"])
+        self.assertEqual(4, len(first["slowest_files"]))
+        self.assertTrue(all(p["wall"] >= 0 and p["cpu"] >= 0 for p in first["phases"].values()))
+        self.assertEqual(
+            {str(ws_dir.joinpath(n)) for n in ["a.png", "b.png"]},
+            {i.path for i in self.repo.get_all_images_for_workspace(report.workspace.id)},
+        )
+
+    def test_workspace_over_indexed_files_gets_thumbnails_from_the_cache(self):
+        parent_dir = self.test_dir.joinpath("parent")
+        parent_dir.joinpath("sub").mkdir(parents=True)
+        for i, name in enumerate(["a.png", "sub/b.png", "sub/c.png"]):
+            Image.new('RGB', (8 + i, 8), color='white').save(parent_dir.joinpath(name))
+        self.mgr.create_new_workspace(path=parent_dir, name="parent", set_current=True)
+
+        with mock.patch("PIL.Image.open", side_effect=AssertionError("decoded")):
+            sub = self.mgr.create_new_workspace(path=parent_dir.joinpath("sub"), name="sub", set_current=False)
+            self.mgr.set_workspace_as_current(sub.id)
+            report = self.mgr.refresh_current_workspace()
+
+        self.assertEqual(2, report.files_updated)
+        self.assertEqual(2, report.thumbnails_cached)
+        self.assertNotIn(PHASE_DECODE, report.phases)
+        images = self.repo.get_all_images_for_workspace(sub.id)
+        self.assertEqual([(9, 8), (10, 8)], [i.dimensions for i in images])
+        self.assertTrue(all(i.thumbnail for i in images))
+
+    def test_subtrees_excluded_by_scan_rules_are_not_listed(self):
+        for d in [".cache/models", "out/latents", "out/keep"]:
+            self.test_dir.joinpath(*d.split("/")).mkdir(parents=True)
+        for name in ["a.png", "a.jpg", ".cache/models/b.png", "out/c.png", "out/latents/d.png", "out/keep/e.tmp.png"]:
+            self.mk_img_file(Path(*name.split("/")))
+        ws = self.mgr.create_new_workspace(path=self.test_dir, name="rules", set_current=False)
+        self.repo.set_scan_rules(ws.id, ScanRules(patterns=".cache/\nlatents/\n*.tmp.png\n", extensions=(".png",)))
+        self.mgr.set_workspace_as_current(ws.id)
+
+        with mock.patch("os.scandir", wraps=os.scandir) as scandir:
+            report = self.mgr.refresh_current_workspace()
+
+        self.assertEqual(
+            {str(self.test_dir.joinpath(*n.split("/"))) for n in ["a.png", "out/c.png"]},
+            {i.path for i in self.repo.get_all_images_for_workspace(ws.id)},
+        )
+        self.assertEqual((2, 1), (report.dirs_pruned, report.files_pruned))
+        self.assertEqual({"dirs": 2, "files": 1}, report.to_json()["pruned"])
+        listed = {os.path.relpath(c.args[0], self.test_dir) for c in scandir.call_args_list}
+        self.assertEqual({".", "out", os.path.join("out", "keep")}, listed)
+        self.assertEqual(ScanRules(patterns=".cache/\nlatents/\n*.tmp.png\n", extensions=(".png",)),
+                         self.repo.get_scan_rules(ws.id))
+
 
 if __name__ == "__main__":
     unittest.main()